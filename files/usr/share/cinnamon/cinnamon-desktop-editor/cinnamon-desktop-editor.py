@@ -17,6 +17,8 @@ from cme import util
 
 sys.path.insert(0, '/usr/share/cinnamon/cinnamon-settings')
 from bin import JsonSettingsWidgets
+from bin import ExecutableIndex
+from bin import GSettingsWidgets
 
 # i18n
 gettext.install("cinnamon", "/usr/share/locale")
@@ -168,6 +170,11 @@ class ItemEditor(object):
 
         self.dialog.connect('response', self.on_response)
 
+        # The PATH directories are listed once, the monitors keep the
+        # listing and the cached lookups current
+        self.executables = ExecutableIndex.get_default()
+        GSettingsWidgets.get_file_monitor()
+
         icon = self.builder.get_object('icon-image')
         icon._file = None
         icon._icon_name = None
@@ -209,7 +216,8 @@ class ItemEditor(object):
     def validate_exec_line(self, string):
         try:
             success, parsed = GLib.shell_parse_argv(string)
-            if GLib.find_program_in_path(parsed[0]) or ((not os.path.isdir(parsed[0])) and os.access(parsed[0], os.X_OK)):
+            # This runs on every keystroke, it only looks at the cached listing
+            if self.executables.find(parsed[0]) or ((not os.path.isdir(parsed[0])) and os.access(parsed[0], os.X_OK)):
                 return True
         except:
             pass
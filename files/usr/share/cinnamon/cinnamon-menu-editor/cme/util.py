@@ -125,7 +125,16 @@ class SurfaceWrapper:
     def __init__(self, surface):
         self.surface = surface
 
+# Icon surfaces by icon and size, many entries share the same icon and the
+# tree is reloaded after every edit
+icon_cache = {}
+icon_cache_theme = None
+
+def clearIconCache(icon_theme=None):
+    icon_cache.clear()
+
 def getIcon(item, widget):
+    global icon_cache_theme
     wrapper = SurfaceWrapper(None)
     pixbuf = None
     if item is None:
@@ -144,6 +153,17 @@ def getIcon(item, widget):
 
     icon_theme = Gtk.IconTheme.get_default()
     size = 24 * widget.get_scale_factor()
+    if icon_cache_theme is not icon_theme:
+        icon_cache.clear()
+        icon_theme.connect("changed", clearIconCache)
+        icon_cache_theme = icon_theme
+
+    key = (gicon.to_string(), size)
+    if key in icon_cache:
+        wrapper.surface = icon_cache[key]
+        return wrapper
+    if key[0] is not None:
+        icon_cache[key] = None
     info = icon_theme.lookup_by_gicon(gicon, size, 0)
     if info is None:
         return wrapper
@@ -157,6 +177,8 @@ def getIcon(item, widget):
         pixbuf = pixbuf.scale_simple(size, size, GdkPixbuf.InterpType.HYPER)
 
     wrapper.surface = Gdk.cairo_surface_create_from_pixbuf (pixbuf, widget.get_scale_factor(), widget.get_window())
+    if key[0] is not None:
+        icon_cache[key] = wrapper.surface
     return wrapper
 
 def removeWhitespaceNodes(node):
@@ -8,6 +8,8 @@ import gettext
 import shutil
 import re
 import subprocess
+import threading
+import collections
 from random import randint
 
 import PIL
@@ -15,13 +17,235 @@ from PIL import Image
 import gi
 gi.require_version("Gtk", "3.0")
 gi.require_version("AccountsService", "1.0")
-from gi.repository import Gtk, GObject, Gio, GdkPixbuf, AccountsService
+from gi.repository import Gtk, GObject, Gio, GLib, GdkPixbuf, AccountsService
 
 gettext.install("cinnamon", "/usr/share/locale")
 
 (INDEX_USER_OBJECT, INDEX_USER_PICTURE, INDEX_USER_DESCRIPTION) = range(3)
 (INDEX_GID, INDEX_GROUPNAME) = range(2)
 
+GENERIC_FACE = "/usr/share/cinnamon/faces/user-generic.png"
+
+# Sizes of the pictures in the user list and face menu, and in the user details
+LIST_FACE_SIZE = 48
+FACE_SIZE = 96
+
+class FaceCache:
+    """ User pictures, decoded and scaled asynchronously.
+
+    The list, the user details and the face menu all get their pictures
+    from here. The most recently used ones are kept, keyed on the file's
+    mtime so a changed picture is loaded again, and callers asking for a
+    picture already being loaded share the same load.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.pixbufs = collections.OrderedDict()
+        self.pending = {}
+
+    def get(self, path, size, callback):
+        # Calls callback(pixbuf) once loaded, or right away if cached. Falls
+        # back to the generic face when the picture can't be read.
+        try:
+            key = (path, size, os.path.getmtime(path))
+        except OSError:
+            if path != GENERIC_FACE:
+                self.get(GENERIC_FACE, size, callback)
+            return
+
+        pixbuf = self.pixbufs.pop(key, None)
+        if pixbuf is not None:
+            self.pixbufs[key] = pixbuf
+            callback(pixbuf)
+            return
+
+        if key in self.pending:
+            self.pending[key].append(callback)
+            return
+        self.pending[key] = [callback]
+        Gio.File.new_for_path(path).read_async(GLib.PRIORITY_DEFAULT, None, self.on_file_read, key)
+
+    def on_file_read(self, file, result, key):
+        try:
+            stream = file.read_finish(result)
+            GdkPixbuf.Pixbuf.new_from_stream_at_scale_async(stream, key[1], key[1], True, None, self.on_pixbuf_loaded, key)
+        except GLib.Error, detail:
+            self.on_failed(key, detail)
+
+    def on_pixbuf_loaded(self, stream, result, key):
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_stream_finish(result)
+        except GLib.Error, detail:
+            self.on_failed(key, detail)
+            return
+        finally:
+            stream.close(None)
+
+        self.pixbufs[key] = pixbuf
+        while len(self.pixbufs) > self.max_size:
+            self.pixbufs.popitem(last=False)
+        for callback in self.pending.pop(key):
+            callback(pixbuf)
+
+    def on_failed(self, key, detail):
+        print "Failed to load %s: %s" % (key[0], detail)
+        callbacks = self.pending.pop(key)
+        if key[0] != GENERIC_FACE:
+            for callback in callbacks:
+                self.get(GENERIC_FACE, key[1], callback)
+
+class SessionCounter:
+    """ Counts the sessions of a user without blocking.
+
+    Asks logind over D-Bus, and falls back to parsing "w" in a subprocess
+    when logind isn't available.
+    """
+
+    def __init__(self):
+        self.proxy = None
+        Gio.DBusProxy.new_for_bus(Gio.BusType.SYSTEM,
+                                  Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES | Gio.DBusProxyFlags.DO_NOT_CONNECT_SIGNALS,
+                                  None,
+                                  "org.freedesktop.login1",
+                                  "/org/freedesktop/login1",
+                                  "org.freedesktop.login1.Manager",
+                                  None,
+                                  self.on_proxy_ready,
+                                  None)
+
+    def on_proxy_ready(self, source, result, data):
+        try:
+            proxy = Gio.DBusProxy.new_for_bus_finish(result)
+            if proxy.get_name_owner() is not None:
+                self.proxy = proxy
+        except GLib.Error, detail:
+            print "logind is not available: %s" % detail
+
+    def count(self, username, callback):
+        # Calls callback(username, n_sessions)
+        if self.proxy is not None:
+            self.proxy.call("ListSessions", None, Gio.DBusCallFlags.NONE, -1, None, self.on_sessions_listed, (username, callback))
+        else:
+            self.count_with_w(username, callback)
+
+    def on_sessions_listed(self, proxy, result, data):
+        username, callback = data
+        try:
+            sessions = proxy.call_finish(result).unpack()[0]
+        except GLib.Error, detail:
+            print "Failed to list the sessions: %s" % detail
+            self.count_with_w(username, callback)
+            return
+        callback(username, len([session for session in sessions if session[2] == username]))
+
+    def count_with_w(self, username, callback):
+        try:
+            process = Gio.Subprocess.new(["w", "-hs", username], Gio.SubprocessFlags.STDOUT_PIPE)
+        except GLib.Error, detail:
+            print "Failed to count the sessions: %s" % detail
+            callback(username, 0)
+            return
+        process.communicate_utf8_async(None, None, self.on_w_done, (username, callback))
+
+    def on_w_done(self, process, result, data):
+        username, callback = data
+        try:
+            success, stdout, stderr = process.communicate_utf8_finish(result)
+        except GLib.Error, detail:
+            print "Failed to count the sessions: %s" % detail
+            stdout = ""
+        callback(username, (stdout or "").count("\n"))
+
+class GroupIndex:
+    """ Which users are in which groups, read once.
+
+    Enumerating groups goes through NSS, which takes seconds with large
+    directory services behind it, so it is done in a thread and the result
+    is kept until the local account databases change or reload() is called
+    after an edit. The callback is called in the main thread every time a
+    new index is ready.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.groups = []
+        self.user_groups = {}
+        self.primary_users = {}
+        self.loaded = False
+        self.loading = False
+        self.reload_pending = False
+
+        self.monitors = []
+        for path in ("/etc/group", "/etc/passwd"):
+            monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            monitor.connect("changed", self.on_file_changed)
+            self.monitors.append(monitor)
+
+        self.reload()
+
+    def on_file_changed(self, monitor, file, other_file, event_type):
+        if event_type == Gio.FileMonitorEvent.CHANGES_DONE_HINT or event_type == Gio.FileMonitorEvent.CREATED:
+            self.reload()
+
+    def reload(self):
+        if self.loading:
+            # Read again once the current pass is done, it may have missed the change
+            self.reload_pending = True
+            return
+        self.loading = True
+        thread = threading.Thread(target=self.build)
+        thread.daemon = True
+        thread.start()
+
+    def read_entries(self, database):
+        # grp and pwd hold the interpreter lock for the whole enumeration,
+        # which would freeze the UI all the same, so getent does the reading
+        try:
+            output = subprocess.check_output(["getent", database])
+            return [line.split(":") for line in output.splitlines() if line.count(":") >= 3]
+        except (OSError, subprocess.CalledProcessError):
+            if database == "group":
+                return [(g[0], g[1], str(g[2]), ",".join(g[3])) for g in grp.getgrall()]
+            return [(p[0], p[1], str(p[2]), str(p[3])) for p in pwd.getpwall()]
+
+    def build(self):
+        groups = []
+        user_groups = {}
+        primary_users = {}
+        try:
+            for entry in self.read_entries("group"):
+                gr_name, gr_gid, gr_mem = entry[0], int(entry[2]), entry[3]
+                groups.append((gr_name, gr_gid))
+                for username in gr_mem.split(","):
+                    if username != "":
+                        user_groups.setdefault(username, set()).add(gr_name)
+            for entry in self.read_entries("passwd"):
+                primary_users.setdefault(int(entry[3]), entry[0])
+        except Exception, detail:
+            print "Failed to read the groups: %s" % detail
+        groups.sort()
+        GLib.idle_add(self.on_built, groups, user_groups, primary_users)
+
+    def on_built(self, groups, user_groups, primary_users):
+        self.groups = groups
+        self.user_groups = user_groups
+        self.primary_users = primary_users
+        self.loaded = True
+        self.loading = False
+        if self.reload_pending:
+            self.reload_pending = False
+            self.reload()
+        self.callback()
+        return False
+
+    def get_groups_of_user(self, username):
+        return sorted(self.user_groups.get(username, ()))
+
+    def get_primary_user(self, gid):
+        # The name of a user having gid as primary group, or None
+        return self.primary_users.get(gid)
+
 class GroupDialog (Gtk.Dialog):
     def __init__ (self, label, value):
         super(GroupDialog, self).__init__()
@@ -380,7 +604,7 @@ class NewUserDialog(Gtk.Dialog):
 
 class GroupsDialog(Gtk.Dialog):
 
-    def __init__ (self, username):
+    def __init__ (self, username, group_index):
         super(GroupsDialog, self).__init__()
 
         try:
@@ -394,12 +618,12 @@ class GroupsDialog(Gtk.Dialog):
             viewport = Gtk.Viewport()
             vbox = Gtk.VBox()
             self.checkboxes = []
-            groups = sorted(grp.getgrall(), key=lambda x: x[0], reverse=False)
-            for group in groups:
-                checkbox = Gtk.CheckButton(group[0])
+            user_groups = group_index.get_groups_of_user(username)
+            for (gr_name, gr_gid) in group_index.groups:
+                checkbox = Gtk.CheckButton(gr_name)
                 self.checkboxes.append(checkbox)
                 vbox.add(checkbox)
-                if username in group[3]:
+                if gr_name in user_groups:
                     checkbox.set_active(True)
 
             viewport.add(vbox)
@@ -481,7 +705,9 @@ class Module:
             self.face_button = Gtk.Button()
             self.face_image = Gtk.Image()
             self.face_button.set_image(self.face_image)
-            self.face_image.set_from_file("/usr/share/cinnamon/faces/user-generic.png")
+            self.face_cache = FaceCache()
+            self.face_cache.get(GENERIC_FACE, FACE_SIZE, self.face_image.set_from_pixbuf)
+            self.session_counter = SessionCounter()
             self.face_button.set_alignment(0.0, 0.5)
             self.face_button.set_tooltip_text(_("Click to change the picture"))
 
@@ -501,9 +727,9 @@ class Module:
                     pictures = sorted(os.listdir(face_dir))
                     for picture in pictures:
                         path = os.path.join(face_dir, picture)
-                        file = Gio.File.new_for_path(path)
-                        file_icon = Gio.FileIcon.new(file)
-                        image = Gtk.Image.new_from_gicon (file_icon, Gtk.IconSize.DIALOG)
+                        image = Gtk.Image()
+                        image.set_size_request(LIST_FACE_SIZE, LIST_FACE_SIZE)
+                        self.face_cache.get(path, LIST_FACE_SIZE, image.set_from_pixbuf)
                         menuitem = Gtk.MenuItem()
                         menuitem.add(image)
                         menuitem.connect('activate', self._on_face_menuitem_activated, path)
@@ -556,7 +782,7 @@ class Module:
             self.accountService = AccountsService.UserManager.get_default()
             self.accountService.connect('notify::is-loaded', self.on_accounts_service_loaded)
 
-            self.load_groups()
+            self.group_index = GroupIndex(self.on_group_index_loaded)
 
             self.window.show_all()
 
@@ -576,13 +802,14 @@ class Module:
         model, treeiter = self.users_treeview.get_selection().get_selected()
         if treeiter != None:
             user = model[treeiter][INDEX_USER_OBJECT]
-            dialog = GroupsDialog(user.get_user_name())
+            dialog = GroupsDialog(user.get_user_name(), self.group_index)
             response = dialog.run()
             if response == Gtk.ResponseType.OK:
                 groups = dialog.get_selected_groups()
                 subprocess.call(["usermod", user.get_user_name(), "-G", ",".join(groups)])
                 groups.sort()
                 self.groups_label.set_text(", ".join(groups))
+                self.group_index.reload()
             dialog.destroy()
 
     def _on_accounttype_changed(self, combobox):
@@ -594,12 +821,8 @@ class Module:
             else:
                 user.set_account_type(AccountsService.UserAccountType.STANDARD)
 
-            groups = []
-            for group in grp.getgrall():
-                if user.get_user_name() in group[3]:
-                    groups.append(group[0])
-            groups.sort()
-            self.groups_label.set_text(", ".join(groups))
+            # The label is updated once the new memberships are read
+            self.group_index.reload()
 
     def _on_realname_changed(self, widget, text):
         model, treeiter = self.users_treeview.get_selection().get_selected()
@@ -647,9 +870,8 @@ class Module:
                 face_path = os.path.join(user.get_home_dir(), ".face")
                 image.save(face_path, "png")
                 user.set_icon_file(face_path)
-                self.face_image.set_from_file(face_path)
-                model.set_value(treeiter, INDEX_USER_PICTURE, GdkPixbuf.Pixbuf.new_from_file_at_size(face_path, 48, 48))
-                model.row_changed(model.get_path(treeiter), treeiter)
+                self.show_face(user, face_path)
+                self.load_list_face(model, treeiter, face_path)
 
             dialog.destroy()
 
@@ -670,10 +892,9 @@ class Module:
             if treeiter != None:
                 user = model[treeiter][INDEX_USER_OBJECT]
                 user.set_icon_file(path)
-                self.face_image.set_from_file(path)
+                self.show_face(user, path)
                 shutil.copy(path, os.path.join(user.get_home_dir(), ".face"))
-                model.set_value(treeiter, INDEX_USER_PICTURE, GdkPixbuf.Pixbuf.new_from_file_at_size(path, 48, 48))
-                model.row_changed(model.get_path(treeiter), treeiter)
+                self.load_list_face(model, treeiter, path)
 
 
     def menu_display(self, widget, event):
@@ -709,22 +930,65 @@ class Module:
         self.users.clear()
         users = self.accountService.list_users()
         for user in users:
-            if os.path.exists(user.get_icon_file()):
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(user.get_icon_file(), 48, 48)
-            else:
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size("/usr/share/cinnamon/faces/user-generic.png", 48, 48)
             description = "<b>%s</b>\n%s" % (user.get_real_name(), user.get_user_name())
-            piter = self.users.append(None, [user, pixbuf, description])
+            piter = self.users.append(None, [user, None, description])
+            self.load_list_face(self.users, piter, user.get_icon_file())
         self.users_treeview.set_model(self.users)
 
+    def load_list_face(self, model, treeiter, path):
+        # The row may be gone or moved by the time the picture is loaded
+        row = Gtk.TreeRowReference.new(model, model.get_path(treeiter))
+        def on_loaded(pixbuf):
+            if row.valid():
+                model.set_value(model.get_iter(row.get_path()), INDEX_USER_PICTURE, pixbuf)
+        self.face_cache.get(path, LIST_FACE_SIZE, on_loaded)
+
+    def show_face(self, user, path):
+        # Only shown if the user is still selected once loaded
+        def on_loaded(pixbuf):
+            if self.get_selected_user() is user:
+                self.face_image.set_from_pixbuf(pixbuf)
+        self.face_cache.get(path, FACE_SIZE, on_loaded)
+
+    def get_selected_user(self):
+        model, treeiter = self.users_treeview.get_selection().get_selected()
+        if treeiter == None:
+            return None
+        return model[treeiter][INDEX_USER_OBJECT]
+
+    def on_sessions_counted(self, username, connections):
+        user = self.get_selected_user()
+        if user is None or user.get_user_name() != username:
+            return
+        if connections > 0:
+            self.builder.get_object("button_delete_user").set_sensitive(False)
+            self.builder.get_object("button_delete_user").set_tooltip_text(_("This user is currently logged in"))
+        else:
+            self.builder.get_object("button_delete_user").set_sensitive(True)
+            self.builder.get_object("button_delete_user").set_tooltip_text("")
+
+    def on_group_index_loaded(self):
+        self.load_groups()
+        self.update_groups_label()
+        self.on_group_selection(self.groups_treeview.get_selection())
+
     def load_groups(self):
         self.groups.clear()
-        groups = sorted(grp.getgrall(), key=lambda x: x[0], reverse=False)
-        for group in groups:
-            (gr_name, gr_passwd, gr_gid, gr_mem) = group
+        for (gr_name, gr_gid) in self.group_index.groups:
             piter = self.groups.append(None, [gr_gid, gr_name])
         self.groups_treeview.set_model(self.groups)
 
+    def update_groups_label(self):
+        model, treeiter = self.users_treeview.get_selection().get_selected()
+        if treeiter == None:
+            return
+        user = model[treeiter][INDEX_USER_OBJECT]
+        if self.group_index.loaded:
+            self.groups_label.set_text(", ".join(self.group_index.get_groups_of_user(user.get_user_name())))
+        else:
+            self.groups_label.set_text("...")
+        self.groups_button.set_sensitive(self.group_index.loaded)
+
 #USER CALLBACKS
 
     def on_user_selection(self, selection):
@@ -749,27 +1013,15 @@ class Module:
             else:
                 self.account_type_combo.set_active(0)
 
-            if os.path.exists(user.get_icon_file()):
-                self.face_image.set_from_file(user.get_icon_file())
-            else:
-                self.face_image.set_from_file("/usr/share/cinnamon/faces/user-generic.png")
-
-            groups = []
-            for group in grp.getgrall():
-                if user.get_user_name() in group[3]:
-                    groups.append(group[0])
-            groups.sort()
-            self.groups_label.set_text(", ".join(groups))
+            self.show_face(user, user.get_icon_file())
+
+            self.update_groups_label()
             self.builder.get_object("box_users").show()
 
-            # Count the number of connections for the currently logged-in user
-            connections = int(subprocess.check_output(["w", "-hs", user.get_user_name()]).count("\n"))
-            if connections > 0:
-                self.builder.get_object("button_delete_user").set_sensitive(False)
-                self.builder.get_object("button_delete_user").set_tooltip_text(_("This user is currently logged in"))
-            else:
-                self.builder.get_object("button_delete_user").set_sensitive(True)
-                self.builder.get_object("button_delete_user").set_tooltip_text("")
+            # Count the number of connections for the currently logged-in user.
+            # Deleting is only allowed once we know there are none.
+            self.builder.get_object("button_delete_user").set_sensitive(False)
+            self.session_counter.count(user.get_user_name(), self.on_sessions_counted)
 
             if os.path.exists("/home/.ecryptfs/%s" % user.get_user_name()):
                 self.password_button.set_sensitive(False)
@@ -797,7 +1049,7 @@ class Module:
                 result = self.accountService.delete_user(user, True)
                 if result:
                     model.remove(treeiter)
-                    self.load_groups()
+                    self.group_index.reload()
 
     def on_user_addition(self, event):
         dialog = NewUserDialog()
@@ -811,15 +1063,15 @@ class Module:
             username = dialog.username_entry.get_text()
             new_user = self.accountService.create_user(username, fullname, account_type)
             new_user.set_password_mode(AccountsService.UserPasswordMode.NONE)
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size("/usr/share/cinnamon/faces/user-generic.png", 48, 48)
             description = "<b>%s</b>\n%s" % (fullname, username)
-            piter = self.users.append(None, [new_user, pixbuf, description])
+            piter = self.users.append(None, [new_user, None, description])
+            self.load_list_face(self.users, piter, GENERIC_FACE)
             # Add the user to his/her own group and sudo if Administrator was selected
             if dialog.account_type_combo.get_active() == 1:
                 subprocess.call(["usermod", username, "-G", "%s,sudo,nopasswdlogin" % username])
             else:
                 subprocess.call(["usermod", username, "-G", "%s,nopasswdlogin" % username])
-            self.load_groups()
+            self.group_index.reload()
         dialog.destroy()
 
     def on_user_edition(self, event):
@@ -835,14 +1087,10 @@ class Module:
             self.builder.get_object("button_edit_group").set_sensitive(True)
             self.builder.get_object("button_delete_group").set_sensitive(True)
             self.builder.get_object("button_delete_group").set_tooltip_text("")
-            group = model[treeiter][INDEX_GROUPNAME]
-            for p in pwd.getpwall():
-                username = p[0]
-                primary_group = grp.getgrgid(p[3])[0]
-                if primary_group == group:
-                    self.builder.get_object("button_delete_group").set_sensitive(False)
-                    self.builder.get_object("button_delete_group").set_tooltip_text(_("This group is set as %s's primary group") % username)
-                    break
+            username = self.group_index.get_primary_user(model[treeiter][INDEX_GID])
+            if username is not None:
+                self.builder.get_object("button_delete_group").set_sensitive(False)
+                self.builder.get_object("button_delete_group").set_tooltip_text(_("This group is set as %s's primary group") % username)
 
         else:
             self.builder.get_object("button_edit_group").set_sensitive(False)
@@ -864,7 +1112,7 @@ class Module:
             r = d.run()
             if r == Gtk.ResponseType.YES:
                 subprocess.call(["groupdel", group])
-                self.load_groups()
+                self.group_index.reload()
             d.destroy()
 
     def on_group_addition(self, event):
@@ -872,7 +1120,7 @@ class Module:
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
             subprocess.call(["groupadd", dialog.entry.get_text().lower()])
-            self.load_groups()
+            self.group_index.reload()
         dialog.destroy()
 
     def on_group_edition(self, event):
@@ -883,7 +1131,7 @@ class Module:
             response = dialog.run()
             if response == Gtk.ResponseType.OK:
                 subprocess.call(["groupmod", group, "-n", dialog.entry.get_text().lower()])
-                self.load_groups()
+                self.group_index.reload()
             dialog.destroy()
 
 
@@ -0,0 +1,136 @@
+#!/usr/bin/python2
+
+import os
+
+from gi.repository import Gio, GLib, GObject
+
+def get_application_dirs():
+    return [os.path.join(x, "applications") for x in [GLib.get_user_data_dir()] + GLib.get_system_data_dirs()]
+
+def find_desktop_files():
+    # Returns {desktop id: mtime} for every desktop file, the first directory
+    # providing an id hides the others, as in GIO
+    found = {}
+    for directory in get_application_dirs():
+        for root, dirs, files in os.walk(directory):
+            prefix = os.path.relpath(root, directory)
+            for name in files:
+                if not name.endswith(".desktop"):
+                    continue
+                desktop_id = name if prefix == "." else "%s-%s" % (prefix.replace(os.path.sep, "-"), name)
+                if desktop_id in found:
+                    continue
+                try:
+                    found[desktop_id] = os.path.getmtime(os.path.join(root, name))
+                except OSError:
+                    pass
+    return found
+
+class AppIndex(GObject.GObject):
+    """ Every installed application, read once per process.
+
+    Applications are indexed by id, category, supported content type and
+    executable name. When Gio.AppInfoMonitor reports a change, the desktop
+    files are only listed and stat'ed, and just the ones that were added or
+    modified are read again. "changed" is emitted afterwards.
+    """
+
+    __gsignals__ = {
+        "changed": (GObject.SignalFlags.RUN_LAST, None, ())
+    }
+
+    def __init__(self):
+        super(AppIndex, self).__init__()
+        self.apps = {}
+        self.mtimes = {}
+        self.by_category = {}
+        self.by_content_type = {}
+        self.by_executable = {}
+        # Where each id was filed, so it can be taken out again
+        self.keys_by_id = {}
+
+        self.update()
+
+        self.monitor = Gio.AppInfoMonitor.get()
+        self.monitor.connect("changed", self.on_apps_changed)
+
+    def update(self):
+        # Returns whether anything changed
+        found = find_desktop_files()
+        changed = False
+
+        for desktop_id in self.mtimes.keys():
+            if desktop_id not in found:
+                self.remove(desktop_id)
+                del self.mtimes[desktop_id]
+                changed = True
+
+        for desktop_id, mtime in found.items():
+            if self.mtimes.get(desktop_id) == mtime:
+                continue
+            self.remove(desktop_id)
+            self.mtimes[desktop_id] = mtime
+            try:
+                info = Gio.DesktopAppInfo.new(desktop_id)
+            except TypeError:
+                info = None
+            if info is not None:
+                self.add(desktop_id, info)
+            changed = True
+
+        return changed
+
+    def add(self, desktop_id, info):
+        self.apps[desktop_id] = info
+        keys = []
+        for category in (info.get_categories() or "").split(";"):
+            if category != "":
+                keys.append((self.by_category, category))
+        for content_type in info.get_supported_types() or []:
+            keys.append((self.by_content_type, content_type))
+        executable = info.get_executable()
+        if executable:
+            keys.append((self.by_executable, os.path.basename(executable)))
+
+        for index, key in keys:
+            index.setdefault(key, set()).add(desktop_id)
+        self.keys_by_id[desktop_id] = keys
+
+    def remove(self, desktop_id):
+        if self.apps.pop(desktop_id, None) is None:
+            return
+        for index, key in self.keys_by_id.pop(desktop_id):
+            ids = index[key]
+            ids.discard(desktop_id)
+            if len(ids) == 0:
+                del index[key]
+
+    def on_apps_changed(self, monitor):
+        if self.update():
+            self.emit("changed")
+
+    def get_apps(self, ids):
+        return [self.apps[desktop_id] for desktop_id in sorted(ids)]
+
+    def get(self, desktop_id):
+        return self.apps.get(desktop_id)
+
+    def get_all(self):
+        return self.get_apps(self.apps.keys())
+
+    def get_by_category(self, category):
+        return self.get_apps(self.by_category.get(category, ()))
+
+    def get_for_content_type(self, content_type):
+        return self.get_apps(self.by_content_type.get(content_type, ()))
+
+    def get_by_executable(self, name):
+        return self.get_apps(self.by_executable.get(os.path.basename(name), ()))
+
+_default_index = None
+
+def get_default():
+    global _default_index
+    if _default_index is None:
+        _default_index = AppIndex()
+    return _default_index
@@ -0,0 +1,134 @@
+#!/usr/bin/python2
+
+import os
+import re
+import json
+import hashlib
+import thread
+
+from XletIndex import INDEX_DIR
+
+# Calls that can block Cinnamon's main loop when used by an xlet
+UNSAFE_ITEMS = ["spawn_sync", "spawn_command_line_sync", "GTop", "get_file_contents_utf8_sync"]
+UNSAFE_RE = re.compile("|".join(re.escape(item) for item in UNSAFE_ITEMS))
+
+# Bump this whenever UNSAFE_ITEMS or the layout of the cache changes
+SCAN_CACHE_VERSION = 1
+
+class DangerScanner:
+    """ Scans xlet directories for UNSAFE_ITEMS and remembers the verdicts.
+
+    Every scanned .js file is recorded with its size, mtime and content hash
+    so later scans only read files that changed; rescanning an unchanged xlet
+    costs a stat per file, on the worker thread. The cache lives in the user's
+    cache directory, the xlets themselves are never modified. scan() is safe to
+    call from several threads at once.
+    """
+
+    def __init__(self, collection_type):
+        self.cache_file = os.path.join(INDEX_DIR, "%ss-danger.json" % collection_type)
+        self.lock = thread.allocate_lock()
+        self.xlets = {}
+        self.verdicts_by_hash = {}
+        self.dirty = False
+
+        try:
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+            if cache["version"] == SCAN_CACHE_VERSION:
+                for directory, xlet in cache["xlets"].items():
+                    # json gives unicode, os.walk gives str
+                    files = {}
+                    for path, (size, mtime, digest, dangerous) in xlet["files"].items():
+                        files[path.encode("utf-8")] = [size, mtime, digest, dangerous]
+                        self.verdicts_by_hash[digest] = dangerous
+                    self.xlets[directory.encode("utf-8")] = {"dangerous": xlet["dangerous"], "files": files}
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def get_verdict(self, directory):
+        # Returns the result of the last scan of directory, or None if it was never scanned
+        with self.lock:
+            xlet = self.xlets.get(directory)
+        if xlet is None:
+            return None
+        return xlet["dangerous"]
+
+    def scan(self, directory, scan_path=None):
+        # The verdict is stored under directory, scan_path is the versioned
+        # subdirectory actually walked for multiversion xlets
+        with self.lock:
+            xlet = self.xlets.get(directory, {"files": {}})
+        old_files = xlet["files"]
+        files = {}
+        dangerous = False
+
+        for root, dirs, filenames in os.walk(scan_path or directory):
+            for filename in filenames:
+                if not filename.endswith(".js"):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    files[path] = self.scan_file(path, old_files.get(path))
+                except (IOError, OSError):
+                    continue
+                dangerous = dangerous or files[path][3]
+
+        with self.lock:
+            if files != old_files or dangerous != xlet.get("dangerous"):
+                self.xlets[directory] = {"dangerous": dangerous, "files": files}
+                self.dirty = True
+
+        return dangerous
+
+    def scan_file(self, path, cached):
+        st = os.stat(path)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached
+
+        with open(path, "r") as f:
+            contents = f.read()
+        digest = hashlib.sha1(contents).hexdigest()
+
+        with self.lock:
+            dangerous = self.verdicts_by_hash.get(digest)
+        if dangerous is None:
+            dangerous = UNSAFE_RE.search(contents) is not None
+            with self.lock:
+                self.verdicts_by_hash[digest] = dangerous
+
+        return [st.st_size, st.st_mtime, digest, dangerous]
+
+    def prune(self, directories):
+        with self.lock:
+            for directory in self.xlets.keys():
+                if directory not in directories:
+                    del self.xlets[directory]
+                    self.dirty = True
+            self.prune_verdicts()
+
+    def prune_verdicts(self):
+        # Called with the lock held, forgets the contents no scanned file has anymore
+        digests = set()
+        for xlet in self.xlets.values():
+            for size, mtime, digest, dangerous in xlet["files"].values():
+                digests.add(digest)
+        for digest in self.verdicts_by_hash.keys():
+            if digest not in digests:
+                del self.verdicts_by_hash[digest]
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.prune_verdicts()
+            try:
+                if not os.path.exists(INDEX_DIR):
+                    os.makedirs(INDEX_DIR)
+                tmp_file = self.cache_file + ".tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump({"version": SCAN_CACHE_VERSION, "xlets": self.xlets}, f)
+                os.rename(tmp_file, self.cache_file)
+                self.dirty = False
+            except (IOError, OSError) as e:
+                print "Failed to save danger scan cache %s: %s" % (self.cache_file, e)
@@ -0,0 +1,67 @@
+#!/usr/bin/python2
+
+import os
+
+from gi.repository import GLib
+
+def get_path_dirs():
+    env = GLib.getenv("PATH")
+
+    if env == None:
+        env = "/bin:/usr/bin:."
+
+    return [path.strip('"') for path in env.split(":")]
+
+class ExecutableIndex:
+    """ The names found in each PATH directory, listed once.
+
+    find() answers from the listings and only stats the file it is about to
+    return. The index is kept current by BinFileMonitor, which passes on the
+    path of every file that appears or disappears in a PATH directory.
+    """
+
+    def __init__(self):
+        self.paths = get_path_dirs()
+        self.names = {}
+        self.found = {}
+
+        for path in self.paths:
+            try:
+                self.names[path] = set(os.listdir(path))
+            except OSError:
+                self.names[path] = set()
+
+    def find(self, name):
+        # Returns the full path of the executable, like GLib.find_program_in_path
+        if os.path.sep in name:
+            if os.path.isfile(name) and os.access(name, os.X_OK):
+                return name
+            return None
+
+        if name not in self.found:
+            self.found[name] = None
+            for path in self.paths:
+                if name in self.names[path]:
+                    exe_file = os.path.join(path, name)
+                    if os.path.isfile(exe_file) and os.access(exe_file, os.X_OK):
+                        self.found[name] = exe_file
+                        break
+        return self.found[name]
+
+    def file_changed(self, filename):
+        path, name = os.path.split(filename)
+        if path not in self.names:
+            return
+        if os.path.lexists(filename):
+            self.names[path].add(name)
+        else:
+            self.names[path].discard(name)
+        self.found.pop(name, None)
+
+_default_index = None
+
+def get_default():
+    global _default_index
+    if _default_index is None:
+        _default_index = ExecutableIndex()
+    return _default_index
@@ -1,7 +1,6 @@
 #!/usr/bin/python2
 
 import sys
-import thread
 import os
 import re
 import json
@@ -14,8 +13,11 @@ import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gio, Gtk, GObject, Gdk, GdkPixbuf, Pango, GLib
 
-from SettingsWidgets import SidePage, SettingsStack
+from SettingsWidgets import SidePage, SettingsStack, fold_search_text
 from Spices import Spice_Harvester
+from XletIndex import XletIndex
+from DangerScanner import DangerScanner
+from WorkQueue import JobGroup, PRIORITY_HIGH, PRIORITY_DEFAULT, PRIORITY_LOW
 
 home = os.path.expanduser("~")
 
@@ -29,6 +31,9 @@ SETTING_TYPE_EXTERNAL = 2
 
 ROW_SIZE = 32
 
+# Delay before the installed list is refiltered after the search text changes
+REFILTER_DELAY = 150
+
 curr_ver = subprocess.check_output(["cinnamon", "--version"]).splitlines()[0].split(" ")[1]
 
 def find_extension_subdir(directory):
@@ -91,8 +96,13 @@ class ExtensionSidePage (SidePage):
         self.collection_type = collection_type
         self.themes = collection_type == "theme"
         self.icons = []
-        self.background_work_queue = None
+        self.scan_jobs = None
+        self.scan_jobs_by_uuid = {}
+        # Takes jobs for the lifetime of the page, so it is never closed
+        self.spices_jobs = JobGroup()
         self.run_once = False
+        self.xlet_index = None
+        self.danger_scanner = None
 
     def load(self, window=None):
 
@@ -119,6 +129,7 @@ class ExtensionSidePage (SidePage):
             self.vbox.pack_start(self.stack, True, True, 2)
 
         self.add_widget(self.stack)
+        self.stack.connect("destroy", self.on_destroy)
 
         extensions_vbox = Gtk.VBox()
 
@@ -126,6 +137,8 @@ class ExtensionSidePage (SidePage):
         self.search_entry.set_icon_from_icon_name(Gtk.EntryIconPosition.PRIMARY, 'edit-find-symbolic')
         self.search_entry.set_placeholder_text(_("Search"))
         self.search_entry.connect('changed', self.on_entry_refilter)
+        self.search_key = ""
+        self.refilter_id = 0
 
         if self.collection_type == "applet":
             self.stack.add_titled(extensions_vbox, "installed", _("Installed applets"))
@@ -184,8 +197,8 @@ class ExtensionSidePage (SidePage):
         self.treeview.append_column(isActiveColumn)
         self.treeview.set_headers_visible(False)
 
-        self.model = Gtk.TreeStore(str, str, int, int, object, str, int, bool, str, long, str, str, str, int, bool, bool)
-        #                          uuid, desc, enabled, max-instances, icon, name, read-only, hide-config-button, ext-setting-app, edit-date, read-only icon, active icon, schema file name (for uninstall), settings type, version_supported, dangerous
+        self.model = Gtk.TreeStore(str, str, int, int, object, str, int, bool, str, long, str, str, str, int, bool, bool, str)
+        #                          uuid, desc, enabled, max-instances, icon, name, read-only, hide-config-button, ext-setting-app, edit-date, read-only icon, active icon, schema file name (for uninstall), settings type, version_supported, dangerous, search key
 
         self.modelfilter = self.model.filter_new()
         self.showFilter = SHOW_ALL
@@ -217,6 +230,7 @@ class ExtensionSidePage (SidePage):
             self.settings.connect("changed::name", lambda x, y: self._enabled_extensions_changed())
 
         scrolledWindow.add(self.treeview)
+        scrolledWindow.get_vadjustment().connect("value-changed", lambda adj: self.prioritize_visible_scans())
         self.treeview.connect('button_press_event', self.on_button_press_event)
 
         if self.collection_type == "applet":
@@ -906,25 +920,33 @@ restarting Cinnamon."""
             cell.set_property("active", False)
 
     def only_active(self, model, iterr, data=None):
-        query = self.search_entry.get_buffer().get_text().lower()
-        extensionName = model.get_value(iterr, 5)
+        query = self.search_key
+        search_key = model.get_value(iterr, 16)
 
         enabled = model.get_value(iterr, 2)
 
-        if extensionName == None:
+        if search_key == None:
             return False
 
         if self.showFilter == SHOW_ALL:
-            return (query == "" or query in extensionName.lower())
+            return (query == "" or query in search_key)
         elif self.showFilter == SHOW_ACTIVE:
-            return enabled > 0 and (query == "" or query in extensionName.lower())
+            return enabled > 0 and (query == "" or query in search_key)
         elif self.showFilter == SHOW_INACTIVE:
-            return enabled <= 0 and (query == "" or query in extensionName.lower())
+            return enabled <= 0 and (query == "" or query in search_key)
         else:
             return False
 
     def on_entry_refilter(self, widget, data=None):
+        if self.refilter_id > 0:
+            GLib.source_remove(self.refilter_id)
+        self.refilter_id = GLib.timeout_add(REFILTER_DELAY, self._refilter_installed)
+
+    def _refilter_installed(self):
+        self.refilter_id = 0
+        self.search_key = fold_search_text(self.search_entry.get_text())
         self.modelfilter.refilter()
+        return False
 
     def gm_changed_sorting(self, widget):
         tree_iter = widget.get_active_iter()
@@ -955,11 +977,11 @@ restarting Cinnamon."""
     def load_spices(self, force=False):
         self.update_list = {}
 
-        thread.start_new_thread(self.spices.load, (self.on_spice_load, force))
+        self.spices_jobs.push(self.spices.load, (self.on_spice_load, force), PRIORITY_HIGH)
 
     def install_extensions(self):
         if len(self.install_list) > 0:
-            thread.start_new_thread(self.spices.install_all, (self.install_list, self.install_finished))
+            self.spices_jobs.push(self.spices.install_all, (self.install_list, self.install_finished), PRIORITY_HIGH)
 
     def install_finished(self, need_restart):
         for row in self.gm_model:
@@ -984,25 +1006,24 @@ restarting Cinnamon."""
             self.gm_model.set_value(iter, 1, '<b>%s</b>' % (extensionName))
             self.gm_model.set_value(iter, 2, 0)
 
+            icon_path = extensionData['icon_path']
             if not self.themes:
-                icon_filename = os.path.basename(extensionData['icon'])
                 w = ROW_SIZE + 5
                 h = ROW_SIZE + 5
             else:
-                icon_filename = os.path.basename(extensionData['screenshot'])
                 w = -1
                 h = 60
             if w != -1:
                 w = w * self.window.get_scale_factor()
             h = h * self.window.get_scale_factor()
 
-            if not os.path.exists(os.path.join(self.spices.get_cache_folder(), icon_filename)):
+            if not os.path.exists(icon_path):
                 theme = Gtk.IconTheme.get_default()
                 if theme.has_icon("cs-%ss" % (self.collection_type)):
                     img = theme.load_icon("cs-%ss" % (self.collection_type), h, 0)
             else:
                 try:
-                    img = GdkPixbuf.Pixbuf.new_from_file_at_size(os.path.join(self.spices.get_cache_folder(), icon_filename), w, h)
+                    img = GdkPixbuf.Pixbuf.new_from_file_at_size(icon_path, w, h)
                 except:
                     theme = Gtk.IconTheme.get_default()
                     if theme.has_icon("cs-%ss" % (self.collection_type)):
@@ -1105,7 +1126,7 @@ Please contact the developer.""")
             return
         self.disable_extension(uuid, name, 0)
 
-        thread.start_new_thread(self.spices.uninstall, (uuid, name, schema_filename, self.on_uninstall_finished))
+        self.spices_jobs.push(self.spices.uninstall, (uuid, name, schema_filename, self.on_uninstall_finished), PRIORITY_HIGH)
 
     def on_uninstall_finished(self, uuid):
         self.load_extensions()
@@ -1295,8 +1316,26 @@ Please contact the developer.""")
     def load_extensions(self):
         self.model.clear()
         if not self.themes:
+            if self.xlet_index is None:
+                self.xlet_index = XletIndex(self.collection_type)
+                self.danger_scanner = DangerScanner(self.collection_type)
+            self.indexed_dirs = set()
+
+            # Each load queues its scans in a group of its own, closed once
+            # every xlet was listed
+            if self.scan_jobs:
+                self.scan_jobs.cancel()
+            self.scan_jobs_by_uuid = {}
+            scan_jobs = JobGroup(on_finished=lambda: self.on_bg_work_complete(scan_jobs))
+            self.scan_jobs = scan_jobs
+
             self.load_extensions_in(('%s/.local/share/cinnamon/%ss') % (home, self.collection_type))
             self.load_extensions_in(('/usr/share/cinnamon/%ss') % (self.collection_type))
+            scan_jobs.close()
+            self.xlet_index.prune(self.indexed_dirs)
+            self.xlet_index.save()
+            self.danger_scanner.prune(self.indexed_dirs)
+            GLib.idle_add(self.prioritize_visible_scans)
         else:
             self.load_extensions_in(('%s/.themes') % (home))
             self.load_extensions_in('/usr/share', True)
@@ -1317,12 +1356,14 @@ Please contact the developer.""")
 
                 extension_dir = "%s/%s" % (directory, extension)
                 try:
-                    if not (os.path.exists("%s/metadata.json" % extension_dir)):
-                        continue
-
-                    json_data=open("%s/metadata.json" % extension_dir).read()
-                    setting_type = 0
-                    data = json.loads(json_data)
+                    entry = self.xlet_index.lookup(extension_dir)
+                    if entry is None:
+                        if not (os.path.exists("%s/metadata.json" % extension_dir)):
+                            continue
+                        entry = self.read_extension_dir(extension_dir)
+                    self.indexed_dirs.add(extension_dir)
+
+                    data = entry["metadata"]
                     extension_uuid = data["uuid"]
                     extension_name = translate(data["uuid"], data["name"])
                     extension_description = translate(data["uuid"], data["description"])
@@ -1339,17 +1380,8 @@ Please contact the developer.""")
                     except KeyError: hide_config_button = False
                     except ValueError: hide_config_button = False
 
-                    if "multiversion" in data and data["multiversion"]:
-                        extension_dir = find_extension_subdir(extension_dir)
-
-                    try:
-                        ext_config_app = os.path.join(extension_dir, data["external-configuration-app"])
-                        setting_type = SETTING_TYPE_EXTERNAL
-                    except KeyError: ext_config_app = ""
-                    except ValueError: ext_config_app = ""
-
-                    if os.path.exists("%s/settings-schema.json" % extension_dir):
-                        setting_type = SETTING_TYPE_INTERNAL
+                    ext_config_app = entry["ext_config_app"]
+                    setting_type = entry["setting_type"]
 
                     try: last_edited = data["last-edited"]
                     except KeyError: last_edited = -1
@@ -1360,13 +1392,15 @@ Please contact the developer.""")
                     except ValueError: schema_filename = ""
 
                     if writeable:
-                        try: dangerous = data["dangerous"]
-                        except KeyError:
-                            self.scan_extension_for_danger(extension_dir)
-                            dangerous = False
-                        except ValueError:
-                            self.scan_extension_for_danger(extension_dir)
-                            dangerous = False
+                        dangerous = self.danger_scanner.get_verdict(extension_dir)
+                        # Editing a file deep inside an xlet leaves its directory
+                        # stamp alone, so every load rescans; the scan only
+                        # reads the files whose size or mtime changed
+                        self.scan_extension_for_danger(extension_uuid, extension_dir, entry["extension_dir"])
+                        if dangerous is None:
+                            # Older versions stored the scan result in the metadata
+                            try: dangerous = data["dangerous"]
+                            except KeyError: dangerous = False
                     else:
                         dangerous = False
 
@@ -1376,16 +1410,9 @@ Please contact the developer.""")
                     except KeyError: version_supported = True # Don't check version if not specified.
                     except ValueError: version_supported = True
 
-
-                    if ext_config_app != "" and not os.path.exists(ext_config_app):
-                        ext_config_app = ""
-
                     if extension_max_instances < -1:
                         extension_max_instances = 1
 
-                    if not (self.search_entry.get_text().upper() in (extension_name + extension_description).upper()):
-                        continue
-
                     iter = self.model.insert_before(None, None)
                     found = sum(extension_uuid in x for x in self.enabled_extensions)
 
@@ -1404,9 +1431,9 @@ Please contact the developer.""")
                         theme = Gtk.IconTheme.get_default()
                         if theme.has_icon(extension_icon):
                             img = theme.load_icon(extension_icon, size, 0)
-                    elif os.path.exists("%s/icon.png" % extension_dir):
+                    elif entry["icon_file"]:
                         try:
-                            img = GdkPixbuf.Pixbuf.new_from_file_at_size("%s/icon.png" % extension_dir, size, size)
+                            img = self.xlet_index.get_icon(extension_dir, entry["icon_file"], size)
                         except:
                             img = None
 
@@ -1443,6 +1470,7 @@ Please contact the developer.""")
                     self.model.set_value(iter, 13, setting_type)
                     self.model.set_value(iter, 14, version_supported)
                     self.model.set_value(iter, 15, dangerous)
+                    self.model.set_value(iter, 16, fold_search_text("%s %s %s" % (extension_name, extension_description, extension_uuid)))
 
                 except Exception, detail:
                     print "Failed to load extension %s: %s" % (extension, detail)
@@ -1525,9 +1553,50 @@ Please contact the developer.""")
                     self.model.set_value(iter, 11, icon)
                     self.model.set_value(iter, 13, SETTING_TYPE_NONE)
                     self.model.set_value(iter, 14, True)
+                    self.model.set_value(iter, 16, fold_search_text(theme_name))
                 except Exception, detail:
                     print "Failed to load extension %s: %s" % (theme, detail)
 
+    def read_extension_dir(self, extension_dir):
+        # Reads everything about an xlet that needs disk access and records it in the index
+        metadata_file = "%s/metadata.json" % extension_dir
+        json_data = open(metadata_file).read()
+        data = json.loads(json_data)
+
+        versioned_dir = extension_dir
+        if "multiversion" in data and data["multiversion"]:
+            versioned_dir = find_extension_subdir(extension_dir)
+
+        setting_type = SETTING_TYPE_NONE
+        try:
+            ext_config_app = os.path.join(versioned_dir, data["external-configuration-app"])
+            setting_type = SETTING_TYPE_EXTERNAL
+        except KeyError: ext_config_app = ""
+        except ValueError: ext_config_app = ""
+
+        if os.path.exists("%s/settings-schema.json" % versioned_dir):
+            setting_type = SETTING_TYPE_INTERNAL
+
+        if ext_config_app != "" and not os.path.exists(ext_config_app):
+            ext_config_app = ""
+
+        icon_file = "%s/icon.png" % versioned_dir
+        if not os.path.exists(icon_file):
+            icon_file = ""
+
+        entry = {"metadata": data,
+                 "extension_dir": versioned_dir,
+                 "ext_config_app": ext_config_app,
+                 "setting_type": setting_type,
+                 "icon_file": icon_file}
+
+        stamp_paths = [extension_dir, metadata_file, versioned_dir]
+        if icon_file:
+            stamp_paths.append(icon_file)
+        self.xlet_index.store(extension_dir, entry, stamp_paths)
+
+        return entry
+
     def show_prompt(self, msg):
         dialog = Gtk.MessageDialog(transient_for = None,
                                    destroy_with_parent = True,
@@ -1572,133 +1641,45 @@ Please contact the developer.""")
 
 ################################## Xlet scanning for dangerous elements
 
-    def scan_extension_for_danger(self, directory):
-        if not self.background_work_queue:
-            self.background_work_queue = BGWorkQueue()
-            self.background_work_queue.connect("finished", self.on_bg_work_complete)
-
-        self.background_work_queue.push(self.scan_extension_thread, directory)
-
-    def on_bg_work_complete(self, queue):
-        self.load_extensions()
-
-    def scan_extension_thread(self, directory):
-        dangerous = False
-
-        def scan_item(item):
-            if item.endswith(".js"):
-                f = open(item)
-                contents = f.read()
-                for unsafe_item in UNSAFE_ITEMS:
-                    if unsafe_item in contents:
-                        raise Exception("unsafe")
-                f.close()
-
-        def scan_dir(subdir):
-            for item in os.listdir(subdir):
-                item_path = os.path.join(subdir, item)
-                if os.path.isdir(item_path):
-                    scan_dir(item_path)
-                else:
-                    scan_item(item_path)
-
-        try:
-            scan_dir(directory)
-        except:
-            dangerous = True
-
-        json_path = os.path.join(directory, "metadata.json")
-
-        # This may be a versioned extension, check the parent folder
-        if not os.path.exists(json_path):
-            json_path = os.path.join(directory, "..", "metadata.json")
-
-        file = open(json_path, 'r')
-        raw_meta = file.read()
-        file.close()
-        md = json.loads(raw_meta)
-        md["dangerous"] = dangerous
-
-        raw_meta = json.dumps(md, indent=4)
-        file = open(json_path, 'w+')
-        file.write(raw_meta)
-        file.close()
-
-UNSAFE_ITEMS = ["spawn_sync", "spawn_command_line_sync", "GTop", "get_file_contents_utf8_sync"]
-
-class BGWorkQueue(GObject.GObject):
-    __gsignals__ = {
-        'finished': (GObject.SignalFlags.RUN_LAST, None, ()),
-    }
-
-    MAX_THREADS=5
-
-    def __init__(self):
-        super(BGWorkQueue, self).__init__()
-        self.jobs = []
-        self.thread_ids = []
-        self.lock = thread.allocate_lock()
-        self.idle_id = 0
-        self.start_id = 0
-
-    def push(self, func, data):
-        if self.start_id > 0:
-            GObject.source_remove(self.start_id)
-            self.start_id = 0
-
-        self.jobs.insert(0, (func, data))
-
-        self.start_id = GObject.idle_add(self.check_start_job)
-
-    def check_start_job(self):
-        self.start_id = 0
-        if len(self.jobs) > 0:
-            if len(self.thread_ids) == self.MAX_THREADS:
-                return
-
-            job = self.jobs.pop()
-            handle = thread.start_new_thread(self.thread_function_wrapper, job)
-            self.thread_ids.append(handle)
+    def scan_extension_for_danger(self, uuid, directory, scan_path):
+        # Scans start at low priority, prioritize_visible_scans() bumps the rows on screen
+        self.scan_jobs_by_uuid[uuid] = self.scan_jobs.push(self.danger_scanner.scan, (directory, scan_path), PRIORITY_LOW,
+                                                           lambda dangerous: self.on_extension_scanned(uuid, dangerous))
+
+    def on_destroy(self, widget):
+        # The verdicts found so far are still saved once the running scans stop
+        if self.scan_jobs:
+            self.scan_jobs.cancel()
+            self.scan_jobs = None
+        self.scan_jobs_by_uuid = {}
+
+    def on_bg_work_complete(self, scan_jobs):
+        # A group cancelled by a reload doesn't touch the scans of the next one
+        if scan_jobs is self.scan_jobs:
+            self.scan_jobs = None
+            self.scan_jobs_by_uuid = {}
+        self.danger_scanner.save()
+
+    def prioritize_visible_scans(self):
+        if len(self.scan_jobs_by_uuid) == 0:
+            return False
 
-            self.check_start_job()
+        visible_range = self.treeview.get_visible_range()
+        if visible_range is None:
+            return False
+        start, end = visible_range
 
+        for index in range(start.get_indices()[0], end.get_indices()[0] + 1):
+            uuid = self.modelfilter[index][0]
+            if uuid in self.scan_jobs_by_uuid:
+                job = self.scan_jobs_by_uuid.pop(uuid)
+                self.scan_jobs.queue.set_priority(job, PRIORITY_DEFAULT)
         return False
 
-    def thread_function_wrapper(self, func, data):
-        func(data)
-
-        self.on_thread_complete()
-        thread.exit()
-
-    def on_thread_complete(self):
-        tid = thread.get_ident()
-
-        self.lock.acquire()
-        self.prune_thread(tid)
-
-        if len(self.thread_ids) == 0:
-            self.send_idle_complete()
-
-        self.lock.release()
-
-    def prune_thread(self, tid):
-        try:
-            self.thread_ids.remove(tid)
-        except:
-            pass
-
-        self.check_start_job()
-
-    def _idle_complete_cb(self):
-        self.idle_id = 0
-
-        self.emit("finished")
-
+    def on_extension_scanned(self, uuid, dangerous):
+        self.scan_jobs_by_uuid.pop(uuid, None)
+        for row in self.model:
+            if self.model.get_value(row.iter, 0) == uuid:
+                self.model.set_value(row.iter, 15, dangerous)
+                break
         return False
-
-    def send_idle_complete(self):
-        if self.idle_id > 0:
-            GObject.source_remove(self.idle_id)
-            self.idle_id = 0
-
-        self.idle_id = GObject.idle_add(self._idle_complete_cb)
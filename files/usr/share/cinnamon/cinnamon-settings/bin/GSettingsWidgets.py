@@ -1,5 +1,6 @@
 from gi.repository import Gio, GLib
 from SettingsWidgets import *
+import ExecutableIndex
 
 # Monkey patch Gio.Settings object
 def __setitem__(self, key, value):
@@ -71,12 +72,7 @@ class BinFileMonitor(GObject.GObject):
 
         self.changed_id = 0
 
-        env = GLib.getenv("PATH")
-
-        if env == None:
-            env = "/bin:/usr/bin:."
-
-        self.paths = env.split(":")
+        self.paths = ExecutableIndex.get_path_dirs()
 
         self.monitors = []
 
@@ -92,6 +88,12 @@ class BinFileMonitor(GObject.GObject):
         return False
 
     def queue_emit_changed(self, file, other, event_type, data=None):
+        # Keep the executable index current, only the names that changed are touched
+        index = ExecutableIndex.get_default()
+        for changed_file in (file, other):
+            if changed_file is not None and changed_file.get_path() is not None:
+                index.file_changed(changed_file.get_path())
+
         if self.changed_id > 0:
             GObject.source_remove(self.changed_id)
             self.changed_id = 0
@@ -154,8 +156,9 @@ class DependencyCheckInstallButton(Gtk.Box):
 
         success = True
 
+        index = ExecutableIndex.get_default()
         for program in self.binfiles:
-            if not GLib.find_program_in_path(program):
+            if index.find(program) is None:
                 success = False
                 break
 
@@ -0,0 +1,265 @@
+#!/usr/bin/python2
+
+import os
+import json
+import base64
+import socket
+import httplib
+import urlparse
+import threading
+
+import proxygsettings
+
+BLOCK_SIZE = 1024 * 8
+TIMEOUT = 30
+MAX_REDIRECTS = 5
+# Idle keep-alive connections kept around per host
+MAX_IDLE_CONNECTIONS = 8
+
+class FetchError(Exception):
+    pass
+
+class FetchAborted(Exception):
+    pass
+
+_default_proxies = None
+
+def get_default_proxies():
+    global _default_proxies
+    if _default_proxies is None:
+        try:
+            _default_proxies = proxygsettings.get_proxy_settings()
+        except Exception, detail:
+            print "Could not read the proxy settings: %s" % detail
+            _default_proxies = {}
+    return _default_proxies
+
+class HttpFetcher:
+    """ Downloads files over a pool of keep-alive connections.
+
+    For files that are already on disk the ETag and Last-Modified headers of
+    the previous download are sent back, and the body is skipped when the
+    server answers 304 Not Modified. fetch() is safe to call from several
+    threads at once, each connection is only used by one request at a time.
+    """
+
+    def __init__(self, validators_file=None, proxies=None):
+        self.validators_file = validators_file
+        self.proxies = proxies if proxies is not None else get_default_proxies()
+        self.lock = threading.Lock()
+        self.idle_connections = {}
+        self.validators = {}
+        self.dirty = False
+
+        if validators_file is not None:
+            try:
+                with open(validators_file, "r") as f:
+                    self.validators = json.load(f)
+            except (IOError, ValueError):
+                pass
+
+    def fetch(self, url, path, progress=None, should_abort=None, conditional=True):
+        """ Saves url to path, returns False if the copy at path was still current.
+
+        progress(count, block_size, total_size) is called from the fetching
+        thread after each block, should_abort() is polled between blocks.
+        """
+        headers = {}
+        validators = None
+        if conditional and os.path.exists(path):
+            with self.lock:
+                validators = self.validators.get(url)
+        if validators is not None:
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last-modified" in validators:
+                headers["If-Modified-Since"] = validators["last-modified"]
+
+        location = url
+        for i in range(MAX_REDIRECTS + 1):
+            key, conn, response = self.request(location, headers)
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = urlparse.urljoin(location, response.getheader("location", ""))
+                self.release(key, conn, response)
+                continue
+            elif response.status == 304:
+                self.release(key, conn, response)
+                return False
+            elif response.status != 200:
+                self.release(key, conn, response)
+                raise FetchError("%s: HTTP %d %s" % (location, response.status, response.reason))
+            break
+        else:
+            self.release(key, conn, response)
+            raise FetchError("%s: too many redirects" % url)
+
+        try:
+            total_size = int(response.getheader("content-length", -1))
+        except ValueError:
+            total_size = -1
+
+        tmp_path = path + ".part"
+        try:
+            with open(tmp_path, "wb") as f:
+                count = 0
+                received = 0
+                while True:
+                    if should_abort is not None and should_abort():
+                        raise FetchAborted()
+                    data = response.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    received += len(data)
+                    count += 1
+                    if progress is not None:
+                        progress(count, BLOCK_SIZE, total_size)
+            if total_size >= 0 and received != total_size:
+                raise IOError("received %d of %d bytes" % (received, total_size))
+            os.rename(tmp_path, path)
+        except (FetchAborted, IOError, OSError, httplib.HTTPException, socket.error), detail:
+            conn.close()
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            if isinstance(detail, FetchAborted):
+                raise
+            raise FetchError("%s: %s" % (url, detail))
+
+        self.release(key, conn, response)
+
+        if conditional:
+            validators = {}
+            if response.getheader("etag"):
+                validators["etag"] = response.getheader("etag")
+            if response.getheader("last-modified"):
+                validators["last-modified"] = response.getheader("last-modified")
+            with self.lock:
+                self.validators[url] = validators
+                self.dirty = True
+
+        return True
+
+    def has_validators(self, url):
+        with self.lock:
+            return url in self.validators
+
+    def forget(self, url):
+        with self.lock:
+            if self.validators.pop(url, None) is not None:
+                self.dirty = True
+
+    def request(self, url, headers):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += "?" + query
+        host, port = netloc, None
+        if ":" in netloc:
+            host, port = netloc.rsplit(":", 1)
+            port = int(port)
+
+        # A connection that sat idle may have been dropped by the server, so
+        # a failure on a reused one is retried once on a fresh connection
+        for attempt in range(2):
+            key, conn, request_path, request_headers = self.get_connection(scheme, host, port, path, url, reuse=(attempt == 0))
+            request_headers.update(headers)
+            try:
+                conn.request("GET", request_path, headers=request_headers)
+                return key, conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error), detail:
+                conn.close()
+                if not conn.reused:
+                    raise FetchError("%s: %s" % (url, detail))
+        raise FetchError("%s: %s" % (url, detail))
+
+    def get_connection(self, scheme, host, port, path, url, reuse=True):
+        if scheme == "https":
+            default_port = httplib.HTTPS_PORT
+            connection_class = httplib.HTTPSConnection
+        elif scheme == "http":
+            default_port = httplib.HTTP_PORT
+            connection_class = httplib.HTTPConnection
+        else:
+            raise FetchError("%s: unsupported scheme" % url)
+        port = port or default_port
+
+        headers = {}
+        proxy = self.proxies.get(scheme)
+        if proxy:
+            if "://" not in proxy:
+                proxy = "http://" + proxy
+            proxy = urlparse.urlsplit(proxy)
+            proxy_headers = {}
+            if proxy.username is not None:
+                credentials = "%s:%s" % (proxy.username, proxy.password or "")
+                proxy_headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials)
+            key = (scheme, host, port, proxy.hostname, proxy.port)
+        else:
+            key = (scheme, host, port)
+
+        with self.lock:
+            idle = self.idle_connections.get(key)
+            if reuse and idle:
+                conn = idle.pop()
+                conn.reused = True
+            else:
+                conn = None
+
+        if conn is None:
+            if not proxy:
+                conn = connection_class(host, port, timeout=TIMEOUT)
+            elif scheme == "https":
+                conn = connection_class(proxy.hostname, proxy.port or httplib.HTTP_PORT, timeout=TIMEOUT)
+                conn.set_tunnel(host, port, proxy_headers)
+            else:
+                conn = connection_class(proxy.hostname, proxy.port or httplib.HTTP_PORT, timeout=TIMEOUT)
+            conn.reused = False
+
+        if proxy and scheme == "http":
+            # Plain http goes through the proxy with the full url as the path
+            headers.update(proxy_headers)
+            return key, conn, url, headers
+        return key, conn, path, headers
+
+    def release(self, key, conn, response):
+        # The body has to be drained before the connection can be reused
+        try:
+            response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            return
+
+        if response.will_close:
+            conn.close()
+            return
+
+        with self.lock:
+            idle = self.idle_connections.setdefault(key, [])
+            if len(idle) < MAX_IDLE_CONNECTIONS:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle_connections.values():
+                for conn in idle:
+                    conn.close()
+            self.idle_connections = {}
+
+    def save(self):
+        if self.validators_file is None:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                tmp_file = self.validators_file + ".tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump(self.validators, f)
+                os.rename(tmp_file, self.validators_file)
+                self.dirty = False
+            except (IOError, OSError) as e:
+                print "Failed to save %s: %s" % (self.validators_file, e)
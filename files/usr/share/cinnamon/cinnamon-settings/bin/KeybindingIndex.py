@@ -0,0 +1,179 @@
+#!/usr/bin/python2
+
+import re
+import sys
+import ConfigParser
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gio, GLib, Gtk, Gdk
+
+CUSTOM_KEYS_PARENT_SCHEMA = "org.cinnamon.desktop.keybindings"
+CUSTOM_KEYS_BASENAME = "/org/cinnamon/desktop/keybindings/custom-keybindings"
+CUSTOM_KEYS_SCHEMA = "org.cinnamon.desktop.keybindings.custom-keybinding"
+
+KEYBINDING_SCHEMAS = ["org.cinnamon.desktop.keybindings.wm",
+                      "org.cinnamon.desktop.keybindings.media-keys",
+                      "org.cinnamon.desktop.keybindings"]
+
+MODIFIER_ALIASES = {"primary": "control", "ctrl": "control", "ctl": "control",
+                    "mod4": "super", "alt": "mod1"}
+
+def normalize_accelerator(accel):
+    # Returns a key equal for every way of writing the same accelerator, or
+    # None for an empty one
+    if accel is None or accel.strip() == "":
+        return None
+
+    keyval, mods = Gtk.accelerator_parse(accel)
+    if keyval != 0:
+        if mods & Gdk.ModifierType.MOD4_MASK:
+            mods = (mods & ~Gdk.ModifierType.MOD4_MASK) | Gdk.ModifierType.SUPER_MASK
+        return (Gdk.keyval_to_lower(keyval), int(mods))
+
+    # Keys only the window manager knows about, like Above_Tab, are compared
+    # by their sorted modifier names and lowercased key name
+    modifiers = [m.lower() for m in re.findall(r"<([^>]+)>", accel)]
+    modifiers = sorted(set(MODIFIER_ALIASES.get(m, m) for m in modifiers))
+    key = re.sub(r"<[^>]+>", "", accel).strip().lower()
+    return ("".join("<%s>" % m for m in modifiers) + key,)
+
+class KeybindingIndex:
+    """ Which bindings use which accelerator.
+
+    Bindings are anything with a label and a list of accelerator strings in
+    entries. They are indexed by the parsed keyval and modifiers of each
+    accelerator, so <Primary>, <Ctrl> and <Control>, modifier order and key
+    name case make no difference, and finding the users of an accelerator is
+    a single lookup. update() must be called after the entries of a binding
+    change.
+    """
+
+    def __init__(self):
+        self.owners = {}
+        self.binding_keys = {}
+
+    def add(self, binding):
+        keys = set()
+        for entry in binding.entries:
+            key = normalize_accelerator(entry)
+            if key is not None:
+                keys.add(key)
+        for key in keys:
+            self.owners.setdefault(key, []).append(binding)
+        self.binding_keys[id(binding)] = keys
+
+    def remove(self, binding):
+        for key in self.binding_keys.pop(id(binding), ()):
+            owners = self.owners[key]
+            owners.remove(binding)
+            if len(owners) == 0:
+                del self.owners[key]
+
+    def update(self, binding):
+        self.remove(binding)
+        self.add(binding)
+
+    def lookup(self, accel):
+        # Returns the bindings using accel
+        key = normalize_accelerator(accel)
+        if key is None:
+            return []
+        return list(self.owners.get(key, []))
+
+    def get_entry_indices(self, binding, accel):
+        # Returns the positions of accel in the entries of binding
+        key = normalize_accelerator(accel)
+        return [i for i, entry in enumerate(binding.entries) if key is not None and normalize_accelerator(entry) == key]
+
+    def get_conflicts(self):
+        # Returns (accelerator, bindings) for every accelerator used by more
+        # than one binding, as written by the first of them
+        conflicts = []
+        for key, owners in self.owners.items():
+            if len(owners) > 1:
+                accel = None
+                for entry in owners[0].entries:
+                    if normalize_accelerator(entry) == key:
+                        accel = entry
+                        break
+                conflicts.append((accel, owners))
+        conflicts.sort(key=lambda conflict: conflict[0])
+        return conflicts
+
+class ProfileBinding:
+    def __init__(self, label, entries):
+        self.label = label
+        self.entries = entries
+
+def load_profile(filename):
+    # Reads a dconf keyfile, as written by "dconf dump /" or found in
+    # /etc/dconf/db/*.d, into {path: {key: value}}
+    parser = ConfigParser.RawConfigParser()
+    parser.optionxform = str
+    parser.read(filename)
+    profile = {}
+    for section in parser.sections():
+        path = "/%s/" % section.strip("/") if section.strip("/") else "/"
+        profile[path] = dict((key, GLib.Variant.parse(None, value, None, None).unpack()) for key, value in parser.items(section))
+    return profile
+
+def get_profile_value(profile, path, key):
+    # Sections may be relative to the path that was dumped, the most specific
+    # one wins
+    for section_path in sorted(profile.keys(), key=len, reverse=True):
+        if path.endswith(section_path) and key in profile[section_path]:
+            return profile[section_path][key]
+    return None
+
+def index_profile(profile=None):
+    # Indexes the keybindings of the current session, or the defaults with
+    # profile applied on top of them
+    index = KeybindingIndex()
+
+    for schema in KEYBINDING_SCHEMAS:
+        settings = Gio.Settings.new(schema)
+        path = "/" + schema.replace(".", "/") + "/"
+        for key in settings.list_keys():
+            if schema == CUSTOM_KEYS_PARENT_SCHEMA and key == "custom-list":
+                continue
+            if settings.get_value(key).get_type_string() != "as":
+                continue
+            if profile is None:
+                entries = settings.get_strv(key)
+            else:
+                entries = get_profile_value(profile, path, key)
+                if entries is None:
+                    entries = settings.get_default_value(key).unpack()
+            index.add(ProfileBinding("%s %s" % (schema, key), entries))
+
+    if profile is None:
+        custom_list = Gio.Settings.new(CUSTOM_KEYS_PARENT_SCHEMA).get_strv("custom-list")
+        for entry in custom_list:
+            settings = Gio.Settings.new_with_path(CUSTOM_KEYS_SCHEMA, "%s/%s/" % (CUSTOM_KEYS_BASENAME, entry))
+            index.add(ProfileBinding(settings.get_string("name"), settings.get_strv("binding")))
+    else:
+        custom_list = get_profile_value(profile, "/" + CUSTOM_KEYS_PARENT_SCHEMA.replace(".", "/") + "/", "custom-list") or []
+        for entry in custom_list:
+            path = "%s/%s/" % (CUSTOM_KEYS_BASENAME, entry)
+            name = get_profile_value(profile, path, "name") or entry
+            index.add(ProfileBinding(name, get_profile_value(profile, path, "binding") or []))
+
+    return index
+
+if __name__ == "__main__":
+    # Lists the accelerators bound more than once, in the current session or
+    # in a dconf keyfile profile. Exits with 1 if there are any.
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] in ("-h", "--help")):
+        print "Usage: %s [dconf-keyfile]" % sys.argv[0]
+        sys.exit(2)
+
+    if len(sys.argv) == 2:
+        index = index_profile(load_profile(sys.argv[1]))
+    else:
+        index = index_profile()
+
+    conflicts = index.get_conflicts()
+    for accel, bindings in conflicts:
+        print "%s: %s" % (accel, ", ".join(binding.label for binding in bindings))
+    sys.exit(1 if len(conflicts) > 0 else 0)
@@ -0,0 +1,176 @@
+#!/usr/bin/python2
+
+import os
+import json
+import gettext
+import threading
+from xml.etree import ElementTree
+
+from gi.repository import GLib
+
+# Bump this whenever the layout of the catalog changes
+CATALOG_VERSION = 1
+
+CATALOG_FILE = os.path.join(GLib.get_user_cache_dir(), "cs_screensavers", "catalog.json")
+
+XSCREENSAVER_PATH = "/usr/share/xscreensaver/config/"
+
+def get_screensaver_dirs():
+    return [os.path.expanduser("~/.local/share/cinnamon-screensaver/screensavers")] + \
+           [os.path.join(x, "cinnamon-screensaver/screensavers/") for x in GLib.get_system_data_dirs()]
+
+def get_stamp(path, depth):
+    # The mtimes of path and of the directories and metadata below it, which
+    # change whenever a screensaver is added, removed or updated
+    try:
+        stamp = [path, os.path.getmtime(path)]
+    except OSError:
+        return None
+    if depth > 0 and os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            child = os.path.join(path, name)
+            if name == "metadata.json" or os.path.isdir(child):
+                stamp.append(get_stamp(child, depth - 1))
+    return stamp
+
+class ScreensaverCatalog:
+    """ Every screensaver that can be picked, as found on disk last time.
+
+    The screensaver directories and the xscreensaver hacks are kept per
+    directory, along with the mtimes they were read at, and only read again
+    when those change or the language does; hack labels are translated when
+    they are read. Loading happens in a thread, each directory is handed to
+    the main loop as soon as it is available.
+    """
+
+    def __init__(self, catalog_file=CATALOG_FILE):
+        self.catalog_file = catalog_file
+        self.language = ":".join(GLib.get_language_names())
+
+    def load(self, callback):
+        # Calls callback(entries, executables) in the main thread for each
+        # directory, in the order they are listed in
+        thread = threading.Thread(target=self.load_thread, args=(callback,))
+        thread.daemon = True
+        thread.start()
+
+    def load_thread(self, callback):
+        sections = {}
+        try:
+            with open(self.catalog_file, "r") as f:
+                catalog = json.load(f)
+            if catalog["version"] == CATALOG_VERSION and catalog["language"] == self.language:
+                sections = catalog["sections"]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+        new_sections = {}
+        executables = {}
+        for directory in get_screensaver_dirs():
+            stamp = get_stamp(directory, 3)
+            if stamp is None:
+                continue
+            section = sections.get(directory)
+            if section is None or section["stamp"] != stamp:
+                entries, found_executables = self.read_screensavers(directory)
+                section = {"stamp": stamp, "entries": entries, "executables": found_executables}
+            new_sections[directory] = section
+            executables.update(section["executables"])
+            GLib.idle_add(callback, section["entries"], section["executables"])
+
+        if "xscreensaver" in executables:
+            stamp = get_stamp(XSCREENSAVER_PATH, 0)
+            section = sections.get(XSCREENSAVER_PATH)
+            if stamp is not None and (section is None or section["stamp"] != stamp):
+                section = {"stamp": stamp, "entries": self.read_xscreensavers(), "executables": {}}
+            if stamp is not None:
+                new_sections[XSCREENSAVER_PATH] = section
+                GLib.idle_add(callback, section["entries"], {})
+
+        if new_sections != sections:
+            self.save(new_sections)
+
+    def save(self, sections):
+        try:
+            directory = os.path.dirname(self.catalog_file)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            tmp_file = self.catalog_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"version": CATALOG_VERSION, "language": self.language, "sections": sections}, f)
+            os.rename(tmp_file, self.catalog_file)
+        except (IOError, OSError) as e:
+            print "Failed to save screensaver catalog %s: %s" % (self.catalog_file, e)
+
+    def read_screensavers(self, directory):
+        entries = []
+        executables = {}
+
+        for path in [os.path.join(directory, x) for x in os.listdir(directory)]:
+            if not os.path.isdir(path):
+                continue
+
+            # Recurse inside if it is webkit
+            if os.path.basename(path.rstrip('/')) == "webkit@cinnamon.org":
+                for theme in [os.path.join(path, x) for x in os.listdir(path)]:
+                    if os.path.basename(theme) == 'main':
+                        executables["webkit"] = theme
+                        continue
+
+                    if not os.path.isdir(theme):
+                        continue
+
+                    entry = self.read_metadata(theme, path, "webkit")
+                    if entry is not None:
+                        entries.append(entry)
+                continue
+
+            if os.path.basename(path.rstrip('/')) == "xscreensaver@cinnamon.org":
+                if os.path.exists(os.path.join(path, 'main')):
+                    executables["xscreensaver"] = os.path.join(path, 'main')
+                continue
+
+            entry = self.read_metadata(path, path, "standalone")
+            if entry is not None:
+                entries.append(entry)
+
+        return entries, executables
+
+    def read_metadata(self, path, directory, ss_type):
+        try:
+            with open(os.path.join(path, "metadata.json"), 'r') as f:
+                data = json.load(f)
+
+            uuid = data["uuid"]
+            assert uuid == os.path.basename(path.rstrip('/'))
+
+            return {"uuid": uuid, "name": data["name"], "description": data.get("description"),
+                    "path": directory, "ss_type": ss_type}
+        except:
+            print "Unable to parse screensaver information at %s" % path
+            return None
+
+    def read_xscreensavers(self):
+        entries = []
+        translation = gettext.translation("xscreensaver", "/usr/share/locale", fallback=True)
+
+        try:
+            for item in sorted(os.listdir(XSCREENSAVER_PATH)):
+                if not item.endswith(".xml"):
+                    continue
+
+                path = os.path.join(XSCREENSAVER_PATH, item)
+                try:
+                    root = ElementTree.parse(path).getroot()
+
+                    label = translation.gettext(root.attrib["_label"])
+                    description = translation.gettext(root.find("_description").text.strip())
+                    entries.append({"uuid": root.attrib["name"], "name": label, "description": description,
+                                    "path": XSCREENSAVER_PATH, "ss_type": "xscreensaver"})
+                except Exception, detail:
+                    print "Unable to parse xscreensaver information at %s: %s" % (path, detail)
+        except Exception, detail:
+            print "Unable to parse xscreensaver hacks: %s" % detail
+
+        entries.sort(key=lambda entry: entry["name"])
+        return entries
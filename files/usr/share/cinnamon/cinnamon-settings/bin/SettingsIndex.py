@@ -0,0 +1,84 @@
+#!/usr/bin/python2
+
+import os
+import json
+import gettext
+
+from gi.repository import GLib
+
+import SettingsWidgets
+
+# Generated by running ./generate_cs_settings_index.py from the top of the
+# source tree, the result is committed; run it again after changing a module
+INDEX_FILE = "/usr/share/cinnamon/cinnamon-settings/data/settings-index.json"
+INDEX_VERSION = 1
+
+XLET_DIRS = ["/usr/share/cinnamon", os.path.join(GLib.get_user_data_dir(), "cinnamon")]
+
+class SettingsEntry:
+    def __init__(self, module, page, label, schema=None, key=None, uuid=None):
+        self.module = module
+        self.page = page
+        self.label = label
+        self.schema = schema
+        self.key = key
+        self.uuid = uuid
+        self.search_key = SettingsWidgets.fold_search_text(label)
+
+class SettingsIndex:
+    """ The individual settings of every module, so a search can find them.
+
+    The index is generated from the module sources, so nothing is imported or
+    built to search it. It is only read on the first search, when the labels
+    are translated and folded once; after that a query is a substring test
+    per setting.
+    """
+
+    def __init__(self, index_file=INDEX_FILE):
+        self.index_file = index_file
+        self.entries = None
+
+    def load(self):
+        self.entries = []
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+            if index["version"] != INDEX_VERSION:
+                return
+            settings = index["settings"]
+            xlets = index["xlets"]
+        except (IOError, ValueError, KeyError, TypeError), detail:
+            print "Could not read the settings index: %s" % detail
+            return
+
+        for module, page, label, schema, key in settings:
+            self.entries.append(SettingsEntry(str(module), page and str(page), _(label.encode("utf-8")), schema, key))
+
+        for collection, uuid, label, key in xlets:
+            if not self.is_xlet_installed(collection, uuid):
+                continue
+            label = label.encode("utf-8")
+            translated = gettext.dgettext(uuid.encode("utf-8"), label)
+            if translated == label:
+                translated = _(label)
+            self.entries.append(SettingsEntry("%ss" % collection, None, translated, key=key, uuid=str(uuid)))
+
+    def is_xlet_installed(self, collection, uuid):
+        for path in XLET_DIRS:
+            if os.path.isdir(os.path.join(path, "%ss" % collection, uuid)):
+                return True
+        return False
+
+    def search(self, text):
+        # Returns the first matching setting of each module, by module name.
+        # text must already be folded.
+        if self.entries is None:
+            self.load()
+
+        matches = {}
+        if text == "":
+            return matches
+        for entry in self.entries:
+            if entry.module not in matches and text in entry.search_key:
+                matches[entry.module] = entry
+        return matches
@@ -4,6 +4,7 @@ import math
 import os
 import subprocess
 import traceback
+import unicodedata
 
 import dbus
 import gi
@@ -14,6 +15,7 @@ from gi.repository import Gio, Gtk, GObject, Gdk, GLib, GdkPixbuf, CDesktopEnums
 
 from ChooserButtonWidgets import *
 from KeybindingWidgets import ButtonKeybinding
+import ExecutableIndex
 
 settings_objects = {}
 
@@ -207,12 +209,7 @@ class SAModule:
         name = name.replace("gksu ", "")
         name = name.split()[0]
 
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
-            exe_file = os.path.join(path, name)
-            if os.path.isfile(exe_file) and os.access(exe_file, os.X_OK):
-                return True
-        return False
+        return ExecutableIndex.get_default().find(name) is not None
 
 def walk_directories(dirs, filter_func, return_directories=False):
     # If return_directories is False: returns a list of valid subdir names
@@ -232,6 +229,13 @@ def walk_directories(dirs, filter_func, return_directories=False):
         #logging.critical("Error parsing directories", exc_info=True)
     return valid
 
+def fold_search_text(text):
+    # Lowercases and strips accents so that search keys compare loosely, returns utf-8
+    if not isinstance(text, unicode):
+        text = unicode(text, "utf-8", "replace")
+    text = unicodedata.normalize("NFD", text.lower())
+    return u"".join(c for c in text if not unicodedata.combining(c)).encode("utf-8")
+
 def rec_mkdir(path):
     if os.path.exists(path):
         return
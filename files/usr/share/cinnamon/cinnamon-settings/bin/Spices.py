@@ -7,15 +7,17 @@ try:
     import os
     import sys
     import time
-    import urllib2
     import zipfile
     import string
     import shutil
     import cgi
     import subprocess
-    import thread
+    import Queue
     from time import sleep
     from PIL import Image
+    from WorkQueue import JobGroup, PRIORITY_DEFAULT, ui_thread_do
+    from HttpFetcher import HttpFetcher, FetchError, FetchAborted
+    from SpicesCatalog import SpicesCatalog, CATALOG_FILE
 except Exception, detail:
     print detail
     sys.exit(1)
@@ -29,7 +31,8 @@ home = os.path.expanduser("~")
 locale_inst = '%s/.local/share/locale' % home
 settings_dir = '%s/.cinnamon/configs/' % home
 
-URL_SPICES_HOME = "http://cinnamon-spices.linuxmint.com"
+# CINNAMON_SPICES_URL points the Spices browser at another server, e.g. a local mirror
+URL_SPICES_HOME = os.environ.get("CINNAMON_SPICES_URL", "http://cinnamon-spices.linuxmint.com").rstrip("/")
 URL_SPICES_APPLET_LIST = URL_SPICES_HOME + "/json/applets.json"
 URL_SPICES_THEME_LIST = URL_SPICES_HOME + "/json/themes.json"
 URL_SPICES_DESKLET_LIST = URL_SPICES_HOME + "/json/desklets.json"
@@ -39,8 +42,8 @@ ABORT_NONE = 0
 ABORT_ERROR = 1
 ABORT_USER = 2
 
-def ui_thread_do(callback, *args):
-    GLib.idle_add (callback, *args, priority=GLib.PRIORITY_DEFAULT)
+# Remembers the ETag and Last-Modified headers of the files in the cache folder
+VALIDATORS_FILE = "validators.json"
 
 def removeEmptyFolders(path):
     if not os.path.isdir(path):
@@ -60,50 +63,18 @@ def removeEmptyFolders(path):
         print "Removing empty folder:", path
         os.rmdir(path)
 
-class ThreadedDownloader:
-    MAX_THREADS = 10
-
-    def __init__(self):
-        self.jobs = []
-        self.thread_ids = []
-
-    def get_n_jobs(self):
-        return len(self.jobs)
-
-    def busy(self):
-        return len(self.jobs) > 0 or len(self.thread_ids) > 0
-
-    def push(self, job):
-        self.jobs.insert(0, job)
-
-        self.check_start_job()
-
-    def check_start_job(self):
-        if len(self.jobs) > 0:
-            if len(self.thread_ids) == self.MAX_THREADS:
-                return
-
-            func, payload = self.jobs.pop()
-            handle = thread.start_new_thread(func, payload)
-            self.thread_ids.append(handle)
-
-            self.check_start_job()
-
-    def prune_thread(self, tid):
-        try:
-            self.thread_ids.remove(tid)
-        except:
-            pass
-
-        self.check_start_job()
-
 class Spice_Harvester:
     def __init__(self, collection_type, window):
         self.collection_type = collection_type
         self.cache_folder = self.get_cache_folder()
         self.install_folder = self.get_install_folder()
         self.index_cache = {}
-        self.download_manager = ThreadedDownloader()
+        self.download_group = None
+        self.install_group = None
+        self.progress_group = None
+        self.fetcher = HttpFetcher(os.path.join(self.cache_folder, VALIDATORS_FILE))
+        self.catalog = SpicesCatalog(self.cache_folder)
+        self.changed_uuids = []
         self.error = None
         self.themes = collection_type == "theme"
 
@@ -261,8 +232,6 @@ class Spice_Harvester:
             self.refresh_cache_done_callback = onDone
             self.refresh_cache()
 
-        thread.exit()
-
     def ui_refreshing_index(self):
         self.progresslabel.set_text(_("Refreshing index..."))
         self.progress_window.show()
@@ -273,8 +242,8 @@ class Spice_Harvester:
         download_url = self.get_index_url()
 
         filename = os.path.join(self.cache_folder, "index.json")
-        f = open(filename, 'w')
-        self.download(f, filename, download_url)
+        self.download(filename, download_url)
+        self.fetcher.save()
 
         self.load_cache()
         # print "Loaded index, now we know about %d spices." % len(self.index_cache)
@@ -298,53 +267,69 @@ class Spice_Harvester:
             except:
                 pass
             self.errorMessage(_("Something went wrong with the spices download.  Please try refreshing the list again."), str(detail))
+            return
 
-    def load_assets(self):
-        needs_refresh = 0
-        self.used_thumbs = []
-
-        uuids = self.index_cache.keys()
-
-        for uuid in uuids:
-            if not self.themes:
-                icon_basename = os.path.basename(self.index_cache[uuid]['icon'])
-                icon_path = os.path.join(self.cache_folder, icon_basename)
-                self.used_thumbs.append(icon_basename)
-            else:
-                icon_basename = self.sanitize_thumb(os.path.basename(self.index_cache[uuid]['screenshot']))
-                icon_path = os.path.join(self.cache_folder, icon_basename)
-                self.used_thumbs.append(icon_basename)
+        # Only the uuids that are new or changed since the last index need any
+        # work. They stay pending in the catalog until their thumbnail was revalidated.
+        self.changed_uuids = self.catalog.update(self.index_cache, self.get_derived_fields)
+        self.catalog.save()
 
-            self.index_cache[uuid]['icon_filename'] = icon_basename
-            self.index_cache[uuid]['icon_path'] = icon_path
+    def get_derived_fields(self, uuid, data):
+        if not self.themes:
+            icon_filename = os.path.basename(data['icon'])
+            icon_url = URL_SPICES_HOME + data['icon']
+        else:
+            icon_filename = self.sanitize_thumb(os.path.basename(data['screenshot']))
+            icon_url = URL_SPICES_HOME + "/uploads/themes/thumbs/" + icon_filename
 
-            if not os.path.isfile(icon_path) or self.is_bad_image(icon_path):
-                needs_refresh += 1
+        return {'icon_filename': icon_filename,
+                'icon_path': os.path.join(self.cache_folder, icon_filename),
+                'icon_url': icon_url}
 
-        self.download_total_files = needs_refresh
+    def load_assets(self):
+        downloads = []
+        self.used_thumbs = set()
+        changed = set(self.changed_uuids)
+
+        for uuid, data in self.index_cache.items():
+            icon_path = data['icon_path']
+            download_url = data['icon_url']
+            self.used_thumbs.add(data['icon_filename'])
+
+            # The thumbnails of changed entries are revalidated, the server
+            # only sends them again if they changed too
+            if not self.is_thumb_ok(icon_path):
+                self.fetcher.forget(download_url)
+                downloads.append((uuid, icon_path, download_url))
+            elif uuid in changed and self.fetcher.has_validators(download_url):
+                downloads.append((uuid, icon_path, download_url))
+            elif uuid in changed:
+                self.catalog.set_revalidated(uuid)
+
+        self.download_total_files = len(downloads)
         self.download_current_file = 0
 
-        need_to_download = False
+        self.download_group = JobGroup(on_finished=self.load_assets_done)
+        self.progress_group = self.download_group
 
-        for uuid in uuids:
+        for uuid, icon_path, download_url in downloads:
             if self.abort_download > ABORT_NONE:
-                return
-
-            icon_path = self.index_cache[uuid]['icon_path']
-            if not os.path.isfile(icon_path) or self.is_bad_image(icon_path):
-                need_to_download = True
-                #self.progress_bar_pulse()
-                self.download_current_file += 1
-                f = open(icon_path, 'w')
-                download_url = ""
-                if not self.themes:
-                    download_url = URL_SPICES_HOME + self.index_cache[uuid]['icon']
-                else:
-                    download_url = URL_SPICES_HOME + "/uploads/themes/thumbs/" + self.index_cache[uuid]['icon_filename']
-                self.download_manager.push((self.load_assets_thread, (f, icon_path, download_url)))
-                # thread.start_new_thread(self.load_assets_thread, (f, icon_path, download_url))
-        if not need_to_download:
-            self.load_assets_done()
+                break
+
+            self.download_current_file += 1
+            self.download_group.push(self.load_assets_thread, (uuid, icon_path, download_url), PRIORITY_DEFAULT)
+
+        # load_assets_done runs once the last download is done or cancelled
+        self.download_group.close()
+
+    def is_thumb_ok(self, path):
+        # Only decodes thumbnails that were not checked before or changed since
+        if self.catalog.is_thumb_checked(path):
+            return True
+        if not os.path.isfile(path) or self.is_bad_image(path):
+            return False
+        self.catalog.set_thumb_checked(path)
+        return True
 
     def is_bad_image(self, path):
         try:
@@ -353,23 +338,18 @@ class Spice_Harvester:
             return True
         return False
 
-    def load_assets_thread(self, f, icon_path, url):
-        valid = True
-
-        self.download(f, icon_path, url)
-
-        self.load_assets_done()
-        thread.exit()
+    def load_assets_thread(self, uuid, icon_path, url):
+        # An aborted or failed download raises, leaving uuid pending for the next refresh
+        self.download(icon_path, url)
+        self.is_thumb_ok(icon_path)
+        self.catalog.set_revalidated(uuid)
 
     def load_assets_done(self):
-        self.download_manager.prune_thread(thread.get_ident())
-        if self.download_manager.busy():
-            return
         # Cleanup obsolete thumbs
         trash = []
         flist = os.listdir(self.cache_folder)
         for f in flist:
-            if f not in self.used_thumbs and f != "index.json":
+            if f not in self.used_thumbs and f not in ("index.json", VALIDATORS_FILE, CATALOG_FILE):
                 trash.append(f)
         for t in trash:
             try:
@@ -377,6 +357,10 @@ class Spice_Harvester:
             except:
                 pass
 
+        self.catalog.prune_thumbs(self.used_thumbs)
+        self.catalog.save()
+        self.fetcher.save()
+
         ui_thread_do(self.progress_window.hide)
         ui_thread_do(self.refresh_cache_done_callback, self.index_cache)
         self.download_total_files = 0
@@ -386,19 +370,86 @@ class Spice_Harvester:
         return basename.replace("jpg", "png").replace("JPG", "png").replace("PNG", "png")
 
     def install_all(self, install_list=[], onFinished=None):
+        # The downloads run in parallel on the shared work queue, each spice is
+        # installed from the staging directory as soon as its download is done
         need_restart = []
-        success = False
-        for uuid, is_update, is_active in install_list:
-            success = self.install(uuid, is_update, is_active)
+        rec_mkdir(self.install_folder)
+        staging = tempfile.mkdtemp(prefix=".cinnamon-settings-", dir=os.path.dirname(os.path.normpath(self.install_folder)))
+        downloaded = Queue.Queue()
+
+        # The installs have their own group, so an abort or a refresh running
+        # at the same time doesn't mix up their counts. Once the group is
+        # closed and done, cancelled or not, None is queued after the last
+        # download.
+        self.install_group = JobGroup(on_finished=lambda: downloaded.put(None))
+        self.progress_group = self.install_group
+        self.download_total_files = len(install_list)
+        self.download_current_file = 0
+        for i, (uuid, is_update, is_active) in enumerate(install_list):
+            filename = os.path.join(staging, "%d.zip" % i)
+            self.install_group.push(self.download_spice, (uuid, is_update, is_active, filename, downloaded), PRIORITY_DEFAULT)
+        self.install_group.close()
+
+        while True:
+            item = downloaded.get()
+            if item is None:
+                break
+
+            uuid, is_update, is_active, filename = item
+            self.download_current_file += 1
+            if self.abort_download > ABORT_NONE:
+                # Nothing more is installed, the remaining downloads are dropped
+                self.install_group.cancel()
+                continue
+            if filename is None:
+                continue
+
+            success = self.install(uuid, filename, staging)
 
             if is_update and is_active and success:
                 need_restart.append(uuid)
 
+        shutil.rmtree(staging, ignore_errors=True)
+
         ui_thread_do(self.progress_window.hide)
         self.abort_download = False
+        self.download_total_files = 0
+        self.download_current_file = 0
 
         ui_thread_do(onFinished, need_restart)
-        thread.exit()
+
+    def download_spice(self, uuid, is_update, is_active, filename, downloaded):
+        download_url = URL_SPICES_HOME + self.index_cache[uuid]['file']
+        try:
+            self.download(filename, download_url, False)
+            downloaded.put((uuid, is_update, is_active, filename))
+        except Exception:
+            # download() already reported the error
+            downloaded.put((uuid, is_update, is_active, None))
+
+    def verify_zip(self, zip):
+        # The index carries no checksums, the CRCs stored in the archive are checked instead
+        bad_file = zip.testzip()
+        if bad_file is not None:
+            raise Exception(_("The downloaded archive is damaged (%s)") % bad_file)
+
+    def replace_install(self, new_path, dest, staging):
+        # The previous installation is moved aside and only removed once the
+        # new one is in place, it is put back if that fails
+        backup = None
+        if os.path.exists(dest):
+            backup = tempfile.mkdtemp(dir=staging)
+            os.rmdir(backup)
+            shutil.move(dest, backup)
+        try:
+            shutil.move(new_path, dest)
+        except Exception:
+            if backup is not None:
+                shutil.rmtree(dest, ignore_errors=True)
+                shutil.move(backup, dest)
+            raise
+        if backup is not None:
+            shutil.rmtree(backup, ignore_errors=True)
 
     def get_members(self, zip):
         parts = []
@@ -415,26 +466,20 @@ class Spice_Harvester:
                 zipinfo.filename = name[offset:]
                 yield zipinfo
 
-    def install(self, uuid, is_update, is_active):
-        #print "Start downloading and installation"
+    def install(self, uuid, filename, staging):
         title = self.index_cache[uuid]['name']
 
-        download_url = URL_SPICES_HOME + self.index_cache[uuid]['file'];
-        self.current_uuid = uuid
-
         ui_thread_do(self.ui_installing_xlet, title)
 
         edited_date = self.index_cache[uuid]['last_edited']
 
         if not self.themes:
-            fd, filename = tempfile.mkstemp()
-            dirname = tempfile.mkdtemp()
-            f = os.fdopen(fd, 'wb')
+            dirname = tempfile.mkdtemp(dir=staging)
             try:
-                self.download(f, filename, download_url)
                 dest = os.path.join(self.install_folder, uuid)
                 schema_filename = ""
                 zip = zipfile.ZipFile(filename)
+                self.verify_zip(zip)
                 zip.extractall(dirname, self.get_members(zip))
                 for file in self.get_members(zip):
                     if not file.filename.endswith('/') and ((file.external_attr >> 16L) & 0o755) == 0o755:
@@ -469,10 +514,7 @@ class Spice_Harvester:
                 file = open(os.path.join(dirname, "metadata.json"), 'w+')
                 file.write(raw_meta)
                 file.close()
-                if os.path.exists(dest):
-                    shutil.rmtree(dest)
-                shutil.copytree(dirname, dest)
-                shutil.rmtree(dirname)
+                self.replace_install(dirname, dest, staging)
                 os.remove(filename)
 
             except Exception, detail:
@@ -486,13 +528,11 @@ class Spice_Harvester:
                     self.errorMessage(_("An error occurred during installation or updating.  You may wish to report this incident to the developer of %s.\n\nIf this was an update, the previous installation is unchanged") % (uuid), str(detail))
                 return False
         else:
-            fd, filename = tempfile.mkstemp()
-            dirname = tempfile.mkdtemp()
-            f = os.fdopen(fd, 'wb')
+            dirname = tempfile.mkdtemp(dir=staging)
             try:
-                self.download(f, filename, download_url)
                 dest = self.install_folder
                 zip = zipfile.ZipFile(filename)
+                self.verify_zip(zip)
                 zip.extractall(dirname)
 
                 # Check dir name - it may or may not be the same as the theme name from our spices data
@@ -514,9 +554,7 @@ class Spice_Harvester:
                 file.write(raw_meta)
                 file.close()
                 final_path = os.path.join(dest, title)
-                if os.path.exists(final_path):
-                    shutil.rmtree(final_path)
-                shutil.copytree(temp_path, final_path)
+                self.replace_install(temp_path, final_path, staging)
                 shutil.rmtree(dirname)
                 os.remove(filename)
 
@@ -580,7 +618,6 @@ class Spice_Harvester:
 
         ui_thread_do(self.progress_window.hide)
         ui_thread_do(onFinished, uuid)
-        thread.exit()
 
     def ui_uninstalling_xlet(self, name):
         self.progresslabel.set_text(_("Uninstalling %s...") % name)
@@ -589,9 +626,15 @@ class Spice_Harvester:
 
     def on_abort_clicked(self, button):
         self.abort_download = ABORT_USER
+        self.cancel_downloads()
         self.progress_window.hide()
         return
 
+    def cancel_downloads(self):
+        for group in (self.download_group, self.install_group):
+            if group is not None:
+                group.cancel()
+
     # def download_with_progressbar(self, outfd, outfile, caption='Please wait..', waitForClose=True):
     #     self.progressbar.set_fraction(0)
     #     self.progressbar.set_text('0%')
@@ -620,30 +663,30 @@ class Spice_Harvester:
             while Gtk.events_pending():
                 Gtk.main_iteration()
 
-    def download(self, outfd, outfile, url):
+    def download(self, outfile, url, conditional=True):
+        # Returns False if outfile was already up to date
         ui_thread_do(self.progress_button_abort.set_sensitive, True)
         try:
-            self.url_retrieve(url, outfd, self.reporthook)
+            return self.url_retrieve(url, outfile, self.reporthook, conditional)
         except KeyboardInterrupt:
-            try:
-                os.remove(outfile)
-            except OSError:
-                pass
+            # outfile is only replaced once a download completes, so there is nothing to clean up
             ui_thread_do(self.progress_window.hide)
             if self.abort_download == ABORT_ERROR:
                 self.errorMessage(_("An error occurred while trying to access the server.  Please try again in a little while."), self.error)
             raise Exception(_("Download aborted."))
 
-        return outfile
-
     def reporthook(self, count, blockSize, totalSize):
         if self.download_total_files > 1:
-            fraction = 1.0 - (float(self.download_manager.get_n_jobs()) / float(self.download_total_files))
-            self.progressbar.set_text("%s - %d / %d files" % (str(int(fraction*100)) + '%', self.download_total_files - self.download_manager.get_n_jobs(), self.download_total_files))
-        else:
+            n_pending = self.progress_group.get_n_pending()
+            fraction = 1.0 - (float(n_pending) / float(self.download_total_files))
+            self.progressbar.set_text("%s - %d / %d files" % (str(int(fraction*100)) + '%', self.download_total_files - n_pending, self.download_total_files))
+        elif totalSize > 0:
             fraction = count * blockSize / float((totalSize / blockSize + 1) *
                 (blockSize))
             self.progressbar.set_text(str(int(fraction * 100)) + '%')
+        else:
+            # The server did not send a content length
+            fraction = 0
 
         if fraction > 0:
             self.progressbar.set_fraction(fraction)
@@ -653,41 +696,21 @@ class Spice_Harvester:
         while Gtk.events_pending():
             Gtk.main_iteration()
 
-    def url_retrieve(self, url, f, reporthook):
-        #Like the one in urllib. Unlike urllib.retrieve url_retrieve
-        #can be interrupted. KeyboardInterrupt exception is rasied when
-        #interrupted.
-        count = 0
-        blockSize = 1024 * 8
+    def url_retrieve(self, url, path, reporthook, conditional=True):
+        #Unlike urllib.retrieve url_retrieve can be interrupted.
+        #KeyboardInterrupt exception is rasied when interrupted.
         try:
-            urlobj = urllib2.urlopen(url)
-            assert urlobj.getcode() == 200
-        except Exception, detail:
-            f.close()
+            return self.fetcher.fetch(url, path,
+                                      lambda count, blockSize, totalSize: ui_thread_do(reporthook, count, blockSize, totalSize),
+                                      lambda: self.abort_download > ABORT_NONE,
+                                      conditional)
+        except FetchAborted:
+            raise KeyboardInterrupt
+        except FetchError, detail:
             self.abort_download = ABORT_ERROR
             self.error = detail
             raise KeyboardInterrupt
 
-        totalSize = int(urlobj.info()['content-length'])
-
-        try:
-            while self.abort_download == ABORT_NONE:
-                data = urlobj.read(blockSize)
-                count += 1
-                if not data:
-                    break
-                f.write(data)
-                ui_thread_do(reporthook, count, blockSize, totalSize)
-        except KeyboardInterrupt:
-            f.close()
-            self.abort_download = ABORT_USER
-
-        if self.abort_download > ABORT_NONE:
-            raise KeyboardInterrupt
-
-        del urlobj
-        f.close()
-
     def scrubConfigDirs(self, enabled_list):
         active_list = {}
         for enabled in enabled_list:
@@ -740,4 +763,5 @@ class Spice_Harvester:
 
     def on_progress_close(self, widget, event):
         self.abort_download = True
+        self.cancel_downloads()
         return widget.hide_on_delete()
@@ -0,0 +1,111 @@
+#!/usr/bin/python2
+
+import os
+import json
+import threading
+
+# Bump this whenever the layout of the catalog changes
+CATALOG_VERSION = 1
+
+CATALOG_FILE = "catalog.json"
+
+class SpicesCatalog:
+    """ Remembers what was derived from the last Spices index of a collection.
+
+    The fields computed from an index entry are kept per uuid and only
+    recomputed when that entry changes, which also tells which uuids are new
+    or were edited since the previous index. Those stay pending until their
+    thumbnail was revalidated, also across runs if that was interrupted.
+    Thumbnails that passed a check are recorded with their size and mtime,
+    so they are not decoded again until they change on disk.
+    """
+
+    def __init__(self, cache_folder):
+        self.catalog_file = os.path.join(cache_folder, CATALOG_FILE)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.thumbs = {}
+        self.pending = set()
+        self.dirty = False
+
+        try:
+            with open(self.catalog_file, "r") as f:
+                catalog = json.load(f)
+            if catalog["version"] == CATALOG_VERSION:
+                self.entries = catalog["entries"]
+                self.thumbs = catalog["thumbs"]
+                self.pending = set(catalog.get("pending", []))
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def get_fingerprint(self, data):
+        return [data.get("last_edited"), data.get("icon"), data.get("screenshot"), data.get("file")]
+
+    def update(self, index, derive):
+        # Adds the fields returned by derive(uuid, data) to every entry of
+        # index and returns the uuids that were added or changed, including
+        # those left pending by an earlier update
+        with self.lock:
+            for uuid, data in index.items():
+                fingerprint = self.get_fingerprint(data)
+                entry = self.entries.get(uuid)
+                if entry is None or entry["fingerprint"] != fingerprint:
+                    entry = {"fingerprint": fingerprint, "derived": derive(uuid, data)}
+                    self.entries[uuid] = entry
+                    self.pending.add(uuid)
+                    self.dirty = True
+                data.update(entry["derived"])
+
+            for uuid in self.entries.keys():
+                if uuid not in index:
+                    del self.entries[uuid]
+                    self.pending.discard(uuid)
+                    self.dirty = True
+            return list(self.pending)
+
+    def set_revalidated(self, uuid):
+        with self.lock:
+            if uuid in self.pending:
+                self.pending.remove(uuid)
+                self.dirty = True
+
+    def get_thumb_stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime]
+
+    def is_thumb_checked(self, path):
+        stamp = self.get_thumb_stamp(path)
+        with self.lock:
+            return stamp is not None and self.thumbs.get(os.path.basename(path)) == stamp
+
+    def set_thumb_checked(self, path):
+        stamp = self.get_thumb_stamp(path)
+        if stamp is None:
+            return
+        with self.lock:
+            self.thumbs[os.path.basename(path)] = stamp
+            self.dirty = True
+
+    def prune_thumbs(self, basenames):
+        with self.lock:
+            for basename in self.thumbs.keys():
+                if basename not in basenames:
+                    del self.thumbs[basename]
+                    self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                tmp_file = self.catalog_file + ".tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump({"version": CATALOG_VERSION, "entries": self.entries, "thumbs": self.thumbs,
+                               "pending": list(self.pending)}, f)
+                os.rename(tmp_file, self.catalog_file)
+                self.dirty = False
+            except (IOError, OSError) as e:
+                print "Failed to save Spices catalog %s: %s" % (self.catalog_file, e)
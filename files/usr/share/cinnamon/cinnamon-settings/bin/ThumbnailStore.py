@@ -0,0 +1,223 @@
+#!/usr/bin/python2
+
+import os
+import json
+import mmap
+import time
+import threading
+
+from gi.repository import GLib
+
+# Bump this whenever the layout of the index or of the blobs changes
+STORE_VERSION = 1
+
+STORE_DIR = os.path.join(GLib.get_user_cache_dir(), "cs_backgrounds")
+
+# The least recently used thumbnails are evicted once the data file grows
+# beyond this, until it is back under three quarters of it
+MAX_STORE_SIZE = 256 * 1024 * 1024
+
+(ENTRY_MTIME, ENTRY_OFFSET, ENTRY_WIDTH, ENTRY_HEIGHT, ENTRY_INFO, ENTRY_USED) = range(6)
+
+class ThumbnailStore:
+    """ Keeps thumbnails as raw RGBA pixels packed into a single data file.
+
+    The index maps a source file and thumbnail size to the offset of its
+    pixels in the data file and is kept in memory, the data file itself is
+    memory mapped so a hit is a plain slice of it. Entries are dropped when
+    their source file changes or is deleted, and the space they used is
+    reclaimed the next time the data file is compacted. Access times are
+    only written out along with other changes. Safe to use from several
+    threads.
+    """
+
+    def __init__(self, directory=STORE_DIR, max_size=MAX_STORE_SIZE):
+        self.index_file = os.path.join(directory, "thumbnails.json")
+        self.data_file = os.path.join(directory, "thumbnails.data")
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dead_size = 0
+        self.data = None
+        self.map = None
+        self.dirty = False
+
+        try:
+            with open(self.index_file, "r") as f:
+                index = json.load(f)
+            if index["version"] == STORE_VERSION:
+                for key, entry in index["entries"].items():
+                    self.entries[key.encode("utf-8")] = entry
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            if len(self.entries) == 0 and os.path.exists(self.data_file):
+                # Without an index the blobs are of no use
+                os.remove(self.data_file)
+            self.data = open(self.data_file, "ab")
+            self.map_data()
+        except (IOError, OSError), detail:
+            print "Failed to open thumbnail store %s: %s" % (self.data_file, detail)
+            self.data = None
+            self.entries = {}
+
+        # Drop entries that point past the end of the data file, e.g. after a
+        # crash. Whatever is not referenced by the index is reclaimable.
+        size = self.get_data_size()
+        live_size = 0
+        for key, entry in self.entries.items():
+            length = entry[ENTRY_WIDTH] * entry[ENTRY_HEIGHT] * 4
+            if entry[ENTRY_OFFSET] + length > size:
+                del self.entries[key]
+                self.dirty = True
+            else:
+                live_size += length
+        self.dead_size = size - live_size
+
+    def get_key(self, filename, size):
+        if isinstance(filename, unicode):
+            filename = filename.encode("utf-8")
+        return "%d:%s" % (size or 0, filename)
+
+    def get_source(self, key):
+        return key.partition(":")[2]
+
+    def get_data_size(self):
+        if self.map is None:
+            return 0
+        return len(self.map)
+
+    def map_data(self):
+        # Called with the lock held after the data file grew or was replaced
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.data.flush()
+        if os.fstat(self.data.fileno()).st_size > 0:
+            with open(self.data_file, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def lookup(self, filename, size):
+        # Returns (pixels, width, height, info) or None
+        key = self.get_key(filename, size)
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            mtime = None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            length = entry[ENTRY_WIDTH] * entry[ENTRY_HEIGHT] * 4
+            if entry[ENTRY_MTIME] != mtime:
+                # The source file changed or is gone since the thumbnail was made
+                del self.entries[key]
+                self.dead_size += length
+                self.dirty = True
+                return None
+            if self.map is None or entry[ENTRY_OFFSET] + length > len(self.map):
+                self.map_data()
+            offset = entry[ENTRY_OFFSET]
+            pixels = self.map[offset:offset + length]
+            # Not worth a rewrite of the index on its own
+            entry[ENTRY_USED] = time.time()
+            return pixels, entry[ENTRY_WIDTH], entry[ENTRY_HEIGHT], entry[ENTRY_INFO]
+
+    def add(self, filename, mtime, size, pixels, width, height, info=None):
+        # pixels are width * height RGBA pixels, info anything json can store
+        key = self.get_key(filename, size)
+        with self.lock:
+            if self.data is None:
+                return
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.dead_size += old_entry[ENTRY_WIDTH] * old_entry[ENTRY_HEIGHT] * 4
+            try:
+                self.data.seek(0, os.SEEK_END)
+                offset = self.data.tell()
+                self.data.write(pixels)
+                self.data.flush()
+            except IOError, detail:
+                print "Failed to add %s to the thumbnail store: %s" % (filename, detail)
+                return
+            self.entries[key] = [mtime, offset, width, height, info, time.time()]
+            self.dirty = True
+
+            data_size = offset + len(pixels)
+            if data_size > self.max_size or self.dead_size > data_size / 2:
+                self.compact(self.max_size * 3 / 4)
+
+    def compact(self, target_size):
+        # Called with the lock held, rewrites the data file with the most
+        # recently used entries that fit in target_size
+        self.remove_orphans()
+        self.map_data()
+        tmp_file = self.data_file + ".tmp"
+        entries = {}
+        try:
+            with open(tmp_file, "wb") as f:
+                total = 0
+                for key, entry in sorted(self.entries.items(), key=lambda item: item[1][ENTRY_USED], reverse=True):
+                    length = entry[ENTRY_WIDTH] * entry[ENTRY_HEIGHT] * 4
+                    if total + length > target_size:
+                        break
+                    offset = entry[ENTRY_OFFSET]
+                    f.write(self.map[offset:offset + length])
+                    entries[key] = entry[:ENTRY_OFFSET] + [total] + entry[ENTRY_OFFSET + 1:]
+                    total += length
+            os.rename(tmp_file, self.data_file)
+        except (IOError, OSError), detail:
+            print "Failed to compact the thumbnail store: %s" % detail
+            return
+
+        self.data.close()
+        self.data = open(self.data_file, "ab")
+        self.entries = entries
+        self.dead_size = 0
+        self.map_data()
+        # The offsets in the saved index are no longer valid
+        self.dirty = True
+        self.save_index()
+
+    def remove_orphans(self):
+        # Called with the lock held, drops the entries whose source was deleted
+        for key, entry in self.entries.items():
+            if not os.path.exists(self.get_source(key)):
+                del self.entries[key]
+                self.dead_size += entry[ENTRY_WIDTH] * entry[ENTRY_HEIGHT] * 4
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            self.remove_orphans()
+            if self.dirty:
+                self.save_index()
+
+    def save_index(self):
+        # Called with the lock held
+        try:
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"version": STORE_VERSION, "entries": self.entries}, f)
+            os.rename(tmp_file, self.index_file)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            print "Failed to save thumbnail index %s: %s" % (self.index_file, e)
+
+    def remove_legacy_files(self):
+        # Older versions kept one pickle per thumbnail in the same directory
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+        for filename in filenames:
+            if filename.endswith("v2"):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
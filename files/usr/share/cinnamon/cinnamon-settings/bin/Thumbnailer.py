@@ -0,0 +1,233 @@
+#!/usr/bin/python2
+
+import os
+import sys
+import json
+import select
+import Queue
+import mimetypes
+import threading
+import subprocess
+import multiprocessing
+
+from PIL import Image
+
+import imtools
+
+# A helper exits after this many seconds without work, the next request
+# starts a new one
+HELPER_IDLE_TIMEOUT = 30
+
+# EXIF utility functions (source: http://stackoverflow.com/questions/4228530/pil-thumbnail-is-rotating-my-image)
+def flip_horizontal(im): return im.transpose(Image.FLIP_LEFT_RIGHT)
+def flip_vertical(im): return im.transpose(Image.FLIP_TOP_BOTTOM)
+def rotate_180(im): return im.transpose(Image.ROTATE_180)
+def rotate_90(im): return im.transpose(Image.ROTATE_90)
+def rotate_270(im): return im.transpose(Image.ROTATE_270)
+def transpose(im): return rotate_90(flip_horizontal(im))
+def transverse(im): return rotate_90(flip_vertical(im))
+orientation_funcs = [None,
+                 lambda x: x,
+                 flip_horizontal,
+                 rotate_180,
+                 flip_vertical,
+                 transpose,
+                 rotate_270,
+                 transverse,
+                 rotate_90
+                ]
+def apply_orientation(im):
+    """
+    Extract the oritentation EXIF tag from the image, which should be a PIL Image instance,
+    and if there is an orientation tag that would rotate the image, apply that rotation to
+    the Image instance given to do an in-place rotation.
+
+    :param Image im: Image instance to inspect
+    :return: A possibly transposed image instance
+    """
+
+    try:
+        kOrientationEXIFTag = 0x0112
+        if hasattr(im, '_getexif'): # only present in JPEGs
+            e = im._getexif()       # returns None if no EXIF data
+            if e is not None:
+                #log.info('EXIF data found: %r', e)
+                orientation = e[kOrientationEXIFTag]
+                f = orientation_funcs[orientation]
+                return f(im)
+    except:
+        # We'd be here with an invalid orientation value or some random error?
+        pass # log.exception("Error applying EXIF Orientation tag")
+    return im
+
+def make_thumbnail(filename, size=None):
+    # Runs in a helper process, returns the RGBA bytes and size of the
+    # thumbnail together with the size of the original image
+    mimetype = mimetypes.guess_type(filename)[0]
+
+    if mimetype == "image/svg+xml":
+        # rasterize svg with Gdk-Pixbuf and convert to PIL Image
+        from gi.repository import GdkPixbuf
+        tmp_pix = GdkPixbuf.Pixbuf.new_from_file(filename)
+        mode = "RGBA" if tmp_pix.props.has_alpha else "RGB"
+        img = Image.frombytes(mode, (tmp_pix.props.width, tmp_pix.props.height),
+                              tmp_pix.read_pixel_bytes().get_data(), "raw",
+                              mode, tmp_pix.props.rowstride)
+    else:
+        img = Image.open(filename)
+        img = apply_orientation(img)
+
+    # generate thumbnail
+    (width, height) = img.size
+    if img.mode != "RGB":
+        if img.mode == "RGBA":
+            bg_img = Image.new("RGBA", img.size, (255,255,255,255))
+            img = Image.alpha_composite(bg_img, img)
+        img = img.convert("RGB")
+    if size:
+        img.thumbnail((size, size), Image.ANTIALIAS)
+    img = imtools.round_image(img, {}, False, None, 3, 255)
+    img = imtools.drop_shadow(img, 4, 4, background_color=(255, 255, 255, 0),
+                              shadow_color=0x444444, border=8, shadow_blur=3,
+                              force_background_color=False, cache=None)
+
+    return [img.tobytes(), img.size[0], img.size[1], width, height]
+
+class ThumbnailError(Exception):
+    pass
+
+class Helper:
+    def __init__(self):
+        script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        # Started with exec, nothing of the parent's threads is inherited
+        self.proc = subprocess.Popen([sys.executable, script], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, close_fds=True)
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def request(self, filename, size):
+        self.proc.stdin.write(json.dumps([filename, size]) + "\n")
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline()
+        if header == "":
+            raise IOError("thumbnail helper exited")
+        reply = json.loads(header)
+        if "error" in reply:
+            raise ThumbnailError(reply["error"])
+        pixels = self.proc.stdout.read(reply["length"])
+        if len(pixels) != reply["length"]:
+            raise IOError("thumbnail helper exited")
+        return [pixels, reply["w"], reply["h"], reply["width"], reply["height"]]
+
+    def close(self):
+        # With both pipes closed it exits even in the middle of a reply
+        for pipe in (self.proc.stdin, self.proc.stdout):
+            try:
+                pipe.close()
+            except IOError:
+                pass
+        self.proc.wait()
+
+class ThumbnailerPool:
+    """ Makes thumbnails in helper processes, one per CPU core.
+
+    PIL and imtools partly run as Python code, so threads would take turns
+    on the interpreter lock. The helpers are separate interpreters started
+    with fork+exec, so they are safe to start from a threaded process. They
+    are started on demand and exit on their own once idle for a while.
+    make_thumbnail() blocks the calling thread until a helper answered.
+    """
+
+    def __init__(self, max_helpers=None):
+        self.max_helpers = max_helpers or get_n_cpus()
+        self.lock = threading.Lock()
+        self.idle = Queue.Queue()
+        self.n_helpers = 0
+
+    def make_thumbnail(self, filename, size=None):
+        for attempt in range(2):
+            helper = self.get_helper()
+            try:
+                result = helper.request(filename, size)
+            except ThumbnailError:
+                self.idle.put(helper)
+                raise
+            except (IOError, ValueError):
+                # It may have timed out just before the request, a second
+                # failure is a real one
+                self.discard(helper)
+                if attempt > 0:
+                    raise
+                continue
+            self.idle.put(helper)
+            return result
+
+    def get_helper(self):
+        while True:
+            try:
+                helper = self.idle.get_nowait()
+            except Queue.Empty:
+                break
+            if helper.is_alive():
+                return helper
+            self.discard(helper)
+
+        with self.lock:
+            start = self.n_helpers < self.max_helpers
+            if start:
+                self.n_helpers += 1
+        if not start:
+            return self.idle.get()
+        try:
+            return Helper()
+        except OSError:
+            with self.lock:
+                self.n_helpers -= 1
+            raise
+
+    def discard(self, helper):
+        helper.close()
+        with self.lock:
+            self.n_helpers -= 1
+
+    def close(self):
+        while True:
+            try:
+                helper = self.idle.get_nowait()
+            except Queue.Empty:
+                return
+            self.discard(helper)
+
+def get_n_cpus():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def serve():
+    # Answers one [filename, size] line at a time on stdin, with a json
+    # header line followed by the pixels on stdout
+    stdin = sys.stdin
+    # Anything printed by the libraries goes to stderr instead of the replies
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    while True:
+        ready, _, _ = select.select([stdin], [], [], HELPER_IDLE_TIMEOUT)
+        if not ready:
+            return
+        line = stdin.readline()
+        if line == "":
+            return
+        filename, size = json.loads(line)
+        try:
+            pixels, w, h, width, height = make_thumbnail(filename.encode("utf-8"), size)
+        except Exception, detail:
+            stdout.write(json.dumps({"error": str(detail)}) + "\n")
+        else:
+            stdout.write(json.dumps({"length": len(pixels), "w": w, "h": h, "width": width, "height": height}) + "\n")
+            stdout.write(pixels)
+        stdout.flush()
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,201 @@
+#!/usr/bin/python2
+
+import heapq
+import itertools
+import threading
+
+from gi.repository import GLib
+
+PRIORITY_HIGH = 0
+PRIORITY_DEFAULT = 100
+PRIORITY_LOW = 200
+
+# Cap on the number of worker threads cinnamon-settings uses for background work
+MAX_THREADS = 8
+# Pushing from a worker thread blocks while this many jobs are already waiting
+MAX_PENDING = 256
+
+# This module is first imported by the main loop's thread
+_main_thread = threading.current_thread()
+
+def ui_thread_do(callback, *args):
+    GLib.idle_add(callback, *args, priority=GLib.PRIORITY_DEFAULT)
+
+class Job:
+    def __init__(self, group, func, args, priority, callback):
+        self.group = group
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.callback = callback
+        self.cancelled = False
+        self.started = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled or self.group.cancelled
+
+class JobGroup:
+    """ A set of related jobs that can be cancelled together.
+
+    on_progress(done, total) is called in the main loop after each job of the
+    group completes, except for cancelled jobs. on_finished() is called once,
+    after close() and when the group has no more jobs, also when some or all
+    of them were cancelled, so whatever waits for the group always gets to
+    finish. Jobs can finish while others are still being pushed, which is why
+    the group has to be closed after the last push. Cancelling closes it too.
+    """
+
+    def __init__(self, queue=None, on_progress=None, on_finished=None):
+        self.queue = queue or get_default()
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.cancelled = False
+        self.closed = False
+        self.finished = False
+        self.n_total = 0
+        self.n_done = 0
+
+    def push(self, func, args=(), priority=PRIORITY_DEFAULT, callback=None):
+        # func(*args) runs in a worker thread, callback(result) in the main loop.
+        # Once cancelled a group stays cancelled, use a new one for the next batch.
+        job = Job(self, func, args, priority, callback)
+        with self.queue.lock:
+            if self.closed and not self.cancelled:
+                raise ValueError("push() on a closed JobGroup")
+            self.n_total += 1
+        self.queue.push(job)
+        return job
+
+    def close(self):
+        # No more jobs will be pushed
+        with self.queue.lock:
+            self.closed = True
+            self.check_finished()
+
+    def cancel(self):
+        self.cancelled = True
+        self.queue.discard(self)
+        self.close()
+
+    def busy(self):
+        return self.n_done < self.n_total
+
+    def get_n_pending(self):
+        return self.n_total - self.n_done
+
+    def job_done(self, job):
+        # Called by the queue, with its lock held
+        self.n_done += 1
+        if self.on_progress and not job.is_cancelled():
+            ui_thread_do(self.on_progress, self.n_done, self.n_total)
+        self.check_finished()
+
+    def check_finished(self):
+        # Called with the queue's lock held
+        if self.closed and not self.finished and self.n_done == self.n_total:
+            self.finished = True
+            if self.on_finished:
+                ui_thread_do(self.on_finished)
+
+class WorkQueue:
+    """ A bounded pool of worker threads running jobs in priority order.
+
+    Workers are started on demand and exit once there is nothing left to do,
+    so an idle cinnamon-settings holds no background threads.
+    """
+
+    def __init__(self, max_threads=MAX_THREADS, max_pending=MAX_PENDING):
+        self.max_threads = max_threads
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.heap = []
+        self.counter = itertools.count()
+        self.n_threads = 0
+        self.n_idle = 0
+        self.work_ready = threading.Condition(self.lock)
+
+    def push(self, job):
+        with self.lock:
+            if threading.current_thread() is not _main_thread:
+                # Never block the main loop, only background producers
+                while len(self.heap) >= self.max_pending:
+                    self.not_full.wait()
+            heapq.heappush(self.heap, (job.priority, next(self.counter), job))
+            if self.n_idle > 0:
+                self.work_ready.notify()
+            if len(self.heap) > self.n_idle and self.n_threads < self.max_threads:
+                self.n_threads += 1
+                worker = threading.Thread(target=self._worker)
+                worker.daemon = True
+                worker.start()
+
+    def set_priority(self, job, priority):
+        # The old heap entry is left behind and skipped when it comes up
+        with self.lock:
+            if job.priority == priority:
+                return
+            job.priority = priority
+            heapq.heappush(self.heap, (priority, next(self.counter), job))
+
+    def discard(self, group):
+        with self.lock:
+            remaining = []
+            for entry in self.heap:
+                job = entry[2]
+                if job.group is not group:
+                    remaining.append(entry)
+                elif not job.started:
+                    # Reprioritized jobs have several entries, only count them once
+                    job.started = True
+                    group.job_done(job)
+            heapq.heapify(remaining)
+            self.heap = remaining
+            self.not_full.notify_all()
+
+    def _next_job(self):
+        # Called with the lock held, returns None once the worker should exit
+        while True:
+            while len(self.heap) == 0:
+                self.n_idle += 1
+                self.work_ready.wait(5)
+                self.n_idle -= 1
+                if len(self.heap) == 0:
+                    self.n_threads -= 1
+                    return None
+            priority, count, job = heapq.heappop(self.heap)
+            self.not_full.notify()
+            if priority != job.priority or job.started:
+                continue
+            job.started = True
+            return job
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                job = self._next_job()
+            if job is None:
+                return
+
+            result = None
+            if not job.is_cancelled():
+                try:
+                    result = job.func(*job.args)
+                except Exception, detail:
+                    print "Background job %s failed: %s" % (job.func.__name__, detail)
+
+            if job.callback and not job.is_cancelled():
+                ui_thread_do(job.callback, result)
+            with self.lock:
+                job.group.job_done(job)
+
+_default_queue = None
+
+def get_default():
+    global _default_queue
+    if _default_queue is None:
+        _default_queue = WorkQueue()
+    return _default_queue
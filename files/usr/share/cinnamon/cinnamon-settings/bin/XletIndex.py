@@ -0,0 +1,117 @@
+#!/usr/bin/python2
+
+import os
+import json
+import hashlib
+
+from gi.repository import GLib, GdkPixbuf
+
+# Bump this whenever the layout of an index entry changes
+INDEX_VERSION = 1
+
+INDEX_DIR = os.path.join(GLib.get_user_cache_dir(), "cs_xlets")
+
+class XletIndex:
+    """ Keeps the parsed metadata and scaled icons of installed xlets on disk.
+
+    Entries are keyed by the xlet directory and are only trusted as long as the
+    modification times of the files they were built from are unchanged.
+    """
+
+    def __init__(self, collection_type):
+        self.index_file = os.path.join(INDEX_DIR, "%ss.json" % collection_type)
+        self.icon_dir = os.path.join(INDEX_DIR, collection_type)
+        self.entries = {}
+        self.dirty = False
+
+        try:
+            with open(self.index_file, "r") as f:
+                index = json.load(f)
+            if index["version"] == INDEX_VERSION:
+                # json hands back unicode keys, the directories we are given are utf-8 str
+                for directory, entry in index["entries"].items():
+                    self.entries[directory.encode("utf-8")] = entry
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def get_stamp(self, paths):
+        stamp = []
+        for path in paths:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(-1)
+        return stamp
+
+    def lookup(self, directory):
+        entry = self.entries.get(directory)
+        if entry is None or entry["stamp"] != self.get_stamp(entry["stamp_paths"]):
+            return None
+        return entry["data"]
+
+    def store(self, directory, data, stamp_paths):
+        # stamp_paths are the files and directories the data was read from
+        self.forget(directory)
+        self.entries[directory] = {"data": data,
+                                   "stamp_paths": stamp_paths,
+                                   "stamp": self.get_stamp(stamp_paths),
+                                   "icon_sizes": []}
+        self.dirty = True
+
+    def forget(self, directory):
+        entry = self.entries.pop(directory, None)
+        if entry is None:
+            return
+        for size in entry["icon_sizes"]:
+            try:
+                os.remove(self.get_icon_cache_path(directory, size))
+            except OSError:
+                pass
+        self.dirty = True
+
+    def prune(self, directories):
+        # Drop the entries of xlets that are no longer installed
+        for directory in self.entries.keys():
+            if directory not in directories:
+                self.forget(directory)
+
+    def get_icon_cache_path(self, directory, size):
+        return os.path.join(self.icon_dir, "%s-%d.png" % (hashlib.sha1(directory).hexdigest(), size))
+
+    def get_icon(self, directory, icon_file, size):
+        entry = self.entries[directory]
+        cache_path = self.get_icon_cache_path(directory, size)
+
+        if size in entry["icon_sizes"]:
+            try:
+                return GdkPixbuf.Pixbuf.new_from_file(cache_path)
+            except GLib.Error:
+                entry["icon_sizes"].remove(size)
+
+        img = GdkPixbuf.Pixbuf.new_from_file_at_size(icon_file, size, size)
+
+        try:
+            if not os.path.exists(self.icon_dir):
+                os.makedirs(self.icon_dir)
+            img.savev(cache_path, "png", [], [])
+            entry["icon_sizes"].append(size)
+            self.dirty = True
+        except (OSError, GLib.Error) as e:
+            print "Failed to cache icon %s: %s" % (icon_file, e)
+
+        return img
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        try:
+            if not os.path.exists(INDEX_DIR):
+                os.makedirs(INDEX_DIR)
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"version": INDEX_VERSION, "entries": self.entries}, f)
+            os.rename(tmp_file, self.index_file)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            print "Failed to save xlet index %s: %s" % (self.index_file, e)
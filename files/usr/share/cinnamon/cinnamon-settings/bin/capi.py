@@ -18,11 +18,25 @@ import os
 
 from gi.repository import Gio, GObject
 
+# Panels whose library is not named after the panel id
+PANEL_LIBRARIES = {"wacom-properties": "wacom", "date_time": "datetime"}
 
 class CManager():
+    """ Knows which control center panels are installed without loading them.
+
+    Panel libraries are named lib<panel id>.so, so the panel directories are
+    only listed at startup and a panel's library is loaded the first time its
+    widget is asked for. Should a panel not follow that naming, every panel
+    is loaded as a fallback.
+    """
+
     def __init__(self):
         self.extension_point = Gio.io_extension_point_register ("cinnamon-control-center-1")
         self.modules = []
+        self.module_paths = {}
+        self.loaded_paths = set()
+        self.panel_dirs = []
+        self.loaded_all = False
 
         architecture = platform.machine()
         paths = ["/usr/lib"]
@@ -42,13 +56,54 @@ class CManager():
             if not os.path.islink(path):
                 path = os.path.join(path, "cinnamon-control-center-1/panels")
                 if os.path.exists(path):
+                    self.panel_dirs.append(path)
                     try:
-                        self.modules = self.modules + Gio.io_modules_load_all_in_directory(path)
-                    except Exception, e:
-                        print "capi failed to load multiarch modules from %s: " % path, e
+                        for filename in os.listdir(path):
+                            if filename.startswith("lib") and filename.endswith(".so"):
+                                mod_id = filename[3:-3]
+                                mod_id = PANEL_LIBRARIES.get(mod_id, mod_id)
+                                if mod_id not in self.module_paths:
+                                    self.module_paths[mod_id] = os.path.join(path, filename)
+                    except OSError, e:
+                        print "capi failed to scan multiarch modules from %s: " % path, e
 
-    def get_c_widget(self, mod_id):
+    def load_path(self, path):
+        if path in self.loaded_paths:
+            return
+        self.loaded_paths.add(path)
+        module = Gio.IOModule.new(path)
+        # use() loads the library, which registers its panel with the extension point
+        if module.use():
+            self.modules.append(module)
+        else:
+            print "capi failed to load module %s" % path
+
+    def load_module(self, mod_id):
         extension = self.extension_point.get_extension_by_name(mod_id)
+        if extension is not None:
+            return extension
+
+        if mod_id in self.module_paths:
+            self.load_path(self.module_paths[mod_id])
+            extension = self.extension_point.get_extension_by_name(mod_id)
+            if extension is not None:
+                return extension
+
+        if not self.loaded_all:
+            self.loaded_all = True
+            for path in self.panel_dirs:
+                try:
+                    for filename in sorted(os.listdir(path)):
+                        if filename.endswith(".so"):
+                            self.load_path(os.path.join(path, filename))
+                except OSError, e:
+                    print "capi failed to load multiarch modules from %s: " % path, e
+            extension = self.extension_point.get_extension_by_name(mod_id)
+
+        return extension
+
+    def get_c_widget(self, mod_id):
+        extension = self.load_module(mod_id)
         if extension is None:
             print("Could not load %s module; is the cinnamon-control-center package installed?" % mod_id)
             return None
@@ -56,9 +111,8 @@ class CManager():
         return GObject.new(panel_type)
 
     def lookup_c_module(self, mod_id):
-        extension = self.extension_point.get_extension_by_name(mod_id)
-        if extension is None:
-            print("Could not find %s module; is the cinnamon-control-center package installed?" % mod_id)
-            return False
-        else:
+        # Only panels that don't follow the library naming get loaded here
+        if mod_id in self.module_paths or self.load_module(mod_id) is not None:
             return True
+        print("Could not find %s module; is the cinnamon-control-center package installed?" % mod_id)
+        return False
@@ -4,15 +4,18 @@ import sys
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
+import time
+STARTUP_TIME = time.time()
+
 import os
 import glob
 import gettext
-import time
+import json
 import traceback
 import locale
 import urllib2
+import subprocess
 from functools import cmp_to_key
-import unicodedata
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -23,6 +26,7 @@ sys.path.append('/usr/share/cinnamon/cinnamon-settings/bin')
 import capi
 import proxygsettings
 import SettingsWidgets
+import SettingsIndex
 
 # i18n
 gettext.install("cinnamon", "/usr/share/locale")
@@ -40,7 +44,24 @@ for mod_file in mod_files:
     if mod_file[0:3] != "cs_":
         raise Exception("Settings modules must have a prefix of 'cs_' !!")
 
-modules = map(__import__, mod_files)
+# Modules listed in the manifest are only imported once their page is opened.
+# Anything missing from it, or needing a load check, is imported right away.
+MODULE_MANIFEST = "/usr/share/cinnamon/cinnamon-settings/data/modules.json"
+
+# Set CINNAMON_SETTINGS_TIMING to print how long the first frame took
+SHOW_TIMING = os.getenv("CINNAMON_SETTINGS_TIMING") is not None
+
+manifest = []
+try:
+    with open(MODULE_MANIFEST) as f:
+        for entry in json.load(f):
+            if entry["module"] in mod_files and not entry["load_check"]:
+                manifest.append(entry)
+except Exception, e:
+    print "Could not read the settings module manifest: ", e
+
+lazy_mod_files = [entry["module"] for entry in manifest]
+modules = map(__import__, [x for x in mod_files if x not in lazy_mod_files])
 
 # i18n for menu item
 menuName = _("System Settings")
@@ -55,6 +76,8 @@ MAX_LABEL_WIDTH = 25
 MIN_PIX_WIDTH = 100
 MAX_PIX_WIDTH = 160
 
+MIN_SETTING_SEARCH_LENGTH = 3
+
 MOUSE_BACK_BUTTON = 8
 
 CATEGORIES = [
@@ -102,6 +125,15 @@ def touch(fname, times=None):
     with file(fname, 'a'):
         os.utime(fname, times)
 
+class LazySidePage(SettingsWidgets.SidePage):
+    # Stands in for a module's side page until the module itself is needed
+    def __init__(self, entry, content_box):
+        SettingsWidgets.SidePage.__init__(self, _(entry["label"].encode("utf-8")), entry["icon"],
+                                          _(entry["keywords"].encode("utf-8")), content_box)
+        self.mod_file = str(entry["module"])
+        self.mod_id = str(entry["name"])
+        self.category = str(entry["category"])
+
 class MainWindow:
 
     # Change pages
@@ -122,6 +154,11 @@ class MainWindow:
     def go_to_sidepage(self, cat, path):
         iterator = self.store[cat].get_iter(path)
         sidePage = self.store[cat].get_value(iterator,2)
+        if isinstance(sidePage, LazySidePage):
+            sidePage = self.load_lazy_sidepage(sidePage)
+            if sidePage is None:
+                return
+            self.store[cat].set_value(iterator, 2, sidePage)
         if not sidePage.is_standalone:
             self.window.set_title(sidePage.name)
             sidePage.build()
@@ -151,9 +188,66 @@ class MainWindow:
                 width += n
             self.top_bar.set_size_request(width + 20, -1)
             self.maybe_resize(sidePage)
+            entry = self.setting_matches.get(self.store[cat].get_value(iterator, 5))
+            if entry is not None and self.search_text not in self.store[cat].get_value(iterator, 4):
+                self.show_setting(sidePage, entry)
         else:
             sidePage.build()
 
+    def show_setting(self, sidePage, entry):
+        # Brings up the setting that got the page into the search results
+        if entry.uuid is not None:
+            subprocess.Popen(["xlet-settings", entry.module[:-1], entry.uuid])
+            return
+
+        if sidePage.stack and entry.page and sidePage.stack.get_child_by_name(entry.page):
+            sidePage.stack.set_visible_child_name(entry.page)
+            page = sidePage.stack.get_visible_child()
+        else:
+            page = self.content_box
+
+        label = self.find_label(page, entry.label)
+        if label is None:
+            return
+        row = label.get_parent()
+        while row is not None and not isinstance(row, SettingsWidgets.SettingsWidget):
+            row = row.get_parent()
+        focusable = self.find_focusable(row or label.get_parent())
+        if focusable is not None:
+            focusable.grab_focus()
+
+    def find_label(self, widget, text):
+        if isinstance(widget, Gtk.Label) and widget.get_text() == text:
+            return widget
+        if isinstance(widget, Gtk.Container):
+            for child in widget.get_children():
+                label = self.find_label(child, text)
+                if label is not None:
+                    return label
+        return None
+
+    def find_focusable(self, widget):
+        if widget.get_can_focus() and widget.get_sensitive():
+            return widget
+        if isinstance(widget, Gtk.Container):
+            for child in widget.get_children():
+                focusable = self.find_focusable(child)
+                if focusable is not None:
+                    return focusable
+        return None
+
+    def load_lazy_sidepage(self, lazy_sidepage):
+        try:
+            module = __import__(lazy_sidepage.mod_file)
+            mod = module.Module(self.content_box)
+            if not self.setParentRefs(mod):
+                return None
+            return mod.sidePage
+        except:
+            print "Failed to load module %s" % lazy_sidepage.mod_file
+            traceback.print_exc()
+            return None
+
     def maybe_resize(self, sidePage):
         m, n = self.content_box.get_preferred_size()
 
@@ -191,6 +285,10 @@ class MainWindow:
         self.window = self.builder.get_object("main_window")
         self.top_bar = self.builder.get_object("top_bar")
         self.side_view = {}
+        self.category_widgets = {}
+        self.search_text = ""
+        self.settings_index = SettingsIndex.SettingsIndex()
+        self.setting_matches = {}
         self.main_stack = self.builder.get_object("main_stack")
         self.main_stack.set_transition_type(Gtk.StackTransitionType.CROSSFADE)
         self.main_stack.set_transition_duration(150)
@@ -223,6 +321,8 @@ class MainWindow:
         self.window.connect("destroy", self.quit)
         self.window.connect("key-press-event", self.on_keypress)
         self.window.connect("button-press-event", self.on_buttonpress)
+        if SHOW_TIMING:
+            self.first_draw_id = self.window.connect_after("draw", self.on_first_draw)
         self.window.show()
 
         self.builder.connect_signals(self)
@@ -246,6 +346,10 @@ class MainWindow:
                 print "Failed to load module %s" % module
                 traceback.print_exc()
 
+        for entry in manifest:
+            sidePage = LazySidePage(entry, self.content_box)
+            self.unsortedSidePages.append((sidePage, sidePage.mod_id, sidePage.category))
+
         for item in CONTROL_CENTER_MODULES:
             ccmodule = SettingsWidgets.CCModule(item[0], item[1], item[2], item[3], item[4], self.content_box)
             if ccmodule.process(self.c_manager):
@@ -274,8 +378,8 @@ class MainWindow:
         self.storeFilter = {}
         for sidepage in self.sidePages:
             sp, sp_id, sp_cat = sidepage
-            if not self.store.has_key(sp_cat):  #       Label         Icon          sidePage     Category
-                self.store[sidepage[2]] = Gtk.ListStore(str,          str,    object,     str)
+            if not self.store.has_key(sp_cat):  #       Label         Icon          sidePage     Category    Search key    Id
+                self.store[sidepage[2]] = Gtk.ListStore(str,          str,    object,     str,        str,          str)
                 for category in CATEGORIES:
                     if category["id"] == sp_cat:
                         category["show"] = True
@@ -284,7 +388,7 @@ class MainWindow:
             name = unicode(sp.name,'utf-8')
             if len(name) > 30:
                 name = "%s..." % name[:30]
-            sidePagesIters[sp_id] = (self.store[sp_cat].append([name, sp.icon, sp, sp_cat]), sp_cat)
+            sidePagesIters[sp_id] = (self.store[sp_cat].append([name, sp.icon, sp, sp_cat, self.get_search_key(sp), sp_id]), sp_cat)
 
         self.min_label_length = 0
         self.min_pix_length = 0
@@ -324,6 +428,12 @@ class MainWindow:
         else:
             self.search_entry.grab_focus()
 
+    def on_first_draw(self, widget, cr):
+        # Only connected when SHOW_TIMING is set
+        widget.disconnect(self.first_draw_id)
+        print 'first frame took %0.3f ms' % ((time.time() - STARTUP_TIME) * 1000.0)
+        return False
+
     def on_keypress(self, widget, event):
         grab = False
         device = Gtk.get_current_event_device()
@@ -348,41 +458,52 @@ class MainWindow:
         self.bar_heights = h
 
     def onSearchTextChanged(self, widget):
-        self.displayCategories()
+        self.search_text = SettingsWidgets.fold_search_text(self.search_entry.get_text())
+        # Very short queries would match a setting in nearly every module
+        if len(self.search_text) >= MIN_SETTING_SEARCH_LENGTH:
+            self.setting_matches = self.settings_index.search(self.search_text)
+        else:
+            self.setting_matches = {}
+        self.refilterCategories()
 
     def onClearSearchBox(self, widget, position, event):
         if position == Gtk.EntryIconPosition.SECONDARY:
             self.search_entry.set_text("")
 
-    def strip_accents(self, text):
-        try:
-            text = unicode(text, 'utf-8')
-        except NameError:
-            # unicode is default in Python 3
-            pass
-        text = unicodedata.normalize('NFD', text)
-        text = text.encode('ascii', 'ignore')
-        text = text.decode("utf-8")
-        return str(text)
+    def get_search_key(self, sidePage):
+        # Folded once here so that filtering is a plain substring test per keystroke
+        return "%s\n%s" % (SettingsWidgets.fold_search_text(sidePage.name),
+                            SettingsWidgets.fold_search_text(sidePage.keywords))
 
     def filter_visible_function(self, model, iter, user_data = None):
-        sidePage = model.get_value(iter, 2)
-        text = self.strip_accents(self.search_entry.get_text().lower())
-        if self.strip_accents(sidePage.name.lower()).find(text) > -1 or \
-           self.strip_accents(sidePage.keywords.lower()).find(text) > -1:
-            return True
-        else:
-            return False
+        return self.search_text in model.get_value(iter, 4) or model.get_value(iter, 5) in self.setting_matches
 
     def displayCategories(self):
         widgets = self.side_view_container.get_children()
         for widget in widgets:
             widget.destroy()
-        self.first_category_done = False # This is just to prevent an extra separator showing up before the first category
+        self.category_widgets = {}
         for category in CATEGORIES:
             if category["show"] is True:
                 self.prepCategory(category)
         self.side_view_container.show_all()
+        self.refilterCategories()
+
+    def refilterCategories(self):
+        # The category widgets are built once, searching only refilters them
+        # and hides the categories left without any match
+        first_category = True
+        for category in CATEGORIES:
+            if category["id"] not in self.category_widgets:
+                continue
+            self.storeFilter[category["id"]].refilter()
+            visible = self.anyVisibleInCategory(category)
+            separator, header, view = self.category_widgets[category["id"]]
+            separator.set_visible(visible and not first_category)
+            header.set_visible(visible)
+            view.set_visible(visible)
+            if visible:
+                first_category = False
 
     def get_label_min_width(self, model):
         min_width_chars = 0
@@ -408,12 +529,8 @@ class MainWindow:
             cell.set_property('surface', wrapper.surface)
 
     def prepCategory(self, category):
-        self.storeFilter[category["id"]].refilter()
-        if not self.anyVisibleInCategory(category):
-            return
-        if self.first_category_done:
-            widget = Gtk.Separator.new(Gtk.Orientation.HORIZONTAL)
-            self.side_view_container.pack_start(widget, False, False, 10)
+        separator = Gtk.Separator.new(Gtk.Orientation.HORIZONTAL)
+        self.side_view_container.pack_start(separator, False, False, 10)
 
         box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 4)
         img = Gtk.Image.new_from_icon_name(category["icon"], Gtk.IconSize.BUTTON)
@@ -449,7 +566,13 @@ class MainWindow:
 
         self.side_view[category["id"]] = widget
         self.side_view_container.pack_start(self.side_view[category["id"]], False, False, 0)
-        self.first_category_done = True
+        self.category_widgets[category["id"]] = (separator, box, widget)
+        # The header contents are shown now, since show_all() stops at the
+        # header itself
+        box.show_all()
+        for widget in self.category_widgets[category["id"]]:
+            # Their visibility is managed by refilterCategories()
+            widget.set_no_show_all(True)
         self.side_view[category["id"]].connect("item-activated", self.side_view_nav, category["id"])
         self.side_view[category["id"]].connect("button-release-event", self.button_press, category["id"])
         self.side_view[category["id"]].connect("keynav-failed", self.on_keynav_failed, category["id"])
@@ -554,14 +677,7 @@ class MainWindow:
             self.side_view_nav(widget, None, category)
 
     def anyVisibleInCategory(self, category):
-        id = category["id"]
-        iter = self.storeFilter[id].get_iter_first()
-        visible = False
-        while iter is not None:
-            cat = self.storeFilter[id].get_value(iter, 3)
-            visible = cat == category["id"]
-            iter = self.storeFilter[id].iter_next(iter)
-        return visible
+        return self.storeFilter[category["id"]].iter_n_children(None) > 0
 
     def setParentRefs (self, mod):
         try:
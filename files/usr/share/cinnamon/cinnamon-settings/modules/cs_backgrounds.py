@@ -2,26 +2,24 @@
 
 import sys
 import os
-import imtools
 import gettext
-import thread
 import subprocess
 import tempfile
 import locale
-import time
-import hashlib
 import mimetypes
-import pickle
-from io import BytesIO
+import threading
+import atexit
 from xml.etree import ElementTree
 
-from PIL import Image
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gio, Gtk, GObject, Gdk, Pango, GLib
 
 sys.path.append('/usr/share/cinnamon/cinnamon-settings/bin')
 from GSettingsWidgets import *
+from WorkQueue import WorkQueue, JobGroup, PRIORITY_DEFAULT, PRIORITY_LOW
+from ThumbnailStore import ThumbnailStore
+from Thumbnailer import ThumbnailerPool, get_n_cpus
 
 gettext.install("cinnamon", "/usr/share/locale")
 
@@ -50,48 +48,6 @@ BACKGROUND_COLLECTION_TYPE_XML = "xml"
 
 (STORE_IS_SEPARATOR, STORE_ICON, STORE_NAME, STORE_PATH, STORE_TYPE) = range(5)
 
-# EXIF utility functions (source: http://stackoverflow.com/questions/4228530/pil-thumbnail-is-rotating-my-image)
-def flip_horizontal(im): return im.transpose(Image.FLIP_LEFT_RIGHT)
-def flip_vertical(im): return im.transpose(Image.FLIP_TOP_BOTTOM)
-def rotate_180(im): return im.transpose(Image.ROTATE_180)
-def rotate_90(im): return im.transpose(Image.ROTATE_90)
-def rotate_270(im): return im.transpose(Image.ROTATE_270)
-def transpose(im): return rotate_90(flip_horizontal(im))
-def transverse(im): return rotate_90(flip_vertical(im))
-orientation_funcs = [None,
-                 lambda x: x,
-                 flip_horizontal,
-                 rotate_180,
-                 flip_vertical,
-                 transpose,
-                 rotate_270,
-                 transverse,
-                 rotate_90
-                ]
-def apply_orientation(im):
-    """
-    Extract the oritentation EXIF tag from the image, which should be a PIL Image instance,
-    and if there is an orientation tag that would rotate the image, apply that rotation to
-    the Image instance given to do an in-place rotation.
-
-    :param Image im: Image instance to inspect
-    :return: A possibly transposed image instance
-    """
-
-    try:
-        kOrientationEXIFTag = 0x0112
-        if hasattr(im, '_getexif'): # only present in JPEGs
-            e = im._getexif()       # returns None if no EXIF data
-            if e is not None:
-                #log.info('EXIF data found: %r', e)
-                orientation = e[kOrientationEXIFTag]
-                f = orientation_funcs[orientation]
-                return f(im)
-    except:
-        # We'd be here with an invalid orientation value or some random error?
-        pass # log.exception("Error applying EXIF Orientation tag")
-    return im
-
 class Module:
     name = "backgrounds"
     category = "appear"
@@ -521,88 +477,71 @@ class Module:
         self.secondary_color_revealer.set_reveal_child(show)
 
 
+def is_image(filename):
+    mimetype = mimetypes.guess_type(filename)[0]
+    return mimetype is not None and mimetype.startswith("image/")
+
 class PixCache(object):
 
     def __init__(self):
         self._data = {}
+        self._lock = threading.Lock()
+        self._store = None
+        self._thumbnailer = None
+        # Thumbnails don't wait behind other background work, each of
+        # these threads hands one picture at a time to a helper process
+        self.queue = WorkQueue(max_threads=get_n_cpus())
+
+    def start(self):
+        # Has to be called from the main thread before any other thread uses
+        # the cache. Thumbnails are made by helper processes, one per core.
+        if self._store is not None:
+            return
+        self._store = ThumbnailStore()
+        self._thumbnailer = ThumbnailerPool()
+        if not os.path.exists(self._store.index_file):
+            cleanup = JobGroup()
+            cleanup.push(self._store.remove_legacy_files, (), PRIORITY_LOW)
+            cleanup.close()
+        # The index is also saved whenever a batch of thumbnails is done or
+        # cancelled, this covers closing the window while one is running
+        atexit.register(self.save)
+        atexit.register(self._thumbnailer.close)
 
     def get_pix(self, filename, size=None):
-        if filename is None:
-            return None
-        mimetype = mimetypes.guess_type(filename)[0]
-        if mimetype is None or not mimetype.startswith("image/"):
+        if filename is None or not is_image(filename):
             return None
 
-        if filename not in self._data:
-            self._data[filename] = {}
-        if size in self._data[filename]:
-            pix = self._data[filename][size]
-        else:
-            try:
-                h = hashlib.sha1(('%f%s' % (os.path.getmtime(filename), filename)).encode()).hexdigest()
-                tmp_cache_path = GLib.get_user_cache_dir() + '/cs_backgrounds/'
-                if not os.path.exists(tmp_cache_path):
-                    os.mkdir(tmp_cache_path)
-                cache_filename = tmp_cache_path + h + "v2"
-
-                if os.path.exists(cache_filename):
-                    # load from disk cache
-                    try:
-                        with open(cache_filename, "r") as cache_file:
-                            pix = pickle.load(cache_file)
-                        tmp_img = Image.open(BytesIO(pix[0]))
-                        pix[0] = self._image_to_pixbuf(tmp_img)
-                    except Exception, detail:
-                        print "Failed to load cache file: %s: %s" % (cache_filename, detail)
-                        pix = None
+        with self._lock:
+            pix = self._data.get(filename, {}).get(size)
+        if pix is not None:
+            return pix
 
-                else:
-                    if mimetype == "image/svg+xml":
-                        # rasterize svg with Gdk-Pixbuf and convert to PIL Image
-                        tmp_pix = GdkPixbuf.Pixbuf.new_from_file(filename)
-                        mode = "RGBA" if tmp_pix.props.has_alpha else "RGB"
-                        img = Image.frombytes(mode, (tmp_pix.props.width, tmp_pix.props.height),
-                                              tmp_pix.read_pixel_bytes().get_data(), "raw",
-                                              mode, tmp_pix.props.rowstride)
-                    else:
-                        img = Image.open(filename)
-                        img = apply_orientation(img)
-
-                    # generate thumbnail
-                    (width, height) = img.size
-                    if img.mode != "RGB":
-                        if img.mode == "RGBA":
-                            bg_img = Image.new("RGBA", img.size, (255,255,255,255))
-                            img = Image.alpha_composite(bg_img, img)
-                        img = img.convert("RGB")
-                    if size:
-                        img.thumbnail((size, size), Image.ANTIALIAS)
-                    img = imtools.round_image(img, {}, False, None, 3, 255)
-                    img = imtools.drop_shadow(img, 4, 4, background_color=(255, 255, 255, 0),
-                                              shadow_color=0x444444, border=8, shadow_blur=3,
-                                              force_background_color=False, cache=None)
-
-                    # save to disk cache
-                    try:
-                        png_bytes = BytesIO()
-                        img.save(png_bytes, "png")
-                        with open(cache_filename, "w") as cache_file:
-                            pickle.dump([png_bytes.getvalue(), width, height], cache_file, 2)
-                    except Exception, detail:
-                        print "Failed to save cache file: %s: %s" % (cache_filename, detail)
-
-                    pix = [self._image_to_pixbuf(img), width, height]
-            except Exception, detail:
-                print "Failed to convert %s: %s" % (filename, detail)
-                pix = None
-            if pix:
-                self._data[filename][size] = pix
+        try:
+            # A hit in the store is a slice of the mapped data file, no decoding needed
+            thumbnail = self._store.lookup(filename, size)
+            if thumbnail is None:
+                mtime = os.path.getmtime(filename)
+                img_bytes, w, h, width, height = self._thumbnailer.make_thumbnail(filename, size)
+                self._store.add(filename, mtime, size, img_bytes, w, h, [width, height])
+            else:
+                img_bytes, w, h, (width, height) = thumbnail
+            pix = [self._bytes_to_pixbuf(img_bytes, w, h), width, height]
+        except Exception, detail:
+            print "Failed to convert %s: %s" % (filename, detail)
+            return None
+
+        with self._lock:
+            self._data.setdefault(filename, {})[size] = pix
         return pix
 
-    # Convert RGBA PIL Image to Pixbuf
-    def _image_to_pixbuf(self, img):
-        [w, h] = img.size
-        return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(img.tobytes()),
+    def save(self):
+        if self._store is not None:
+            self._store.save()
+
+    # Convert RGBA bytes to Pixbuf
+    def _bytes_to_pixbuf(self, img_bytes, w, h):
+        return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(img_bytes),
                                                GdkPixbuf.Colorspace.RGB,
                                                True, 8, w, h,
                                                w * 4)
@@ -615,7 +554,8 @@ class ThreadedIconView(Gtk.IconView):
     def __init__(self):
         Gtk.IconView.__init__(self)
         self.set_item_width(BACKGROUND_ICONS_SIZE * 1.1)
-        self._model = Gtk.ListStore(object, GdkPixbuf.Pixbuf, str, str)
+        # The last column holds the job loading the row's thumbnail
+        self._model = Gtk.ListStore(object, GdkPixbuf.Pixbuf, str, str, object)
         self._model_filter = self._model.filter_new()
         self._model_filter.set_visible_func(self.visible_func)
         self.set_model(self._model_filter)
@@ -634,14 +574,9 @@ class ThreadedIconView(Gtk.IconView):
         self.add_attribute(text_renderer, "markup", 2)
         text_renderer.set_property("alignment", Pango.Alignment.CENTER)
 
-        self._loading_queue = []
-        self._loading_queue_lock = thread.allocate_lock()
-
-        self._loading_lock = thread.allocate_lock()
-        self._loading = False
-
-        self._loaded_data = []
-        self._loaded_data_lock = thread.allocate_lock()
+        self._loading_jobs = JobGroup(PIX_CACHE.queue, on_finished=PIX_CACHE.save)
+        self._vadjustment = None
+        self.connect("notify::vadjustment", self._on_vadjustment_changed)
 
     def visible_func(self, model, iter, data=None):
         item_path = model.get_value(iter, 3)
@@ -650,90 +585,80 @@ class ThreadedIconView(Gtk.IconView):
     def set_pictures_list(self, pictures_list, path=None):
         self.clear()
         self.current_path = path
+        PIX_CACHE.start()
         for i in pictures_list:
             self.add_picture(i, path)
+        self._loading_jobs.close()
+        GLib.idle_add(self._prioritize_visible)
 
     def clear(self):
-        self._loading_queue_lock.acquire()
-        self._loading_queue = []
-        self._loading_queue_lock.release()
-
-        self._loading_lock.acquire()
-        is_loading = self._loading
-        self._loading_lock.release()
-        while is_loading:
-            time.sleep(0.1)
-            self._loading_lock.acquire()
-            is_loading = self._loading
-            self._loading_lock.release()
-
+        self._loading_jobs.cancel()
+        self._loading_jobs = JobGroup(PIX_CACHE.queue, on_finished=PIX_CACHE.save)
         self._model.clear()
 
     def add_picture(self, picture, path):
-        self._loading_queue_lock.acquire()
-        self._loading_queue.append(picture)
-        self._loading_queue_lock.release()
-
-        start_loading = False
-        self._loading_lock.acquire()
-        if not self._loading:
-            self._loading = True
-            start_loading = True
-        self._loading_lock.release()
-
-        if start_loading:
-            GLib.timeout_add(100, self._check_loading_progress)
-            thread.start_new_thread(self._do_load, (path,))
-
-    def _check_loading_progress(self):
-        self._loading_lock.acquire()
-        self._loaded_data_lock.acquire()
-        res = self._loading
-        to_load = []
-        while len(self._loaded_data) > 0:
-            to_load.append(self._loaded_data[0])
-            self._loaded_data = self._loaded_data[1:]
-        self._loading_lock.release()
-        self._loaded_data_lock.release()
-
-        for i in to_load:
-            self._model.append(i)
-
-        return res
-
-    def _do_load(self, path):
-        finished = False
-        while not finished:
-            self._loading_queue_lock.acquire()
-            if len(self._loading_queue) == 0:
-                finished = True
-            else:
-                to_load = self._loading_queue[0]
-                self._loading_queue = self._loading_queue[1:]
-            self._loading_queue_lock.release()
-            if not finished:
-                filename = to_load["filename"]
-                if filename.endswith(".xml"):
-                    filename = self.getFirstFileFromBackgroundXml(filename)
-                pix = PIX_CACHE.get_pix(filename, BACKGROUND_ICONS_SIZE)
-                if pix != None:
-                    if "name" in to_load:
-                        label = to_load["name"]
-                    else:
-                        label = os.path.split(to_load["filename"])[1]
-                    if "artist" in to_load:
-                        artist = "%s\n" % to_load["artist"]
-                    else:
-                        artist = ""
-                    dimensions = "%dx%d" % (pix[1], pix[2])
-
-                    self._loaded_data_lock.acquire()
-                    self._loaded_data.append((to_load, pix[0], "<b>%s</b>\n<sub>%s%s</sub>" % (label, artist, dimensions), path))
-                    self._loaded_data_lock.release()
-
-        self._loading_lock.acquire()
-        self._loading = False
-        self._loading_lock.release()
+        filename = picture["filename"]
+        if not filename.endswith(".xml") and not is_image(filename):
+            return
+
+        # Rows are added in display order right away, their thumbnails are
+        # filled in as the background jobs make them
+        iter = self._model.append((picture, None, self._get_markup(picture), path, None))
+        row = Gtk.TreeRowReference.new(self._model, self._model.get_path(iter))
+        job = self._loading_jobs.push(self._do_load, (picture,), PRIORITY_LOW,
+                                      lambda pix, row=row: self._on_picture_loaded(row, pix))
+        self._model.set_value(iter, 4, job)
+
+    def _get_markup(self, to_load, pix=None):
+        if "name" in to_load:
+            label = to_load["name"]
+        else:
+            label = os.path.split(to_load["filename"])[1]
+        if pix is None:
+            return "<b>%s</b>" % label
+        if "artist" in to_load:
+            artist = "%s\n" % to_load["artist"]
+        else:
+            artist = ""
+        dimensions = "%dx%d" % (pix[1], pix[2])
+        return "<b>%s</b>\n<sub>%s%s</sub>" % (label, artist, dimensions)
+
+    def _on_vadjustment_changed(self, *args):
+        if self._vadjustment is not None:
+            self._vadjustment.disconnect_by_func(self._prioritize_visible)
+        self._vadjustment = self.get_vadjustment()
+        if self._vadjustment is not None:
+            self._vadjustment.connect("value-changed", self._prioritize_visible)
+
+    def _prioritize_visible(self, *args):
+        # Move the thumbnails scrolled into view ahead of the rest
+        visible_range = self.get_visible_range()
+        if visible_range is None:
+            return False
+        start, end = visible_range
+
+        for index in range(start.get_indices()[0], end.get_indices()[0] + 1):
+            job = self._model_filter[index][4]
+            if job is not None:
+                self._loading_jobs.queue.set_priority(job, PRIORITY_DEFAULT)
+        return False
+
+    def _on_picture_loaded(self, row, pix):
+        if not row.valid():
+            return
+        iter = self._model.get_iter(row.get_path())
+        if pix is None:
+            self._model.remove(iter)
+            return
+        self._model.set_value(iter, 1, pix[0])
+        self._model.set_value(iter, 2, self._get_markup(self._model.get_value(iter, 0), pix))
+        self._model.set_value(iter, 4, None)
+
+    def _do_load(self, to_load):
+        filename = to_load["filename"]
+        if filename.endswith(".xml"):
+            filename = self.getFirstFileFromBackgroundXml(filename)
+        return PIX_CACHE.get_pix(filename, BACKGROUND_ICONS_SIZE)
 
     def getFirstFileFromBackgroundXml(self, filename):
         try:
@@ -2,6 +2,7 @@
 
 from GSettingsWidgets import *
 from gi.repository import *
+import AppIndex
 
 PREF_MEDIA_AUTORUN_NEVER = "autorun-never"
 PREF_MEDIA_AUTORUN_X_CONTENT_START_APP = "autorun-x-content-start-app"
@@ -12,6 +13,10 @@ CUSTOM_ITEM_ASK = "cc-item-ask"
 CUSTOM_ITEM_DO_NOTHING = "cc-item-do-nothing"
 CUSTOM_ITEM_OPEN_FOLDER = "cc-item-open-folder"
 
+ASSOCIATIONS_DEFAULT_GROUP = "Default Applications"
+ASSOCIATIONS_ADDED_GROUP = "Added Associations"
+ASSOCIATIONS_REMOVED_GROUP = "Removed Associations"
+
 MEDIA_HANDLING_SCHEMA = "org.cinnamon.desktop.media-handling"
 TERMINAL_SCHEMA = "org.cinnamon.desktop.default-applications.terminal"
 
@@ -196,6 +201,78 @@ class MnemonicLabel(Gtk.Label):
         self.set_alignment(0.0, 0.5)
         self.set_line_wrap(True)
 
+class MimeAppsWriter:
+    """ Makes an application the default for many content types at once.
+
+    set_as_default_for_type() rewrites mimeapps.list for every type, and each
+    rewrite makes every running GIO client reload its associations. Here the
+    changes are made to a single copy of the file, which is then replaced in
+    one go, so there is one write and one change notification, and only when
+    something actually changed.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(GLib.get_user_config_dir(), "mimeapps.list")
+
+    def set_default(self, info, content_types):
+        # Returns the content types that could be set
+        app_id = info.get_id()
+        if app_id is None:
+            return [t for t in content_types if info.set_as_default_for_type(t)]
+
+        keyfile = GLib.KeyFile()
+        try:
+            keyfile.load_from_file(self.path, GLib.KeyFileFlags.KEEP_COMMENTS | GLib.KeyFileFlags.KEEP_TRANSLATIONS)
+        except GLib.Error as e:
+            if e.domain != GLib.quark_to_string(GLib.file_error_quark()) or e.code != GLib.FileError.NOENT:
+                # Rewriting a file that can't be parsed would lose whatever is in it
+                print "Not touching %s: %s" % (self.path, e.message)
+                return []
+
+        changed = False
+        for t in content_types:
+            # GIO writes the defaults as lists, the first one that is
+            # installed wins; the others stay as fallbacks
+            try:
+                defaults = keyfile.get_string_list(ASSOCIATIONS_DEFAULT_GROUP, t)
+            except GLib.Error:
+                defaults = []
+            if len(defaults) == 0 or defaults[0] != app_id:
+                keyfile.set_string_list(ASSOCIATIONS_DEFAULT_GROUP, t, [app_id] + [x for x in defaults if x != app_id])
+                changed = True
+
+            # Like GIO does, the default also goes first in the added
+            # associations, so it shows up as recommended for the type
+            try:
+                added = keyfile.get_string_list(ASSOCIATIONS_ADDED_GROUP, t)
+            except GLib.Error:
+                added = []
+            if len(added) == 0 or added[0] != app_id:
+                keyfile.set_string_list(ASSOCIATIONS_ADDED_GROUP, t, [app_id] + [x for x in added if x != app_id])
+                changed = True
+
+            # An application the user removed for the type is brought back
+            try:
+                removed = keyfile.get_string_list(ASSOCIATIONS_REMOVED_GROUP, t)
+            except GLib.Error:
+                removed = []
+            if app_id in removed:
+                removed = [x for x in removed if x != app_id]
+                if len(removed) > 0:
+                    keyfile.set_string_list(ASSOCIATIONS_REMOVED_GROUP, t, removed)
+                else:
+                    keyfile.remove_key(ASSOCIATIONS_REMOVED_GROUP, t)
+                changed = True
+
+        if changed:
+            try:
+                GLib.file_set_contents(self.path, keyfile.to_data()[0])
+            except GLib.Error as e:
+                print "Failed to write %s: %s" % (self.path, e.message)
+                return []
+
+        return list(content_types)
+
 class DefaultAppChooserButton(Gtk.AppChooserButton):
     def __init__(self, content_type, gen_content_type):
         super(DefaultAppChooserButton, self).__init__(content_type=content_type)
@@ -220,53 +297,45 @@ class DefaultAppChooserButton(Gtk.AppChooserButton):
             if supported_mimetypes is not None:
                 for t in sorted(supported_mimetypes):
                     if t.startswith(self.generic_content_type):
-                        if info.set_as_default_for_type (t):
-                            print "  Set as default for supported %s" % t
-                            set_mimes.append(t)
-                        else:
-                            print "  Failed to set as default application for '%s'" % t
+                        set_mimes.append(t)
 
             # Also assign mimes hardcoded in the mimetypes hashtable
             if hardcoded_mimetypes is not None:
                 for t in sorted(hardcoded_mimetypes):
                     if t not in set_mimes:
-                        if info.set_as_default_for_type (t):
-                            print "  Set as default for hardcoded %s" % t
-                        else:
-                            print "  Failed to set as default application for '%s'" % t
+                        set_mimes.append(t)
 
             #Web
-            if self.content_type == "x-scheme-handler/http":
-                if info.set_as_default_for_type ("x-scheme-handler/https") == False:
-                    print "  Failed to set '%s' as the default application for '%s'" % (info.get_name(), "x-scheme-handler/https")
+            if self.content_type == "x-scheme-handler/http" and "x-scheme-handler/https" not in set_mimes:
+                set_mimes.append("x-scheme-handler/https")
+
+            done = MimeAppsWriter().set_default(info, set_mimes)
+            for t in set_mimes:
+                if t in done:
+                    print "  Set as default for %s" % t
+                else:
+                    print "  Failed to set '%s' as the default application for '%s'" % (info.get_name(), t)
 
 class DefaultTerminalButton(Gtk.AppChooserButton): #TODO: See if we can get this to change the x-terminal-emulator default to allow it to be a more global change rather then just cinnamon/nemo
     def __init__(self):
         super(DefaultTerminalButton, self).__init__()
         self.connect("changed", self.onChanged)
 
-        apps = Gio.app_info_get_all()
-        self.this_item = []
         self.active_items = []
         self.settings = Gio.Settings.new(TERMINAL_SCHEMA)
         self.key_value = self.settings.get_string("exec")
-        count_up = 0
-
-        while (self.this_item is not None and count_up < len(apps)):
-            self.this_item = apps[count_up]
-            cat_val = Gio.DesktopAppInfo.get_categories(self.this_item)
-            exec_val = Gio.DesktopAppInfo.get_string(self.this_item, "Exec")
-            name_val = Gio.DesktopAppInfo.get_string(self.this_item, "Name")
-            icon_val = Gio.DesktopAppInfo.get_string(self.this_item, "Icon")
-            #terminals don't have mime types, so we check for "TerminalEmulator" under the "Category" key in desktop files
-            if (cat_val is not None and "TerminalEmulator" in cat_val):
-                #this crazy if statement makes sure remaining desktop file info is not empty, then prevents root terminals from showing, then prevents repeating terminals from trying to being added which leave a blank space and Gtk-WARNING's
-                if (exec_val is not None and name_val is not None and icon_val is not None and not "gksu" in exec_val and exec_val not in self.active_items):
-                    self.append_custom_item(exec_val, name_val, Gio.ThemedIcon.new(icon_val))
-                    self.active_items.append(exec_val)
-                    if (self.key_value == exec_val):
-                        self.set_active_custom_item(self.key_value)
-            count_up += 1
+
+        #terminals don't have mime types, so we look for "TerminalEmulator" under the "Category" key in desktop files
+        for info in AppIndex.get_default().get_by_category("TerminalEmulator"):
+            exec_val = info.get_string("Exec")
+            name_val = info.get_string("Name")
+            icon_val = info.get_string("Icon")
+            #this crazy if statement makes sure remaining desktop file info is not empty, then prevents root terminals from showing, then prevents repeating terminals from trying to being added which leave a blank space and Gtk-WARNING's
+            if (exec_val is not None and name_val is not None and icon_val is not None and not "gksu" in exec_val and exec_val not in self.active_items):
+                self.append_custom_item(exec_val, name_val, Gio.ThemedIcon.new(icon_val))
+                self.active_items.append(exec_val)
+                if (self.key_value == exec_val):
+                    self.set_active_custom_item(self.key_value)
 
     def onChanged(self, button):
         index_num = button.get_active()
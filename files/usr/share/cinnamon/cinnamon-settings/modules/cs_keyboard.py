@@ -9,6 +9,7 @@ gi.require_version("Gtk", "3.0")
 from gi.repository import Gio, Gtk, GObject, Gdk
 
 from KeybindingWidgets import CellRendererKeybinding
+from KeybindingIndex import KeybindingIndex
 from GSettingsWidgets import *
 
 gettext.install("cinnamon", "/usr/share/locale")
@@ -303,8 +304,11 @@ class Module:
             self.remove_custom_button = Gtk.Button.new_with_label(_("Remove custom shortcut"))
             self.remove_custom_button.connect('clicked', self.onRemoveCustomButtonClicked)
             self.remove_custom_button.set_property('sensitive', False)
+            self.conflicts_button = Gtk.Button.new_with_label(_("Show conflicts"))
+            self.conflicts_button.connect('clicked', self.onShowConflictsButtonClicked)
             buttonbox.pack_start(self.add_custom_button, False, False, 2)
             buttonbox.pack_start(self.remove_custom_button, False, False, 2)
+            buttonbox.pack_start(self.conflicts_button, False, False, 2)
 
             right_vbox.pack_end(buttonbox, False, False, 2)
 
@@ -354,6 +358,7 @@ class Module:
             self.entry_tree.set_tooltip_text("%s\n%s\n%s" % (_("Click to set a new accelerator key."), _("Press Escape or click again to cancel the operation."), _("Press Backspace to clear the existing keybinding.")))
 
             self.main_store = []
+            self.kb_index = KeybindingIndex()
 
             for cat in CATEGORIES:
                 self.main_store.append(KeyBindingCategory(cat[0], cat[1], cat[2], cat[3]))
@@ -361,7 +366,9 @@ class Module:
             for binding in KEYBINDINGS:
                 for category in self.main_store:
                     if category.int_name == binding[3]:
-                        category.add(KeyBinding(binding[0], binding[1], binding[2], binding[3]))
+                        keybinding = KeyBinding(binding[0], binding[1], binding[2], binding[3])
+                        category.add(keybinding)
+                        self.kb_index.add(keybinding)
 
             cat_iters = {}
             longest_cat_label = " "
@@ -426,6 +433,8 @@ class Module:
     def loadCustoms(self):
         for category in self.main_store:
             if category.int_name is "custom":
+                for keybinding in category.keybindings:
+                    self.kb_index.remove(keybinding)
                 category.clear()
 
         parent = Gio.Settings.new(CUSTOM_KEYS_PARENT_SCHEMA)
@@ -442,6 +451,7 @@ class Module:
             for category in self.main_store:
                 if category.int_name is "custom":
                     category.add(custom_kb)
+            self.kb_index.add(custom_kb)
 
     def onKeyBindingChanged(self, tree):
         self.entry_store.clear()
@@ -461,34 +471,30 @@ class Module:
             current_keybinding = keybindings[kb_iter][1]
 
         # Check for duplicates
-        for category in self.main_store:
-            for keybinding in category.keybindings:
-                for entry in keybinding.entries:
-                    found = False
-                    if accel_string.lower() == entry.lower():
-                        found = True
-                    elif accel_string.replace("<Primary>", "<Control>").lower() == entry.lower():
-                        found = True
-
-                    if found and keybinding.label != current_keybinding.label:
-                        dialog = Gtk.MessageDialog(None,
-                                    Gtk.DialogFlags.DESTROY_WITH_PARENT,
-                                    Gtk.MessageType.QUESTION,
-                                    Gtk.ButtonsType.YES_NO,
-                                    None)
-                        dialog.set_default_size(400, 200)
-                        msg = _("This key combination, <b>%(combination)s</b> is currently in use by <b>%(old)s</b>.  ")
-                        msg += _("If you continue, the combination will be reassigned to <b>%(new)s</b>.\n\n")
-                        msg += _("Do you want to continue with this operation?")
-                        dialog.set_markup(msg % {'combination':accel_label, 'old':cgi.escape(keybinding.label), 'new':cgi.escape(current_keybinding.label)})
-                        dialog.show_all()
-                        response = dialog.run()
-                        dialog.destroy()
-                        if response == Gtk.ResponseType.YES:
-                            keybinding.setBinding(keybinding.entries.index(entry), None)
-                        elif response == Gtk.ResponseType.NO:
-                            return
+        for keybinding in self.kb_index.lookup(accel_string):
+            if keybinding is current_keybinding:
+                continue
+            dialog = Gtk.MessageDialog(None,
+                        Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                        Gtk.MessageType.QUESTION,
+                        Gtk.ButtonsType.YES_NO,
+                        None)
+            dialog.set_default_size(400, 200)
+            msg = _("This key combination, <b>%(combination)s</b> is currently in use by <b>%(old)s</b>.  ")
+            msg += _("If you continue, the combination will be reassigned to <b>%(new)s</b>.\n\n")
+            msg += _("Do you want to continue with this operation?")
+            dialog.set_markup(msg % {'combination':accel_label, 'old':cgi.escape(keybinding.label), 'new':cgi.escape(current_keybinding.label)})
+            dialog.show_all()
+            response = dialog.run()
+            dialog.destroy()
+            if response == Gtk.ResponseType.YES:
+                for index in self.kb_index.get_entry_indices(keybinding, accel_string):
+                    keybinding.setBinding(index, None)
+                self.kb_index.update(keybinding)
+            elif response == Gtk.ResponseType.NO:
+                return
         current_keybinding.setBinding(int(path), accel_string)
+        self.kb_index.update(current_keybinding)
         self.onKeyBindingChanged(self.kb_tree)
         self.entry_tree.get_selection().select_path(path)
 
@@ -498,6 +504,7 @@ class Module:
         if kb_iter:
             current_keybinding = keybindings[kb_iter][1]
         current_keybinding.setBinding(int(path), None)
+        self.kb_index.update(current_keybinding)
         self.onKeyBindingChanged(self.kb_tree)
         self.entry_tree.get_selection().select_path(path)
 
@@ -641,8 +648,29 @@ class Module:
 
     def onResetToDefault(self, popup, keybinding):
         keybinding.resetDefaults()
+        self.kb_index.update(keybinding)
         self.onKeyBindingChanged(self.kb_tree)
 
+    def onShowConflictsButtonClicked(self, button):
+        conflicts = self.kb_index.get_conflicts()
+        if len(conflicts) == 0:
+            msg = _("No key combination is used by more than one shortcut.")
+        else:
+            lines = []
+            for accel, keybindings in conflicts:
+                key, mods = Gtk.accelerator_parse(accel)
+                accel_label = Gtk.accelerator_get_label(key, mods) if key != 0 else accel
+                lines.append("<b>%s</b>: %s" % (cgi.escape(accel_label), cgi.escape(", ".join(keybinding.label for keybinding in keybindings))))
+            msg = "%s\n\n%s" % (_("These key combinations are used by more than one shortcut:"), "\n".join(lines))
+        dialog = Gtk.MessageDialog(None,
+                    Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                    Gtk.MessageType.INFO,
+                    Gtk.ButtonsType.CLOSE,
+                    None)
+        dialog.set_markup(msg)
+        dialog.run()
+        dialog.destroy()
+
 
 class KeyBindingCategory():
     def __init__(self, label, int_name, parent, icon):
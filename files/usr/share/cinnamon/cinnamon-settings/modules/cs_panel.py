@@ -10,6 +10,9 @@ from gi.repository import GLib, Gtk, Gdk
 from GSettingsWidgets import *
 
 
+# Pending edits are written out at most this often, in milliseconds
+PANEL_APPLY_DELAY = 100
+
 class Monitor:
     def __init__(self):
         self.top = -1
@@ -297,11 +300,120 @@ class Module:
         if self.panel_id:
             self.proxy.highlightPanel('(ib)', int(self.panel_id), False)
 
+class PanelSettingsStore(object):
+    """ The per-panel values of the panels-* keys, shared by all panel widgets.
+
+    Those keys are lists of "panel_id:value" strings. There is one Settings
+    object per schema, and the lists are parsed once and again only when
+    they change. Edits go to the Settings in delayed mode and are applied
+    together at most once every PANEL_APPLY_DELAY, counted from the first
+    pending edit, so changes made by several widgets end up as a single
+    write and a slider drag still moves the panel while it goes on. Watchers are only called when the value of their own panel
+    changed.
+    """
+
+    def __init__(self):
+        self.settings = {}
+        self.values = {}
+        self.watchers = {}
+        self.apply_id = 0
+
+    def get_settings(self, schema):
+        if schema not in self.settings:
+            settings = Gio.Settings.new(schema)
+            settings.delay()
+            settings.connect("changed", self.on_settings_changed, schema)
+            self.settings[schema] = settings
+        return self.settings[schema]
+
+    def get_values(self, schema, key):
+        # Returns [(panel_id, value)] in the order of the list
+        if (schema, key) not in self.values:
+            self.values[(schema, key)] = self.parse(self.get_settings(schema)[key])
+        return self.values[(schema, key)]
+
+    def parse(self, strings):
+        values = []
+        for string in strings:
+            panel_id, sep, value = string.partition(":")
+            values.append((panel_id, value))
+        return values
+
+    def get_value(self, schema, key, panel_id):
+        for pid, value in self.get_values(schema, key):
+            if pid == panel_id:
+                return value
+        return None
+
+    def set_value(self, schema, key, panel_id, new_value):
+        values = [(pid, new_value if pid == panel_id else value) for pid, value in self.get_values(schema, key)]
+        self.values[(schema, key)] = values
+        self.get_settings(schema)[key] = ["%s:%s" % (pid, value) for pid, value in values]
+
+        # The timer is not pushed back by later edits, a continuous drag
+        # would otherwise not be applied until it stops
+        if self.apply_id == 0:
+            self.apply_id = GLib.timeout_add(PANEL_APPLY_DELAY, self.on_apply_timeout)
+
+    def on_apply_timeout(self):
+        self.apply_id = 0
+        self.apply()
+        return False
+
+    def apply(self):
+        # Writes out the pending edits right away
+        if self.apply_id > 0:
+            GLib.source_remove(self.apply_id)
+            self.apply_id = 0
+        applied = False
+        for settings in self.settings.values():
+            if settings.get_has_unapplied():
+                settings.apply()
+                applied = True
+        return applied
+
+    def flush(self):
+        # Like apply(), and waits for the writes, for when the process may be about to exit
+        if self.apply():
+            Gio.Settings.sync()
+
+    def watch(self, schema, key, panel_id, callback):
+        self.get_values(schema, key)
+        self.watchers.setdefault((schema, key, panel_id), []).append(callback)
+
+    def unwatch(self, schema, key, panel_id, callback):
+        watchers = self.watchers.get((schema, key, panel_id), [])
+        if callback in watchers:
+            watchers.remove(callback)
+
+    def on_settings_changed(self, settings, key, schema):
+        if (schema, key) not in self.values:
+            return
+
+        old_values = dict(self.values[(schema, key)])
+        self.values[(schema, key)] = self.parse(settings[key])
+
+        # Our own edits were cached when they were made, so only changes
+        # from elsewhere reach the widgets
+        for panel_id, value in self.values[(schema, key)]:
+            if old_values.get(panel_id) != value:
+                for callback in list(self.watchers.get((schema, key, panel_id), [])):
+                    callback()
+
+_panel_settings_store = None
+
+def get_panel_settings_store():
+    global _panel_settings_store
+    if _panel_settings_store is None:
+        _panel_settings_store = PanelSettingsStore()
+    return _panel_settings_store
+
 class PanelWidgetBackend(object):
     def connect_to_settings(self, schema, key):
+        self.schema = schema
         self.key = key
-        self.settings = Gio.Settings.new(schema)
-        self.settings_changed_id = self.settings.connect("changed::"+self.key, self.on_setting_changed)
+        self.store = get_panel_settings_store()
+        self.store.watch(self.schema, self.key, self.panel_id, self.on_setting_changed)
         self.connect("destroy", self.on_destroy)
         self.on_setting_changed()
 
@@ -312,27 +424,20 @@ class PanelWidgetBackend(object):
             self.connect_widget_handlers()
 
     def set_value(self, value):
-        vals = self.settings[self.key]
-        newvals = []
-        for val in vals:
-            if val.split(":")[0] == self.panel_id:
-                newvals.append(self.panel_id + ":" + self.stringify(value))
-            else:
-                newvals.append(val)
-        self.settings[self.key] = newvals
+        self.store.set_value(self.schema, self.key, self.panel_id, self.stringify(value))
 
     def get_value(self):
-        vals = self.settings[self.key]
-        for val in vals:
-            [pid, value] = val.split(":")
-            if pid == self.panel_id:
-                return self.unstringify(value)
+        value = self.store.get_value(self.schema, self.key, self.panel_id)
+        if value is not None:
+            return self.unstringify(value)
 
     def stringify(self, value):
         return str(value)
 
     def on_destroy(self, *args):
-        self.settings.disconnect(self.settings_changed_id)
+        self.store.unwatch(self.schema, self.key, self.panel_id, self.on_setting_changed)
+        # Don't lose the last edit when the window is closed
+        self.store.flush()
 
 class PanelSwitch(Switch, PanelWidgetBackend):
     def __init__(self, label, schema, key, panel_id, *args, **kwargs):
@@ -1,7 +1,6 @@
 #!/usr/bin/python2
 
 import os, json, subprocess, re
-from xml.etree import ElementTree
 import gettext
 import signal
 
@@ -10,6 +9,14 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gdk, GLib, Pango
 
 from GSettingsWidgets import *
+from ScreensaverCatalog import ScreensaverCatalog
+
+# Previews that don't send their window id within this many seconds are given up
+PREVIEW_HANDSHAKE_TIMEOUT = 5
+
+# Minimum time between two preview launches, in milliseconds, so moving through
+# the list with the keyboard doesn't start a process for every row passed
+PREVIEW_SPAWN_INTERVAL = 300
 
 LOCK_DELAY_OPTIONS = [
     (0, _("Lock immediately")),
@@ -35,8 +42,6 @@ LOCK_INACTIVE_OPTIONS = [
     (3600, _("1 hour"))
 ]
 
-XSCREENSAVER_PATH = "/usr/share/xscreensaver/config/"
-
 
 def list_header_func(row, before, user_data):
     if before and not row.get_header():
@@ -184,6 +189,12 @@ class ScreensaverBox(Gtk.Box):
         self.webkit_executable = None
         self.xscreensaver_executable = None
         self.proc = None
+        self.preview_command = None
+        self.preview_cancellable = None
+        self.handshake_data = ""
+        self.handshake_timeout_id = 0
+        self.spawn_id = 0
+        self.last_spawn_time = 0
 
         self.current_name = self.settings.get_string("screensaver-name")
         if self.current_name == "webkit@cinnamon.org":
@@ -255,102 +266,48 @@ class ScreensaverBox(Gtk.Box):
         if self.current_name == "":
             self.list_box.select_row(row)
 
-        dirs = [os.path.expanduser("~/.local/share/cinnamon-screensaver/screensavers")] + \
-               [os.path.join(x, "cinnamon-screensaver/screensavers/") for x in GLib.get_system_data_dirs()]
-
-        things = []
-        for directory in dirs:
-            if not os.path.isdir(directory):
-                continue
-
-            things += [os.path.join(directory, x) for x in os.listdir(directory)]
-
-        for path in things:
-            if not os.path.isdir(path):
-                continue
-
-            # Recurse inside if it is webkit
-            if os.path.basename(path.rstrip('/')) == "webkit@cinnamon.org":
-                webkits = [os.path.join(path, x) for x in os.listdir(path)]
-
-                for theme in webkits:
-                    if os.path.basename(theme) == 'main':
-                        self.webkit_executable = theme
-                        continue
-
-                    if not os.path.isdir(theme):
-                        continue
-
-                    self.parse_dir(theme, path, "webkit")
-                continue
-
-            if os.path.basename(path.rstrip('/')) == "xscreensaver@cinnamon.org":
-                if os.path.exists(os.path.join(path, 'main')):
-                    self.xscreensaver_executable = os.path.join(path, 'main')
-
-                continue
-
-            self.parse_dir(path, path, "standalone")
-
-        if self.xscreensaver_executable is not None and os.path.exists(XSCREENSAVER_PATH):
-            xscreensavers = []
-            try:
-                gettext.install("xscreensaver", "/usr/share/locale")
-
-                for item in sorted(os.listdir(XSCREENSAVER_PATH)):
-                    if not item.endswith(".xml"):
-                        continue
-
-                    path = os.path.join(XSCREENSAVER_PATH, item)
-                    try:
-                        tree = ElementTree.parse(path);
-                        root = tree.getroot()
-
-                        name = root.attrib["name"]
-                        label = root.attrib["_label"]
-                        description = root.find("_description").text.strip()
-                        label = _(label)
-                        description = _(description)
-                        row = ScreensaverRow(name, label, description, XSCREENSAVER_PATH, "xscreensaver")
-                        xscreensavers.append(row)
-                    except Exception, detail:
-                        print "Unable to parse xscreensaver information at %s: %s" % (path, detail)
-
-                xscreensavers = sorted(xscreensavers, key=lambda x: x.name)
-                for xscreensaver in xscreensavers:
-                    self.add_row(xscreensaver)
-                    if self.current_name == "xscreensaver-" + xscreensaver.uuid:
-                        self.list_box.select_row(xscreensaver)
-                gettext.install("cinnamon", "/usr/share/locale")
-            except Exception, detail:
-                print "Unable to parse xscreensaver hacks: %s" % detail
-
-    def parse_dir(self, path, directory, ss_type):
-        try:
-            metadata = open(os.path.join(path, "metadata.json"), 'r').read()
-            data = json.loads(metadata)
+        # The rest is read in a thread, mostly from the catalog cache
+        ScreensaverCatalog().load(self.on_screensavers_found)
 
-            name = data["name"]
-            uuid = data["uuid"]
+    def on_screensavers_found(self, entries, executables):
+        if "webkit" in executables:
+            self.webkit_executable = executables["webkit"]
+        if "xscreensaver" in executables:
+            self.xscreensaver_executable = executables["xscreensaver"]
 
-            assert uuid == os.path.basename(path.rstrip('/'))
-
-            try:
-                description = data["description"]
-            except KeyError:
-                description = None
-            except ValueError:
-                description = None
-
-            row = ScreensaverRow(uuid, name, description, directory, ss_type)
+        for entry in entries:
+            row = ScreensaverRow(entry["uuid"], entry["name"], entry["description"] or "", entry["path"], entry["ss_type"])
+            row.show_all()
             self.add_row(row)
 
-            if self.current_name == uuid:
+            if entry["ss_type"] == "xscreensaver":
+                name = "xscreensaver-" + entry["uuid"]
+            else:
+                name = entry["uuid"]
+            if self.current_name == name:
                 self.list_box.select_row(row)
-        except:
-            print "Unable to parse screensaver information at %s" % path
+                # The default preview was shown until now
+                if self.preview_stack.get_mapped():
+                    self.on_row_activated(None, None)
+                    GLib.idle_add(self.idle_scroll_to_selection)
+
+        return False
 
     def kill_plug(self):
+        self.preview_command = None
+
+        if self.spawn_id > 0:
+            GLib.source_remove(self.spawn_id)
+            self.spawn_id = 0
+
+        if self.handshake_timeout_id > 0:
+            GLib.source_remove(self.handshake_timeout_id)
+            self.handshake_timeout_id = 0
+
+        if self.preview_cancellable is not None:
+            self.preview_cancellable.cancel()
+            self.preview_cancellable = None
+
         if not self.proc:
             return
 
@@ -365,8 +322,6 @@ class ScreensaverBox(Gtk.Box):
         if not row:
             return
 
-        self.kill_plug()
-
         uuid = row.uuid
         path = row.path
         ss_type = row.ss_type
@@ -383,6 +338,7 @@ class ScreensaverBox(Gtk.Box):
             self.settings.set_string('screensaver-name', uuid)
 
         if ss_type == 'default':
+            self.kill_plug()
             self.preview_stack.set_visible_child_name("default")
             return
 
@@ -395,24 +351,71 @@ class ScreensaverBox(Gtk.Box):
         else:
             command = [os.path.join(path, "main")]
 
-        GObject.idle_add(self.idle_spawn_plug, command)
+        self.show_preview(command)
+
+    def show_preview(self, command):
+        if command == self.preview_command:
+            # Reselecting the screensaver already shown keeps its preview
+            return
+
+        self.kill_plug()
+        self.preview_command = command
+
+        elapsed = (GLib.get_monotonic_time() - self.last_spawn_time) / 1000
+        if elapsed >= PREVIEW_SPAWN_INTERVAL:
+            self.spawn_plug()
+        else:
+            self.spawn_id = GLib.timeout_add(PREVIEW_SPAWN_INTERVAL - elapsed, self.spawn_plug)
+
+    def spawn_plug(self):
+        self.spawn_id = 0
+        self.last_spawn_time = GLib.get_monotonic_time()
 
-    def idle_spawn_plug(self, command):
         try:
-            self.proc = Gio.Subprocess.new(command, Gio.SubprocessFlags.STDOUT_PIPE | Gio.SubprocessFlags.STDERR_SILENCE)
+            self.proc = Gio.Subprocess.new(self.preview_command, Gio.SubprocessFlags.STDOUT_PIPE | Gio.SubprocessFlags.STDERR_SILENCE)
         except GLib.Error as e:
             print e.message
+            self.preview_command = None
+            return False
+
+        # The plug prints its window id once it is ready, which is waited for
+        # without blocking, and only for so long
+        self.preview_cancellable = Gio.Cancellable()
+        self.handshake_data = ""
+        self.handshake_timeout_id = GLib.timeout_add_seconds(PREVIEW_HANDSHAKE_TIMEOUT, self.on_handshake_timeout)
+        self.proc.get_stdout_pipe().read_bytes_async(1024, GLib.PRIORITY_DEFAULT, self.preview_cancellable,
+                                                     self.on_handshake_read, self.proc)
+        return False
+
+    def on_handshake_read(self, pipe, result, proc):
+        try:
+            bytes_read = pipe.read_bytes_finish(result)
+        except GLib.Error:
+            # Cancelled, the preview was killed in the meantime
+            return
+
+        if proc is not self.proc:
+            return
 
-        pipe = self.proc.get_stdout_pipe()
-        bytes_read = pipe.read_bytes(1024, None)
+        data = bytes_read.get_data().decode()
+        self.handshake_data += data
+        if data and "\n" not in self.handshake_data:
+            pipe.read_bytes_async(1024, GLib.PRIORITY_DEFAULT, self.preview_cancellable, self.on_handshake_read, proc)
+            return
+
+        GLib.source_remove(self.handshake_timeout_id)
+        self.handshake_timeout_id = 0
         pipe.close(None)
 
-        output = bytes_read.get_data().decode()
+        match = re.match('^\s*WINDOW ID=(\d+)\s*$', self.handshake_data)
+        if match:
+            self.socket.add_id(int(match.group(1)))
 
-        if output:
-            match = re.match('^\s*WINDOW ID=(\d+)\s*$', output)
-            if match:
-                self.socket.add_id(int(match.group(1)))
+    def on_handshake_timeout(self):
+        self.handshake_timeout_id = 0
+        print "Screensaver preview did not start in time: %s" % " ".join(self.preview_command)
+        self.kill_plug()
+        return False
 
     def on_stack_mapped(self, widget, data=None):
         self.kill_plug()
@@ -424,6 +427,8 @@ class ScreensaverBox(Gtk.Box):
 
     def idle_scroll_to_selection(self):
         row = self.list_box.get_selected_row()
+        if row is None:
+            return False
         alloc = row.get_allocation()
 
         adjustment = self.list_box.get_adjustment()
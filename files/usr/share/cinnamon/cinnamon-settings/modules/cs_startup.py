@@ -9,6 +9,7 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gio, Gtk, GObject, Gdk, GdkPixbuf, GLib, Pango
 
 from GSettingsWidgets import *
+import AppIndex
 
 try:
     ENVIRON = os.environ['XDG_CURRENT_DESKTOP']
@@ -63,23 +64,25 @@ class Module:
     def gather_apps(self):
         system_files = []
 
+        apps_by_name = {}
+
         user_files = glob.glob(os.path.join(GLib.get_user_config_dir(), "autostart", "*.desktop"))
         for app in user_files:
-            AUTOSTART_APPS.append(AutostartApp(app, user_position=os.path.dirname(app)))
+            autostart_app = AutostartApp(app, user_position=os.path.dirname(app))
+            AUTOSTART_APPS.append(autostart_app)
+            apps_by_name[os.path.basename(app)] = autostart_app
 
         for d in GLib.get_system_config_dirs():
             system_files.extend(glob.glob(os.path.join(d, "autostart", "*.desktop")))
 
         for sys_app in system_files:
-            found = False
-            for app in AUTOSTART_APPS:
-                if os.path.basename(sys_app) == os.path.basename(app.app):
-                    app.system_position = os.path.dirname(sys_app)
-                    found = True
-                    break
-
-            if not found:
-                AUTOSTART_APPS.append(AutostartApp(sys_app, system_position=os.path.dirname(sys_app)))
+            app = apps_by_name.get(os.path.basename(sys_app))
+            if app is not None:
+                app.system_position = os.path.dirname(sys_app)
+            else:
+                app = AutostartApp(sys_app, system_position=os.path.dirname(sys_app))
+                AUTOSTART_APPS.append(app)
+                apps_by_name[os.path.basename(sys_app)] = app
 
 class AutostartApp():
     def __init__(self, app, user_position=None, system_position=None):
@@ -886,7 +889,7 @@ class AppChooserDialog(Gtk.Dialog):
         list_box.set_filter_func(self.list_filter_func, None)
         self.entry.connect("search-changed", lambda e: list_box.invalidate_filter())
 
-        apps = Gio.app_info_get_all()
+        apps = AppIndex.get_default().get_all()
         for a in apps:
             if a.should_show():
                 widget = self.build_widget(a)
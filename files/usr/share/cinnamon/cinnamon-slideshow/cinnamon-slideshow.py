@@ -1,10 +1,16 @@
 #! /usr/bin/python2
 
-from gi.repository import Gio, GLib
+import gi
+gi.require_version('Gdk', '3.0')
+from gi.repository import Gio, GLib, Gdk, GdkPixbuf
 import dbus, dbus.service, dbus.glib
 from dbus.mainloop.glib import DBusGMainLoop
 import random
+import math
+import heapq
 import os, locale
+import hashlib
+import threading
 from xml.etree import ElementTree
 
 SLIDESHOW_DBUS_NAME = "org.Cinnamon.Slideshow"
@@ -13,6 +19,119 @@ SLIDESHOW_DBUS_PATH = "/org/Cinnamon/Slideshow"
 BACKGROUND_COLLECTION_TYPE_DIRECTORY = "directory"
 BACKGROUND_COLLECTION_TYPE_XML = "xml"
 
+# Screen-sized, upright copies of the images, named after their contents
+CACHE_DIR = os.path.join(GLib.get_user_cache_dir(), "cinnamon-slideshow")
+
+# With these options the background is scaled to the screen anyway, so a copy
+# just big enough to cover the screen looks the same as the original
+SCALED_PICTURE_OPTIONS = ("zoom", "scaled", "stretched", "spanned")
+
+class Playlist:
+    """ The images of a slideshow, in the order they are shown.
+
+    Folders are shown in sorted order from two heaps: the images still to
+    come this round and the ones already shown, which become the next round.
+    An image found later goes into whichever heap its name falls in. xml
+    collections keep file order in a list walked with a cursor. A set holds
+    the current images; removing one only drops it from the set, its entry
+    is skipped when reached and reclaimed once most entries are stale.
+    Random order draws from a bag of the images not shown yet this round.
+    """
+
+    def __init__(self, keep_sorted):
+        self.keep_sorted = keep_sorted
+        self.upcoming = []
+        self.shown = []
+        self.last = None
+        self.uris = []
+        self.position = 0
+        self.listed = set()
+        self.members = set()
+        self.bag = []
+        self.bagged = set()
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, uri):
+        return uri in self.members
+
+    def add(self, uri):
+        if uri in self.members:
+            return
+        self.members.add(uri)
+
+        if uri not in self.listed:
+            self.listed.add(uri)
+            if not self.keep_sorted:
+                self.uris.append(uri)
+            elif self.last is None or uri > self.last:
+                heapq.heappush(self.upcoming, uri)
+            else:
+                heapq.heappush(self.shown, uri)
+
+        if uri not in self.bagged:
+            self.bagged.add(uri)
+            self.bag.append(uri)
+
+    def remove(self, uri):
+        if uri not in self.members:
+            return
+        self.members.remove(uri)
+        if len(self.members) < len(self.listed) / 2:
+            self.compact()
+
+    def compact(self):
+        self.position = len([uri for uri in self.uris[:self.position] if uri in self.members])
+        self.uris = [uri for uri in self.uris if uri in self.members]
+        self.upcoming = [uri for uri in self.upcoming if uri in self.members]
+        self.shown = [uri for uri in self.shown if uri in self.members]
+        heapq.heapify(self.upcoming)
+        heapq.heapify(self.shown)
+        self.listed = set(self.uris) | set(self.upcoming) | set(self.shown)
+        self.bag = [uri for uri in self.bag if uri in self.members]
+        self.bagged = set(self.bag)
+
+    def get_next(self):
+        if len(self.members) == 0:
+            return None
+        if self.keep_sorted:
+            return self.get_next_sorted()
+        while True:
+            if self.position >= len(self.uris):
+                self.position = 0
+            uri = self.uris[self.position]
+            self.position += 1
+            if uri in self.members:
+                return uri
+
+    def get_next_sorted(self):
+        while True:
+            if len(self.upcoming) == 0:
+                self.upcoming, self.shown = self.shown, []
+            uri = heapq.heappop(self.upcoming)
+            if uri not in self.members:
+                self.listed.discard(uri)
+                continue
+            heapq.heappush(self.shown, uri)
+            self.last = uri
+            return uri
+
+    def get_random(self):
+        # Every image is drawn once before any of them is shown again
+        if len(self.members) == 0:
+            return None
+        while True:
+            if len(self.bag) == 0:
+                self.bag = list(self.members)
+                self.bagged = set(self.bag)
+            index = random.randrange(len(self.bag))
+            self.bag[index], self.bag[-1] = self.bag[-1], self.bag[index]
+            uri = self.bag.pop()
+            self.bagged.remove(uri)
+            if uri in self.members:
+                return uri
+
 class CinnamonSlideshow(dbus.service.Object):
     def __init__(self):
         bus_name = dbus.service.BusName(SLIDESHOW_DBUS_NAME, bus=dbus.SessionBus())
@@ -24,14 +143,18 @@ class CinnamonSlideshow(dbus.service.Object):
         if self.slideshow_settings.get_boolean("slideshow-paused"):
             self.slideshow_settings.set_boolean("slideshow-paused", False)
 
-        self.image_playlist = []
-        self.used_image_playlist = []
+        self.playlist = Playlist(True)
         self.images_ready = False
         self.update_in_progress = False
         self.current_image = self.background_settings.get_string("picture-uri")
 
+        # The first image is shown as soon as there is one
         self.update_id = 0
-        self.loop_counter = self.slideshow_settings.get_int("delay")
+        self.next_change_time = self.get_time()
+        self.prefetch_uri = None
+        self.prefetched_uri = None
+        self.delay = self.slideshow_settings.get_int("delay")
+        self.paused = False
 
         self.folder_monitor = None
         self.folder_monitor_id = 0
@@ -50,20 +173,17 @@ class CinnamonSlideshow(dbus.service.Object):
 
     @dbus.service.method(SLIDESHOW_DBUS_NAME, in_signature='', out_signature='')
     def getNextImage(self):
-        if self.update_id > 0:
-            GLib.source_remove(self.update_id)
-            self.update_id = 0
-
-        self.loop_counter = self.slideshow_settings.get_int("delay")
-        self.start_mainloop()
+        self.next_change_time = self.get_time()
+        self.schedule_next_change()
 
     def setup_slideshow(self):
+        self.remove_unused_copies()
         self.load_settings()
         self.connect_signals()
         self.gather_images()
         if self.collection_type == BACKGROUND_COLLECTION_TYPE_DIRECTORY:
             self.connect_folder_monitor()
-        self.start_mainloop()
+        self.schedule_next_change()
 
     def format_source(self, type, path):
         # returns 'type://path'
@@ -71,6 +191,8 @@ class CinnamonSlideshow(dbus.service.Object):
 
     def load_settings(self):
         self.random_order = self.slideshow_settings.get_boolean("random-order")
+        self.delay = self.slideshow_settings.get_int("delay")
+        self.paused = self.slideshow_settings.get_boolean("slideshow-paused")
         self.collection = self.slideshow_settings.get_string("image-source")
         self.collection_path = ""
         self.collection_type = None
@@ -81,6 +203,8 @@ class CinnamonSlideshow(dbus.service.Object):
     def connect_signals(self):
         self.slideshow_settings.connect("changed::image-source", self.on_slideshow_source_changed)
         self.slideshow_settings.connect("changed::random-order", self.on_random_order_changed)
+        self.slideshow_settings.connect("changed::delay", self.on_delay_changed)
+        self.slideshow_settings.connect("changed::slideshow-paused", self.on_paused_changed)
         self.background_settings.connect("changed::picture-uri", self.on_picture_uri_changed)
 
     def connect_folder_monitor(self):
@@ -94,6 +218,11 @@ class CinnamonSlideshow(dbus.service.Object):
             self.folder_monitor_id = 0
 
     def gather_images(self):
+        self.playlist = Playlist(self.collection_type == BACKGROUND_COLLECTION_TYPE_DIRECTORY)
+        self.images_ready = False
+        self.prefetch_uri = None
+        self.prefetched_uri = None
+
         if self.collection_type == BACKGROUND_COLLECTION_TYPE_DIRECTORY:
             folder_at_path = Gio.file_new_for_path(self.collection_path)
 
@@ -112,19 +241,20 @@ class CinnamonSlideshow(dbus.service.Object):
                 self.add_image_to_playlist(filename)
 
     def gather_images_cb(self, obj, res, user_data):
-        all_files = []
         enumerator = obj.enumerate_children_finish(res)
-        def on_next_file_complete(obj, res, user_data=all_files):
+        playlist = self.playlist
+        def on_next_file_complete(obj, res, user_data):
             files = obj.next_files_finish(res)
-            file_list = all_files
-            if len(files) is not 0:
-                file_list = file_list.extend(files)
+            if playlist is not self.playlist:
+                # The source changed while the folder was being listed
+                enumerator.close(None)
+            elif len(files) is not 0:
+                self.ensure_file_is_image(files)
                 enumerator.next_files_async(100, GLib.PRIORITY_LOW, None, on_next_file_complete, None)
             else:
                 enumerator.close(None)
-                self.ensure_file_is_image(file_list)
 
-        enumerator.next_files_async(100, GLib.PRIORITY_LOW, None, on_next_file_complete, all_files)
+        enumerator.next_files_async(100, GLib.PRIORITY_LOW, None, on_next_file_complete, None)
 
     def ensure_file_is_image(self, file_list):
         for item in file_list:
@@ -136,20 +266,16 @@ class CinnamonSlideshow(dbus.service.Object):
 
     def add_image_to_playlist(self, file_path):
         image = Gio.file_new_for_path(file_path)
-        image_uri = image.get_uri();
-        self.image_playlist.append(image_uri)
-        if self.collection_type == BACKGROUND_COLLECTION_TYPE_DIRECTORY:
-            self.image_playlist.sort()
-        self.images_ready = True
+        self.playlist.add(image.get_uri())
+        if not self.images_ready:
+            self.images_ready = True
+            self.schedule_next_change()
 
     def on_slideshow_source_changed(self, settings, key):
         if self.update_id > 0:
             GLib.source_remove(self.update_id)
             self.update_id = 0
         self.disconnect_folder_monitor()
-        self.image_playlist = []
-        self.used_image_playlist = []
-        self.images_ready = False
         self.collection = self.slideshow_settings.get_string("image-source")
         self.collection_path = ""
         self.collection_type = None
@@ -159,19 +285,14 @@ class CinnamonSlideshow(dbus.service.Object):
         if self.collection_type == BACKGROUND_COLLECTION_TYPE_DIRECTORY:
             self.connect_folder_monitor()
         self.gather_images()
-        self.loop_counter = self.slideshow_settings.get_int("delay")
-        self.start_mainloop()
+        self.next_change_time = self.get_time()
+        self.schedule_next_change()
 
     def on_monitored_folder_changed(self, monitor, file1, file2, event_type):
         try:
             if event_type == Gio.FileMonitorEvent.DELETED:
-                file_uri = file1.get_uri();
-                if self.image_playlist.count(file_uri) > 0:
-                    index_to_remove = self.image_playlist.index(file_uri)
-                    del self.image_playlist[index_to_remove]
-                elif self.used_image_playlist.count(file_uri) > 0:
-                    index_to_remove = self.used_image_playlist.index(file_uri)
-                    del self.used_image_playlist[index_to_remove]
+                self.playlist.remove(file1.get_uri())
+                self.images_ready = len(self.playlist) > 0
 
             if event_type == Gio.FileMonitorEvent.CREATED:
                 file_path = file1.get_path()
@@ -187,28 +308,51 @@ class CinnamonSlideshow(dbus.service.Object):
     def on_random_order_changed(self, settings, key):
         self.random_order = self.slideshow_settings.get_boolean("random-order")
 
+    def on_delay_changed(self, settings, key):
+        # Counted from the last change, like before the delay was edited
+        delay = self.slideshow_settings.get_int("delay")
+        self.next_change_time += (delay - self.delay) * 60
+        self.delay = delay
+        self.schedule_next_change()
+
+    def on_paused_changed(self, settings, key):
+        # The deadline keeps running while paused, a change that fell due in
+        # the meantime happens on resume
+        self.paused = self.slideshow_settings.get_boolean("slideshow-paused")
+        self.schedule_next_change()
+
     def on_picture_uri_changed(self, settings, key):
+        self.remove_unused_copies()
         if self.update_in_progress:
             return
         else:
             if self.background_settings.get_string("picture-uri") != self.current_image:
                 self.slideshow_settings.set_boolean("slideshow-enabled", False)
 
-    def start_mainloop(self):
+    def get_time(self):
+        return GLib.get_monotonic_time() / 1000000.0
+
+    def schedule_next_change(self):
+        # A single timer is armed for the next change, nothing runs until then
         if self.update_id > 0:
             GLib.source_remove(self.update_id)
             self.update_id = 0
 
-        if not self.images_ready:
-            self.update_id = GLib.timeout_add_seconds(1, self.start_mainloop)
+        if not self.images_ready or self.paused:
+            return
+
+        remaining = self.next_change_time - self.get_time()
+        if remaining <= 0:
+            self.update_id = GLib.idle_add(self.on_change_due)
         else:
-            if self.loop_counter >= self.slideshow_settings.get_int("delay") and not self.slideshow_settings.get_boolean("slideshow-paused"):
-                self.loop_counter = 1
-                self.update_background()
-                self.update_id = GLib.timeout_add_seconds(60, self.start_mainloop)
-            else:
-                self.loop_counter = self.loop_counter + 1
-                self.update_id = GLib.timeout_add_seconds(60, self.start_mainloop)
+            self.update_id = GLib.timeout_add_seconds(int(math.ceil(remaining)), self.on_change_due)
+
+    def on_change_due(self):
+        self.update_id = 0
+        self.update_background()
+        self.next_change_time = self.get_time() + self.delay * 60
+        self.schedule_next_change()
+        return False
 
     def update_background(self):
         if self.update_in_progress:
@@ -216,37 +360,160 @@ class CinnamonSlideshow(dbus.service.Object):
 
         self.update_in_progress = True
 
-        if len(self.image_playlist) == 0:
-            self.move_used_images_to_original_playlist()
+        if self.prefetch_uri is not None and self.prefetch_uri in self.playlist:
+            # Falls back to the original if the copy is not ready yet
+            next_image = self.prefetch_uri
+            if self.prefetched_uri is not None and os.path.exists(Gio.File.new_for_uri(self.prefetched_uri).get_path()):
+                next_image = self.prefetched_uri
+        else:
+            next_image = self.get_next_image_from_list()
+        self.prefetch_uri = None
+        self.prefetched_uri = None
 
-        next_image = self.get_next_image_from_list()
         if next_image is not None:
             self.background_settings.set_string("picture-uri", next_image)
             self.current_image = next_image
+            self.prefetch_next_image()
 
         self.update_in_progress = False
 
-    def get_next_image_from_list(self):
-        if self.random_order:
-            index = random.randint(0, len(self.image_playlist) - 1)
-            image = self.image_playlist[index]
-        else:
-            index = 0
-            image = self.image_playlist[index]
-
-        self.move_image_to_used_playlist(index, image)
+    def prefetch_next_image(self):
+        # Picks the image to show next and prepares it in a thread, so it is
+        # ready by the time it is due
+        self.prefetch_uri = self.get_next_image_from_list()
+        self.prefetched_uri = None
+        if self.prefetch_uri is None:
+            return
 
-        return image
+        width, height = 0, 0
+        if self.background_settings.get_string("picture-options") in SCALED_PICTURE_OPTIONS:
+            width, height = self.get_screen_size()
+
+        thread = threading.Thread(target=self.prepare_image, args=(self.prefetch_uri, width, height))
+        thread.daemon = True
+        thread.start()
+
+    def get_screen_size(self):
+        # The largest size a background is shown at, in device pixels
+        screen = Gdk.Screen.get_default()
+        if screen is None:
+            return 0, 0
+
+        if self.background_settings.get_string("picture-options") == "spanned":
+            scale = screen.get_monitor_scale_factor(0)
+            return screen.get_width() * scale, screen.get_height() * scale
+
+        width, height = 0, 0
+        for monitor in range(screen.get_n_monitors()):
+            rect = screen.get_monitor_geometry(monitor)
+            scale = screen.get_monitor_scale_factor(monitor)
+            width = max(width, rect.width * scale)
+            height = max(height, rect.height * scale)
+        return width, height
+
+    def get_cache_key(self, path, width, height):
+        # The same picture is only prepared once, wherever it is stored
+        md5 = hashlib.md5("%d:%d:" % (width, height))
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                md5.update(data)
+        return md5.hexdigest()
+
+    def prepare_image(self, uri, width, height):
+        # Runs in a thread. Decoding the image checks it is not corrupted, and
+        # a copy is made when it is larger than the screen or needs rotating,
+        # so the shell only has a screen-sized image to load when it is due.
+        prepared_uri = None
+        try:
+            path = Gio.File.new_for_uri(uri).get_path()
+            key = self.get_cache_key(path, width, height)
+            for extension in (".jpg", ".png"):
+                filename = os.path.join(CACHE_DIR, key + extension)
+                if os.path.exists(filename):
+                    GLib.idle_add(self.on_image_prepared, uri, Gio.File.new_for_path(filename).get_uri())
+                    return
+
+            format, image_width, image_height = GdkPixbuf.Pixbuf.get_file_info(path)
+            if format is None:
+                raise Exception("unknown image format")
+
+            pixbuf = self.load_at_cover_size(path, image_width, image_height, width, height)
+            orientation = pixbuf.get_option("orientation")
+            if orientation in ("5", "6", "7", "8") and (pixbuf.get_width(), pixbuf.get_height()) != (image_width, image_height):
+                # Turned sideways, the other side has to cover the screen width
+                pixbuf = self.load_at_cover_size(path, image_width, image_height, height, width)
+            scaled = (pixbuf.get_width(), pixbuf.get_height()) != (image_width, image_height)
+            if orientation not in (None, "1"):
+                pixbuf = pixbuf.apply_embedded_orientation()
+
+            if not scaled and orientation in (None, "1"):
+                prepared_uri = uri
+            else:
+                if not os.path.exists(CACHE_DIR):
+                    os.makedirs(CACHE_DIR)
+                if pixbuf.get_has_alpha():
+                    filename = os.path.join(CACHE_DIR, key + ".png")
+                    pixbuf.savev(filename + ".tmp", "png", [], [])
+                else:
+                    filename = os.path.join(CACHE_DIR, key + ".jpg")
+                    pixbuf.savev(filename + ".tmp", "jpeg", ["quality"], ["95"])
+                os.rename(filename + ".tmp", filename)
+                prepared_uri = Gio.File.new_for_path(filename).get_uri()
+        except Exception, detail:
+            print "Skipping %s: %s" % (uri, detail)
+
+        GLib.idle_add(self.on_image_prepared, uri, prepared_uri)
+
+    def load_at_cover_size(self, path, image_width, image_height, width, height):
+        # Decodes straight at the smallest size covering width x height
+        if width <= 0 or height <= 0:
+            return GdkPixbuf.Pixbuf.new_from_file(path)
+        scale = min(1.0, max(float(width) / image_width, float(height) / image_height))
+        return GdkPixbuf.Pixbuf.new_from_file_at_scale(path,
+                                                       max(1, int(round(image_width * scale))),
+                                                       max(1, int(round(image_height * scale))),
+                                                       True)
+
+    def on_image_prepared(self, uri, prepared_uri):
+        if uri != self.prefetch_uri:
+            # Already shown, or the source changed in the meantime
+            return False
+
+        if prepared_uri is None:
+            # Unreadable, it never reaches the background
+            self.playlist.remove(uri)
+            self.prefetch_next_image()
+        else:
+            self.prefetched_uri = prepared_uri
+        return False
 
-    def move_image_to_used_playlist(self, index, image):
-        self.image_playlist.pop(index)
-        self.used_image_playlist.append(image)
+    def remove_unused_copies(self):
+        # A copy stays until picture-uri no longer points at it, so the
+        # background survives restarts; the one prepared next is kept too
+        keep = set([self.background_settings.get_string("picture-uri"), self.prefetched_uri])
+        try:
+            filenames = os.listdir(CACHE_DIR)
+        except OSError:
+            return
+        for filename in filenames:
+            if filename.endswith(".tmp"):
+                # Still being written by a prefetch
+                continue
+            path = os.path.join(CACHE_DIR, filename)
+            if Gio.File.new_for_path(path).get_uri() not in keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
 
-    def move_used_images_to_original_playlist(self):
-        self.image_playlist = self.used_image_playlist
-        if self.collection_type == BACKGROUND_COLLECTION_TYPE_DIRECTORY:
-            self.image_playlist.sort()
-        self.used_image_playlist = []
+    def get_next_image_from_list(self):
+        if self.random_order:
+            return self.playlist.get_random()
+        else:
+            return self.playlist.get_next()
 
 
 ########### TAKEN FROM CS_BACKGROUND
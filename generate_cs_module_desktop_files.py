@@ -3,7 +3,7 @@
 DOMAIN = "cinnamon"
 PATH = "/usr/share/locale"
 
-import os, gettext, sys
+import os, gettext, sys, json
 sys.path.append('/usr/lib/linuxmint/common')
 import additionalfiles
 
@@ -38,6 +38,10 @@ except Exception, detail:
     print detail
     sys.exit(1)
 
+# Startup manifest read by cinnamon-settings so it can list the modules without
+# importing them. Strings are stored untranslated and looked up at runtime.
+MANIFEST_FILE = "files/usr/share/cinnamon/cinnamon-settings/data/modules.json"
+manifest = []
 
 for i in range(len(modules)):
     try:
@@ -60,8 +64,20 @@ Categories=Settings;
 """ % {'module': mod.name, 'category': category, 'icon': mod.sidePage.icon}
 
         additionalfiles.generate(DOMAIN, PATH, "files/usr/share/applications/cinnamon-settings-%s.desktop" % mod.name, prefix, mod.sidePage.name, mod.comment, "", None, mod.sidePage.keywords)
-        
+
+        manifest.append({"module": mod_files[i],
+                         "name": mod.name,
+                         "label": mod.sidePage.name,
+                         "icon": mod.sidePage.icon,
+                         "category": mod.category,
+                         "keywords": mod.sidePage.keywords,
+                         "load_check": hasattr(mod, "_loadCheck")})
+
     except:
         print "Failed to load module %s" % modules[i]
         import traceback
         traceback.print_exc()
+
+with open(MANIFEST_FILE, "w") as f:
+    json.dump(manifest, f, indent=4, separators=(",", ": "), sort_keys=True)
+    f.write("\n")
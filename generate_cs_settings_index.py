@@ -0,0 +1,142 @@
+#!/usr/bin/python2
+
+# Builds the index cinnamon-settings searches to find individual settings. The
+# modules are only parsed, not imported, so this runs without a session. The
+# strings are stored untranslated and looked up at runtime.
+#
+# Run it by hand from the top of the source tree and commit the updated
+# data/settings-index.json along with the module changes.
+
+import os
+import ast
+import glob
+import json
+
+SETTINGS_DIR = "files/usr/share/cinnamon/cinnamon-settings"
+XLETS_DIR = "files/usr/share/cinnamon"
+INDEX_FILE = os.path.join(SETTINGS_DIR, "data/settings-index.json")
+INDEX_VERSION = 1
+
+WIDGET_FILES = ["bin/SettingsWidgets.py", "bin/GSettingsWidgets.py", "bin/ChooserButtonWidgets.py", "bin/KeybindingWidgets.py"]
+
+def get_string(node):
+    # Returns the text of "string" and _("string"), None for anything else
+    if isinstance(node, ast.Str):
+        return node.s
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "_" \
+       and len(node.args) == 1 and isinstance(node.args[0], ast.Str):
+        return node.args[0].s
+    return None
+
+def get_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+def find_widget_classes(trees):
+    # Every class deriving from SettingsWidget, plus the generated GSettings variants
+    bases = {}
+    can_backend = []
+    for tree in trees:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ClassDef):
+                bases[node.name] = [get_name(base) for base in node.bases]
+            elif isinstance(node, ast.Assign) and get_name(node.targets[0]) == "CAN_BACKEND":
+                can_backend = [element.s for element in node.value.elts]
+
+    def is_widget(name, seen):
+        if name == "SettingsWidget":
+            return True
+        if name in seen or name not in bases:
+            return False
+        seen.add(name)
+        return any(is_widget(base, seen) for base in bases[name])
+
+    widgets = set(name for name in bases if is_widget(name, set()))
+    widgets.update("GSettings" + name for name in can_backend)
+    return widgets
+
+class ModuleIndexer(ast.NodeVisitor):
+    # Visits a module in source order, remembering the stack page that
+    # widgets are being added to
+    def __init__(self, widget_classes):
+        self.widget_classes = widget_classes
+        self.module = None
+        self.page = None
+        self.entries = []
+
+    def visit_ClassDef(self, node):
+        if node.name == "Module":
+            for statement in node.body:
+                if isinstance(statement, ast.Assign) and get_name(statement.targets[0]) == "name":
+                    self.module = get_string(statement.value)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        name = get_name(node.func)
+        if name in ("add_titled", "add_named") and len(node.args) >= 2:
+            page = get_string(node.args[1])
+            if page is not None:
+                self.page = page
+        elif name in self.widget_classes and len(node.args) > 0:
+            label = get_string(node.args[0])
+            if label:
+                strings = [get_string(arg) for arg in node.args[1:3]]
+                strings += [None] * (2 - len(strings))
+                for keyword in node.keywords:
+                    if keyword.arg == "schema":
+                        strings[0] = get_string(keyword.value)
+                    elif keyword.arg == "key":
+                        strings[1] = get_string(keyword.value)
+                schema, key = strings
+                if schema is None or "." not in schema:
+                    schema = key = None
+                self.entries.append([self.page, label, schema, key])
+        self.generic_visit(node)
+
+def index_modules():
+    widget_trees = [ast.parse(open(os.path.join(SETTINGS_DIR, path)).read()) for path in WIDGET_FILES]
+    entries = []
+
+    for path in sorted(glob.glob(os.path.join(SETTINGS_DIR, "modules/cs_*.py"))):
+        tree = ast.parse(open(path).read(), path)
+        indexer = ModuleIndexer(find_widget_classes(widget_trees + [tree]))
+        indexer.visit(tree)
+        if indexer.module is None:
+            print "No module name found in %s" % path
+            continue
+        for page, label, schema, key in indexer.entries:
+            entries.append([indexer.module, page, label, schema, key])
+
+    return entries
+
+def index_xlets():
+    entries = []
+
+    for collection in ("applet", "desklet", "extension"):
+        for path in sorted(glob.glob(os.path.join(XLETS_DIR, "%ss" % collection, "*", "settings-schema.json"))):
+            uuid = os.path.basename(os.path.dirname(path))
+            with open(path) as f:
+                schema = json.load(f)
+            for key in sorted(schema.keys()):
+                setting = schema[key]
+                if not isinstance(setting, dict) or "description" not in setting:
+                    continue
+                if setting.get("type") in ("layout", "page", "section", "header", "separator"):
+                    continue
+                entries.append([collection, uuid, setting["description"], key])
+
+    return entries
+
+if __name__ == "__main__":
+    index = {"version": INDEX_VERSION,
+             "settings": index_modules(),
+             "xlets": index_xlets()}
+
+    with open(INDEX_FILE, "w") as f:
+        json.dump(index, f, separators=(",", ":"), sort_keys=True)
+        f.write("\n")
+
+    print "Indexed %d settings and %d xlet settings" % (len(index["settings"]), len(index["xlets"]))
@@ -0,0 +1,202 @@
+#!/usr/bin/python2
+
+# Runs HttpFetcher against a local stand-in for the Spices server:
+#   python2 tests/unit/test_http_fetcher.py
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../files/usr/share/cinnamon/cinnamon-settings/bin"))
+from HttpFetcher import HttpFetcher, FetchError, FetchAborted
+
+BODY = "spice " * 4096
+ETAG = '"v1"'
+LAST_MODIFIED = "Mon, 01 Aug 2016 10:00:00 GMT"
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, headers={}):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers={}):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address, dict(self.headers)))
+
+        if self.path == "/etag":
+            if self.headers.get("If-None-Match") == ETAG:
+                self.send_empty(304)
+            else:
+                self.send_body(BODY, {"ETag": ETAG})
+        elif self.path == "/last-modified":
+            if self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+                self.send_empty(304)
+            else:
+                self.send_body(BODY, {"Last-Modified": LAST_MODIFIED})
+        elif self.path == "/redirect":
+            self.send_empty(302, {"Location": "/etag"})
+        elif self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(BODY[:100])
+            self.close_connection = 1
+        else:
+            self.send_empty(404)
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.requests = []
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response is part of the tests
+        pass
+
+class HttpFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+        self.directory = tempfile.mkdtemp()
+        self.validators_file = os.path.join(self.directory, "validators.json")
+        self.fetcher = HttpFetcher(self.validators_file, proxies={})
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def get_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_fetch(self):
+        path = self.get_path("etag")
+        self.assertTrue(self.fetcher.fetch(self.base_url + "/etag", path))
+        self.assertEqual(self.read(path), BODY)
+        self.assertFalse(os.path.exists(path + ".part"))
+
+    def test_keep_alive(self):
+        for i in range(3):
+            self.fetcher.fetch(self.base_url + "/etag", self.get_path("etag%d" % i))
+        clients = set(client for path, client, headers in self.server.requests)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(clients), 1)
+
+    def test_not_modified_etag(self):
+        path = self.get_path("etag")
+        url = self.base_url + "/etag"
+        self.assertTrue(self.fetcher.fetch(url, path))
+        self.assertFalse(self.fetcher.fetch(url, path))
+        self.assertEqual(self.server.requests[-1][2].get("if-none-match"), ETAG)
+        self.assertEqual(self.read(path), BODY)
+
+    def test_not_modified_last_modified(self):
+        path = self.get_path("last-modified")
+        url = self.base_url + "/last-modified"
+        self.assertTrue(self.fetcher.fetch(url, path))
+        self.assertFalse(self.fetcher.fetch(url, path))
+        self.assertEqual(self.server.requests[-1][2].get("if-modified-since"), LAST_MODIFIED)
+
+    def test_validators_saved(self):
+        path = self.get_path("etag")
+        url = self.base_url + "/etag"
+        self.fetcher.fetch(url, path)
+        self.fetcher.save()
+
+        fetcher = HttpFetcher(self.validators_file, proxies={})
+        try:
+            self.assertTrue(fetcher.has_validators(url))
+            self.assertFalse(fetcher.fetch(url, path))
+        finally:
+            fetcher.close()
+
+    def test_unconditional(self):
+        path = self.get_path("etag")
+        url = self.base_url + "/etag"
+        self.fetcher.fetch(url, path)
+        self.assertTrue(self.fetcher.fetch(url, path, conditional=False))
+        self.assertNotIn("if-none-match", self.server.requests[-1][2])
+
+    def test_missing_file_is_fetched_again(self):
+        # Validators are only sent when there is a copy to validate
+        path = self.get_path("etag")
+        url = self.base_url + "/etag"
+        self.fetcher.fetch(url, path)
+        os.remove(path)
+        self.assertTrue(self.fetcher.fetch(url, path))
+        self.assertNotIn("if-none-match", self.server.requests[-1][2])
+
+    def test_redirect(self):
+        path = self.get_path("redirect")
+        self.assertTrue(self.fetcher.fetch(self.base_url + "/redirect", path))
+        self.assertEqual(self.read(path), BODY)
+
+    def test_http_error(self):
+        path = self.get_path("missing")
+        self.assertRaises(FetchError, self.fetcher.fetch, self.base_url + "/missing", path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_truncated(self):
+        path = self.get_path("truncated")
+        self.assertRaises(FetchError, self.fetcher.fetch, self.base_url + "/truncated", path)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".part"))
+
+    def test_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.assertRaises(FetchError, self.fetcher.fetch, "http://127.0.0.1:%d/etag" % port, self.get_path("refused"))
+
+    def test_abort(self):
+        path = self.get_path("etag")
+        self.assertRaises(FetchAborted, self.fetcher.fetch, self.base_url + "/etag", path, None, lambda: True)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".part"))
+
+    def test_dropped_idle_connection(self):
+        # A kept-alive connection the server closed in the meantime is
+        # replaced by a fresh one
+        self.fetcher.fetch(self.base_url + "/etag", self.get_path("first"))
+        for idle in self.fetcher.idle_connections.values():
+            for conn in idle:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(self.fetcher.fetch(self.base_url + "/etag", self.get_path("second")))
+
+if __name__ == "__main__":
+    unittest.main()